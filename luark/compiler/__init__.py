@@ -1,2 +1,7 @@
 from luark.compiler.compiler import Compiler
 from luark.compiler.program import *
+from luark.compiler import precompiled
+from luark.compiler.cache import CompilationCache
+from luark.compiler.optimizer import Optimizer
+from luark.compiler.profiling import CompilerObserver, EventRecorder, PhaseEvent
+from luark.compiler.incremental import FunctionCache
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from functools import cache
+from os import PathLike
+from pathlib import Path
+
+import lark
+
+from luark.compiler import precompiled
+from luark.compiler.errors import PrecompiledFormatError
+from luark.compiler.program import Program
+
+# Files whose contents determine the code the compiler generates, relative
+# to the luark package. Changing any of them, or the version of lark,
+# invalidates every cached program.
+_COMPILER_FILES = (
+    "compiler/grammar.lark",
+    "compiler/luark_ast.py",
+    "compiler/compiler.py",
+    "compiler/parser.py",
+    "compiler/program.py",
+    "compiler/precompiled.py",
+    "compiler/optimizer.py",
+    "compiler/folding.py",
+    "compiler/incremental.py",
+    "compiler/streaming.py",
+    "numbers.py",
+)
+
+
+@cache
+def compiler_fingerprint() -> bytes:
+    digest = hashlib.sha256()
+    digest.update(str(precompiled.FORMAT_VERSION).encode())
+    digest.update(lark.__version__.encode())
+    directory = Path(__file__).parent.parent
+    for name in _COMPILER_FILES:
+        digest.update(name.encode())
+        digest.update((directory / name).read_bytes())
+    return digest.digest()
+
+
+class CompilationCache:
+    # Programs are looked up in memory first, then on disk. Cached
+    # programs are shared between callers and must not be modified.
+
+    def __init__(
+            self,
+            max_entries: int = 256,
+            directory: str | PathLike | None = None,
+            max_disk_size: int = 256 * 1024 * 1024,
+    ):
+        self.max_entries = max_entries
+        self.directory = Path(directory) if directory is not None else None
+        self.max_disk_size = max_disk_size
+        self._memory: OrderedDict[str, Program] = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, source: str, options: str = "") -> str:
+        digest = hashlib.sha256(compiler_fingerprint())
+        digest.update(options.encode())
+        digest.update(b"\0")
+        digest.update(source.encode("utf_8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Program | None:
+        program = self._memory.get(key)
+        if program is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return program
+
+        program = self._load(key)
+        if program is not None:
+            self._remember(key, program)
+            self.disk_hits += 1
+            return program
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, program: Program):
+        self._remember(key, program)
+        self._store(key, program)
+
+    def clear(self):
+        self._memory.clear()
+        if self.directory is not None:
+            for path in self._disk_entries():
+                self._remove(path)
+
+    def _remember(self, key: str, program: Program):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = program
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / (key + precompiled.EXTENSION)
+
+    def _load(self, key: str) -> Program | None:
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            program = precompiled.load(path)
+        except (OSError, ValueError, PrecompiledFormatError):
+            return None
+        try:
+            os.utime(path)  # mark as recently used for eviction
+        except OSError:
+            pass
+        return program
+
+    def _store(self, key: str, program: Program):
+        if self.directory is None:
+            return
+        data = precompiled.dumps(program)
+        if len(data) > self.max_disk_size:
+            return
+
+        # Write to a temporary file first so that other processes
+        # never observe a partially written entry.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            self._remove(Path(temp_path))
+            return
+        self._evict()
+
+    def _disk_entries(self) -> list[Path]:
+        return list(self.directory.glob("*" + precompiled.EXTENSION))
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for path in self._disk_entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_size:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: Path):
+        try:
+            path.unlink()
+        except OSError:
+            pass
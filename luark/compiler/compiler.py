@@ -1,43 +1,228 @@
-import sys
+import os
+import pickle
+from concurrent.futures import Future
 from os import PathLike
-from pathlib import Path
+from typing import IO
 
-from lark import Lark, ast_utils
-
-import luark
-import luark.compiler.luark_ast
-from luark.compiler.errors import InternalCompilerError
-from luark.compiler.luark_ast import LuarkTransformer, Chunk
-from luark.compiler.program import Program
+from luark.compiler import precompiled
+from luark.compiler.cache import CompilationCache
+from luark.compiler.errors import InternalCompilerError, CompilationError
+from luark.compiler.incremental import FunctionCache
+from luark.compiler.luark_ast import Chunk, ChunkEmitter, _ProgramState
+from luark.compiler.optimizer import Optimizer
+from luark.compiler.parser import build_parser, create_transformer, get_parser, get_transformer
+from luark.compiler.profiling import CompilerObserver, EventRecorder, PhaseEvent, Profiler, ast_size, tree_size
+from luark.compiler.program import Program, ConstantPool
+from luark.compiler.streaming import DEFAULT_CHUNK_SIZE, parse_stream
 
 
 class Compiler:
-    def __init__(self, debug: bool = False):
+    def __init__(
+            self,
+            debug: bool = False,
+            cache: CompilationCache | None = None,
+            optimization_level: int = 1,
+            observers: list[CompilerObserver] | None = None,
+            trace_memory: bool = False,
+            incremental: bool = False,
+    ):
         self.debug = debug
-        path = Path(luark.compiler.compiler.__file__).parent / "grammar.lark"
-        with open(path) as file:
-            self.grammar = file.read()
-        self.lark = Lark(grammar=self.grammar, parser="lalr", cache=True, debug=self.debug, propagate_positions=True)
-        self.transformer = ast_utils.create_transformer(
-            sys.modules[luark.compiler.luark_ast.__name__],
-            LuarkTransformer(),
-        )
-
-    def compile_source(self, source: str) -> Program:
-        tree = self.lark.parse(source)
+        self.cache = cache
+        self.optimizer = Optimizer(optimization_level)
+        self.observers: list[CompilerObserver] = list(observers) if observers else []
+        self.trace_memory = trace_memory
+        # Functions of the last compilation of every source name, see incremental.py.
+        self.function_caches: dict[str, FunctionCache] | None = {} if incremental else None
+        if self.debug:
+            # Debug parsers report grammar conflicts, so they are never shared.
+            self.lark = build_parser(debug=True)
+            self.transformer = create_transformer()
+        else:
+            self.lark = get_parser()
+            self.transformer = get_transformer()
+
+    def add_observer(self, observer: CompilerObserver):
+        self.observers.append(observer)
+
+    def remove_observer(self, observer: CompilerObserver):
+        self.observers.remove(observer)
+
+    def compile_source(self, source: str, name: str = "<source>") -> Program:
+        if self.cache is None:
+            return self._compile(source, name)
+
+        key = self.cache.key(source, self._cache_options())
+        program = self.cache.get(key)
+        if program is None:
+            program = self._compile(source, name)
+            self.cache.put(key, program)
+        return program
+
+    def _compile(self, source: str, name: str = "<source>") -> Program:
+        profiler = Profiler(self.observers, name, self.trace_memory)
+        return profiler.run("compile", self._run_phases, source, profiler, size=_instruction_count)
+
+    def _run_phases(self, source: str, profiler: Profiler) -> Program:
+        tree = profiler.run("parse", self.lark.parse, source, size=tree_size)
         if self.debug:
             print(tree.pretty())
 
-        chunk: Chunk = self.transformer.transform(tree)
+        chunk: Chunk = profiler.run("transform", self.transformer.transform, tree, size=ast_size)
         if not isinstance(chunk, Chunk):
             raise InternalCompilerError("Attempted to compile something other than a chunk.")
-        program: Program = chunk.emit()
+        cache = None
+        if self.function_caches is not None:
+            cache = self.function_caches.setdefault(profiler.name, FunctionCache())
+        state = profiler.run("emit", chunk.generate, cache, size=lambda s: s.instruction_count())
+        profiler.run("optimize", state.optimize, self.optimizer, size=lambda _: state.instruction_count())
+        program = state.compile()
         if self.debug:
             print(program)
 
         return program
 
-    def compile_file(self, path: str | PathLike) -> Program:
+    def compile_file(self, path: str | PathLike, streaming: bool = False) -> Program:
+        if streaming:
+            with open(path) as file:
+                return self.compile_stream(file, str(path))
         with open(path) as file:
             source = file.read()
-        return self.compile_source(source)
+        return self.compile_source(source, str(path))
+
+    def compile_stream(
+            self,
+            file: IO[str],
+            name: str = "<stream>",
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Program:
+        # Compiles the source while it is being read, without holding all
+        # of it or its parse tree in memory, see streaming.py. Streamed
+        # sources are never cached.
+        profiler = Profiler(self.observers, name, self.trace_memory)
+        return profiler.run("compile", self._run_streamed, file, chunk_size, profiler, size=_instruction_count)
+
+    def _run_streamed(self, file: IO[str], chunk_size: int, profiler: Profiler) -> Program:
+        state = profiler.run("stream", self._emit_stream, file, chunk_size, size=lambda s: s.instruction_count())
+        profiler.run("optimize", state.optimize, self.optimizer, size=lambda _: state.instruction_count())
+        program = state.compile()
+        if self.debug:
+            print(program)
+
+        return program
+
+    def _emit_stream(self, file: IO[str], chunk_size: int) -> _ProgramState:
+        emitter = ChunkEmitter()
+        for statement in parse_stream(self.lark, self.transformer, file, chunk_size):
+            emitter.emit(statement)
+        return emitter.finish()
+
+    def compile_many(
+            self,
+            paths: list[str | PathLike],
+            workers: int | None = None,
+    ) -> list[Program | Exception]:
+        # Results are returned in the order of the given paths. A file
+        # that fails to compile yields the exception instead of a program.
+        results: list[Program | Exception | None] = [None] * len(paths)
+        sources: dict[int, str] = {}
+        for i, path in enumerate(paths):
+            try:
+                with open(path) as file:
+                    sources[i] = file.read()
+            except OSError as e:
+                results[i] = e
+
+        keys: dict[int, str] = {}
+        if self.cache is not None:
+            for i, source in list(sources.items()):
+                keys[i] = self.cache.key(source, self._cache_options())
+                program = self.cache.get(keys[i])
+                if program is not None:
+                    results[i] = program
+                    del sources[i]
+
+        # Schedule the largest files first so that a single big
+        # file does not end up as the tail of the batch.
+        pending = sorted(sources, key=lambda i: len(sources[i]), reverse=True)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(pending))
+
+        if workers <= 1:
+            for i in pending:
+                try:
+                    results[i] = self._compile(sources[i], str(paths[i]))
+                except Exception as e:
+                    results[i] = e
+        else:
+            # Imported here, as multiprocessing takes a while to import.
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_worker,
+                    initargs=(self.optimizer.level, bool(self.observers), self.trace_memory),
+            ) as executor:
+                constants = ConstantPool()  # shared by the programs of this batch
+                futures: dict[int, Future] = {}
+                for i in pending:
+                    futures[i] = executor.submit(_compile_in_worker, sources.pop(i), str(paths[i]))
+                for i, future in futures.items():
+                    try:
+                        data, events = future.result()
+                        results[i] = precompiled.loads(data, constants)
+                    except Exception as e:
+                        results[i] = e
+                        continue
+                    # The phases have already run, so only their results are passed on.
+                    for event in events:
+                        for observer in self.observers:
+                            observer.phase_finished(event)
+
+        if self.cache is not None:
+            for i, key in keys.items():
+                if isinstance(results[i], Program):
+                    self.cache.put(key, results[i])
+
+        return results
+
+    def _cache_options(self) -> str:
+        return f"-O{self.optimizer.level}"
+
+
+_worker_compiler: Compiler | None = None
+
+
+def _instruction_count(program: Program) -> int:
+    return sum(len(proto) for proto in program.prototypes)
+
+
+def _init_worker(optimization_level: int, profile: bool, trace_memory: bool):
+    # Build the parser up front so that every worker is warm before the first job.
+    global _worker_compiler
+    _worker_compiler = Compiler(
+        optimization_level=optimization_level,
+        observers=[EventRecorder()] if profile else None,
+        trace_memory=trace_memory,
+    )
+
+
+def _compile_in_worker(source: str, name: str) -> tuple[bytes, list[PhaseEvent]]:
+    # Programs travel back to the parent in the precompiled format,
+    # which is much cheaper to transfer than pickled prototypes.
+    # Phase events of failed compilations are not sent back.
+    events = []
+    for recorder in _worker_compiler.observers:
+        recorder.clear()
+        events = recorder.events
+    try:
+        return precompiled.dumps(_worker_compiler._compile(source, name)), events
+    except Exception as e:
+        # Exceptions are pickled on their way to the parent process. Some of
+        # them (e.g. Lark's VisitError) cannot be restored there and would
+        # break the whole pool, so they are replaced with a plain error.
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            raise CompilationError(f"{type(e).__name__}: {e}") from None
+        raise
@@ -3,3 +3,6 @@ class InternalCompilerError(RuntimeError):
 
 class CompilationError(RuntimeError):
     pass
+
+class PrecompiledFormatError(RuntimeError):
+    pass
@@ -0,0 +1,107 @@
+import math
+
+from luark import numbers
+from luark.compiler.program import Opcode
+from luark.errors import LuaError
+
+# Evaluation of operators with constant operands at compile time. It follows
+# the semantics of the VM exactly, which is why the number helpers shared with
+# the VM are used. Constants are represented by their Lua values: None, bool,
+# int, float and str. NotImplemented is returned for operations which cannot be folded,
+# e.g. because they would raise an error at runtime.
+
+_ARITHMETIC = {
+    Opcode.ADD: "add",
+    Opcode.SUB: "sub",
+    Opcode.MUL: "mul",
+    Opcode.DIV: "div",
+    Opcode.FDIV: "fdiv",
+    Opcode.MOD: "mod",
+    Opcode.EXP: "exp",
+}
+
+_BITWISE = {
+    Opcode.BAND: "band",
+    Opcode.BOR: "bor",
+    Opcode.BXOR: "bxor",
+    Opcode.LSH: "lsh",
+    Opcode.RSH: "rsh",
+}
+
+
+def _is_number(value) -> bool:
+    return value.__class__ is int or value.__class__ is float
+
+
+def _tostring(value) -> str:
+    return value if value.__class__ is str else numbers.number_to_str(value)
+
+
+def _checked(value):
+    # NaN and negative zero cannot be told apart from other
+    # constants in the constant table, so they are left alone.
+    if value.__class__ is float and (value != value or (value == 0.0 and math.copysign(1.0, value) < 0)):
+        return NotImplemented
+    return value
+
+
+def fold_binary(opcode: Opcode, a, b):
+    if opcode in _ARITHMETIC:
+        # Strings are coerced to numbers at runtime, but like
+        # the reference implementation, only numbers are folded.
+        if not _is_number(a) or not _is_number(b):
+            return NotImplemented
+        try:
+            return _checked(numbers.arith_int_or_float(_ARITHMETIC[opcode], a, b))
+        except LuaError:  # e.g. integer division by zero
+            return NotImplemented
+
+    if opcode in _BITWISE:
+        if not _is_number(a) or not _is_number(b):
+            return NotImplemented
+        x, y = numbers.tointeger(a), numbers.tointeger(b)
+        if x is None or y is None:
+            return NotImplemented
+        return numbers.bitwise(_BITWISE[opcode], x, y)
+
+    match opcode:
+        case Opcode.EQ:
+            return numbers.raw_equals(a, b)
+        case Opcode.NEQ:
+            return not numbers.raw_equals(a, b)
+        case Opcode.LT | Opcode.LE | Opcode.GT | Opcode.GE:
+            if not (_is_number(a) and _is_number(b)) and not (a.__class__ is str and b.__class__ is str):
+                return NotImplemented
+            match opcode:
+                case Opcode.LT:
+                    return a < b
+                case Opcode.LE:
+                    return a <= b
+                case Opcode.GT:
+                    return a > b
+                case Opcode.GE:
+                    return a >= b
+        case Opcode.CONCAT:
+            if (a.__class__ is str or _is_number(a)) and (b.__class__ is str or _is_number(b)):
+                return _tostring(a) + _tostring(b)
+    return NotImplemented
+
+
+def fold_unary(opcode: Opcode, a):
+    match opcode:
+        case Opcode.NEGATE:
+            if a.__class__ is int:
+                return numbers.wrap_int(-a)
+            if a.__class__ is float:
+                return _checked(-a)
+        case Opcode.NOT:
+            return not numbers.truthy(a)
+        case Opcode.LEN:
+            if a.__class__ is str:
+                return len(a)
+        case Opcode.BNOT:
+            if _is_number(a):
+                x = numbers.tointeger(a)
+                if x is not None:
+                    return numbers.wrap_int(~x)
+    return NotImplemented
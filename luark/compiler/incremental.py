@@ -0,0 +1,99 @@
+import hashlib
+from enum import Enum
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # The code generator imports this module.
+    from luark.compiler.luark_ast import _ProtoState
+
+# Incremental compilation. Every emitted function is fingerprinted by the
+# structure of its body, and remembers which names from the enclosing
+# functions it resolved and what they referred to (a compile time constant,
+# a local of an enclosing function or a global). When a source is compiled
+# again, a function with the same fingerprint whose names still refer to the
+# same things reuses the optimized prototypes of the previous compilation,
+# together with the functions nested in it. Only the changed functions and
+# the ones enclosing them are emitted and optimized again.
+
+
+class CachedFunction:
+    __slots__ = ("names", "bindings", "protos", "base", "size")
+
+    def __init__(self, names: tuple[str, ...], bindings: tuple, protos: list["_ProtoState"], base: int, size: int):
+        self.names = names  # resolved outside of the function
+        self.bindings = bindings  # what each of the names referred to
+        self.protos = protos  # of the whole program, the function is at 'base'
+        self.base = base
+        self.size = size  # the function and the ones nested in it
+
+    def prototypes(self) -> list["_ProtoState"]:
+        return self.protos[self.base:self.base + self.size]
+
+
+class FunctionCache:
+    # The functions of the last successful compilation of a source.
+
+    def __init__(self):
+        self.entries: dict[bytes, list[CachedFunction]] = {}
+        self.reused = 0  # prototypes taken from the cache by the last compilation
+        self.emitted = 0  # prototypes emitted by the last compilation
+
+    def find(self, fingerprint: bytes) -> list[CachedFunction]:
+        return self.entries.get(fingerprint, [])
+
+    def update(self, protos: list["_ProtoState"]):
+        entries = {}
+        for index, proto in enumerate(protos):
+            if proto.fingerprint is not None:
+                entry = CachedFunction(proto.names, proto.bindings, protos, index, proto.subtree_size)
+                entries.setdefault(proto.fingerprint, []).append(entry)
+        self.entries = entries
+
+    def clear(self):
+        self.entries.clear()
+
+
+def fingerprint(node, memo: dict[int, tuple[Any, bytes]], boundary: type) -> bytes:
+    # The node is serialized into a list of strings which is hashed at once.
+    # Nodes of the boundary type (function bodies) inside of it are
+    # fingerprinted on their own and only contribute their digest, so every
+    # node is serialized once. The memo keeps the nodes alive, so that their
+    # ids are not reused.
+    entry = memo.get(id(node))
+    if entry is not None:
+        return entry[1]
+    parts = []
+    _serialize(node, parts, memo, boundary)
+    result = hashlib.blake2b("\0".join(parts).encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    memo[id(node)] = (node, result)
+    return result
+
+
+def _serialize(node, parts: list[str], memo: dict[int, tuple[Any, bytes]], boundary: type):
+    parts.append(type(node).__qualname__)
+    for name, value in vars(node).items():
+        parts.append(name)
+        if isinstance(value, list):
+            parts.append("[")
+            for item in value:
+                _serialize_value(item, parts, memo, boundary)
+            parts.append("]")
+        else:
+            _serialize_value(value, parts, memo, boundary)
+    parts.append(")")
+
+
+def _serialize_value(value, parts: list[str], memo: dict[int, tuple[Any, bytes]], boundary: type):
+    if isinstance(value, str):
+        parts.append(repr(str(value)))  # lark tokens are strings too
+    elif value is None or isinstance(value, (bool, int, float, Enum)):
+        parts.append(repr(value))
+    elif isinstance(value, (list, tuple)):
+        parts.append("[")
+        for item in value:
+            _serialize_value(item, parts, memo, boundary)
+        parts.append("]")
+    elif isinstance(value, boundary):
+        parts.append(fingerprint(value, memo, boundary).hex())
+    else:
+        _serialize(value, parts, memo, boundary)
@@ -1,14 +1,21 @@
+import copy
+import hashlib
 import math
+from array import array
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from enum import Enum, auto
-from typing import Callable, TypeAlias
+from typing import TypeAlias
 
 from lark.ast_utils import Ast, AsList
 from lark.visitors import Transformer, Discard
 
 from luark.compiler.errors import InternalCompilerError, CompilationError
-from luark.compiler.program import Program, Prototype, LocalVar, LocalVarIndex, ConstValue
+from luark.compiler.folding import fold_binary, fold_unary
+from luark.compiler.incremental import FunctionCache, fingerprint
+from luark.compiler.optimizer import Optimizer
+from luark.compiler.program import Program, Prototype, LocalVar, LocalVarIndex, ConstValue, ConstantPool, Opcode, \
+    INSTRUCTION_SIZE, OPERAND_MIN, OPERAND_MAX, new_code, const_key
 
 
 # TODO: closing upvalues
@@ -16,15 +23,25 @@ from luark.compiler.program import Program, Prototype, LocalVar, LocalVarIndex,
 
 class _BlockState:
     current_locals: LocalVarIndex
-    labels: dict[str, int]
+    labels: dict[str, tuple[int, int]]
     const_locals: dict[str, "Expression"]
-    gotos: dict
+    gotos: list[tuple[int, str, int]]
+    captured: set[int]
+    tbc_locals: list[int]
+    is_loop: bool
 
     def __init__(self):
         self.current_locals = LocalVarIndex()
-        self.labels = {}
+        self.labels = {}  # pc and the number of named locals in scope, by name
         self.const_locals = {}  # compile time constants referenced by names from code
-        self.gotos = {}
+        self.gotos = []  # pending forward jumps: pc, label and the number of named locals in scope
+        self.captured = set()  # locals referenced as upvalues by nested functions
+        self.tbc_locals = []  # to-be-closed variables, in the order of declaration
+        self.is_loop = False  # the body of a loop, 'break' leaves it
+
+
+def _named_locals(block: _BlockState) -> int:
+    return sum(1 for var in block.current_locals if var.name)
 
 
 class _ProtoState:
@@ -44,10 +61,20 @@ class _ProtoState:
 
     block_stack: list[_BlockState]
     upvalues: dict[str, int]
-    consts: dict[ConstValue, int]
-    opcodes: list[str]
+    upvalue_sources: list[tuple[bool, int]]
+    consts: dict[tuple, int]  # keyed by const_key()
+    const_values: list[ConstValue]
+    opcodes: array
 
     breaks: list[list[int]]
+    reserved: set[int]
+
+    optimized: bool
+    fingerprint: bytes | None
+    escapes: set[str]
+    names: tuple[str, ...]
+    bindings: tuple
+    subtree_size: int
 
     def __init__(self, func_name: str = None):
         self.locals = LocalVarIndex()
@@ -66,10 +93,21 @@ class _ProtoState:
 
         self.block_stack = []
         self.upvalues = {}
+        self.upvalue_sources = []
         self.consts = {}
-        self.opcodes = []
+        self.const_values = []
+        self.opcodes = new_code()
 
         self.breaks = []
+        self.reserved = set()  # pcs of the reserved opcodes which are not set yet
+
+        self.optimized = False
+        # Only set when compiling incrementally, see incremental.py.
+        self.fingerprint = None
+        self.escapes = set()  # names resolved outside of the function
+        self.names = ()
+        self.bindings = ()
+        self.subtree_size = 1
 
     @property
     def block(self) -> _BlockState:
@@ -79,20 +117,26 @@ class _ProtoState:
     def pc(self):
         return self._pc
 
-    def get_upvalue_index(self, name: str) -> int:
+    def get_upvalue_index(self, name: str, in_stack: bool = False, source: int = 0) -> int:
+        # The source tells the VM where to take the upvalue from when creating
+        # a closure: a local of the enclosing function if 'in_stack' is set,
+        # or one of the enclosing function's own upvalues otherwise.
         if name in self.upvalues:
             return self.upvalues[name]
         index = self.num_upvalues
         self.num_upvalues += 1
         self.upvalues[name] = index
+        self.upvalue_sources.append((in_stack, source))
         return index
 
     def get_const_index(self, value: ConstValue) -> int:
-        if value in self.consts:
-            return self.consts[value]
-        index = self.num_consts
-        self.num_consts += 1
-        self.consts[value] = index
+        key = const_key(value)
+        index = self.consts.get(key)
+        if index is None:
+            index = self.num_consts
+            self.num_consts += 1
+            self.consts[key] = index
+            self.const_values.append(value)
         return index
 
     def _next_local_index(self) -> int:
@@ -124,60 +168,135 @@ class _ProtoState:
         return var.index
 
     def release_local(self, index: int):
-        self.locals_pool.append(index)
+        if index not in self.locals_pool:
+            self.locals_pool.append(index)
+
+    def close_captured(self, block: _BlockState):
+        # Closes the to-be-closed variables of the block and detaches
+        # upvalues from its locals, so that their slots can safely be reused.
+        self.close_variables(block)
+        for index in sorted(block.captured):
+            if index not in block.tbc_locals:
+                self.add_opcode(Opcode.CLOSE, index)
+
+    def close_variables(self, block: _BlockState):
+        # To-be-closed variables are closed in the reverse order of declaration.
+        for index in reversed(block.tbc_locals):
+            self.add_opcode(Opcode.CLOSE, index)
+
+    def enter_loop(self):
+        # The innermost block is the body of a loop.
+        self.block.is_loop = True
+        self.breaks.append([])
 
     def add_label(self, name: str):
         if name not in self.block.labels:
-            self.block.labels[name] = self.pc
+            self.block.labels[name] = (self.pc, _named_locals(self.block))
         else:
             raise CompilationError(f"Label '{name}' is already defined.")
 
-    def get_label_target(self, name: str):
-        if name in self.block.labels:
-            return self.block.labels[name]
-        else:
-            raise CompilationError(f"Label '{name}' is not defined.")
+    def end_statements(self):
+        # Labels which no code follows in their block are out of the scope
+        # of its locals, so that a goto declared before them may jump there.
+        labels = self.block.labels
+        for name, (pc, _) in labels.items():
+            if pc == self.pc:
+                labels[name] = (pc, 0)
 
-    def add_opcode(self, opcode):
+    def add_goto(self, label: str):
+        if any(block.tbc_locals for block in self.block_stack):
+            raise CompilationError("Cannot use goto in the scope of a to-be-closed variable.")
+        for block in reversed(self.block_stack):
+            if label in block.labels:
+                self.add_jump(block.labels[label][0])
+                return
+        # Forward jumps are set at the end of the block, see resolve_gotos().
+        self.block.gotos.append((self.pc, label, _named_locals(self.block)))
+        self.reserve_opcodes(1)
+
+    def resolve_gotos(self):
+        # Called at the end of the innermost block. Sets the pending jumps to
+        # its labels and leaves the other ones to the enclosing block.
+        block = self.block
+        outer = self.block_stack[-2] if len(self.block_stack) > 1 else None
+        for pc, label, num_locals in block.gotos:
+            if label in block.labels:
+                target, label_locals = block.labels[label]
+                if label_locals > num_locals:
+                    raise CompilationError("Cannot jump into a scope of a local variable.")
+                self.set_jump(pc, target)
+            elif outer is not None:
+                outer.gotos.append((pc, label, _named_locals(outer)))
+            else:
+                raise CompilationError(f"Label '{label}' is not defined.")
+        block.gotos = []
+
+    def add_opcode(self, opcode: Opcode, a: int = 0, b: int = 0):
         if opcode is None:
             raise InternalCompilerError("Attempted to add a None opcode.")
-        self.opcodes.append(opcode)
+        self.opcodes.extend((opcode, a, b))
         self._pc += 1
 
+    def set_opcode(self, pc: int, opcode: Opcode, a: int = 0, b: int = 0):
+        offset = pc * INSTRUCTION_SIZE
+        self.opcodes[offset:offset + INSTRUCTION_SIZE] = array("i", (opcode, a, b))
+        self.reserved.discard(pc)
+
     def reserve_opcodes(self, count: int) -> int:
         pc = self._pc
         for _ in range(count):
-            # noinspection PyTypeChecker
-            self.opcodes.append(None)
-            self._pc += count
+            # Reserved slots jump far past the end of the code until they are
+            # set, so that running one fails instead of doing something else.
+            self.opcodes.extend((Opcode.JUMP, OPERAND_MAX, 0))
+            self.reserved.add(self._pc)
+            self._pc += 1
         return pc
 
     def add_jump(self, to: int, from_: int = None):
-        if not from_:
+        if from_ is None:
             from_ = self._pc
-        self.add_opcode(f"jump {to - from_}")
+        self.add_opcode(Opcode.JUMP, to - from_)
 
     def set_jump(self, jump_pc: int, target: int = None):
-        if not target:
+        if target is None:
             target = self._pc
-        self.opcodes[jump_pc] = f"jump {target - jump_pc}"
+        self.set_opcode(jump_pc, Opcode.JUMP, target - jump_pc)
 
     def pop_opcode(self):
-        self.opcodes.pop()
+        del self.opcodes[-INSTRUCTION_SIZE:]
         self._pc -= 1
-
-    def add_goto(self, label: str):
-        self.block.gotos[self.pc] = (label, len(self.block.current_locals))
-        self.reserve_opcodes(1)
-
-    def compile(self) -> Prototype:
+        self.reserved.discard(self._pc)
+
+    def optimize(self, optimizer: Optimizer):
+        if self.optimized:
+            return
+        code = optimizer.optimize(self.opcodes, self.locals)
+        if code is not None:
+            self.opcodes = code
+            self._pc = len(code) // INSTRUCTION_SIZE
+        self.optimized = True
+
+    def relocated(self, delta: int) -> "_ProtoState":
+        # A copy for a program where the function and the ones
+        # nested in it start 'delta' prototypes further.
+        proto = copy.copy(self)
+        if delta:
+            code = array("i", self.opcodes)
+            for offset in range(0, len(code), INSTRUCTION_SIZE):
+                if code[offset] == Opcode.CLOSURE:
+                    code[offset + 1] += delta
+            proto.opcodes = code
+        return proto
+
+    def compile(self, constants: ConstantPool) -> Prototype:
         prototype = Prototype()
         prototype.func_name = self.func_name
         prototype.opcodes = self.opcodes
         prototype.num_locals = self.num_locals
         prototype.locals = self.locals
-        prototype.consts = list(self.consts.keys())
+        prototype.consts = [constants.intern(value) for value in self.const_values]
         prototype.upvalues = list(self.upvalues.keys())
+        prototype.upvalue_sources = self.upvalue_sources
         prototype.fixed_params = self.fixed_params
         prototype.is_variadic = self.is_variadic
         return prototype
@@ -192,10 +311,15 @@ class _ProgramState:
         LOAD = auto()
         STORE = auto()
 
-    def __init__(self):
+    def __init__(self, cache: FunctionCache | None = None):
         self.protos = []
         self.proto_stack = []
         self.num_lambdas = 0
+        self.cache = cache  # only set when compiling incrementally
+        self._fingerprints = {}
+        if cache is not None:
+            cache.reused = 0
+            cache.emitted = 0
 
     @property
     def proto(self) -> _ProtoState | None:
@@ -224,6 +348,11 @@ class _ProgramState:
 
     def pop_block(self):
         proto = self.proto
+        proto.resolve_gotos()
+        if len(proto.block_stack) > 1:
+            # Frames are never reused, so the function's outermost block
+            # does not have to close anything.
+            proto.close_captured(proto.block)
         block = proto.block_stack.pop()
         end = self.proto.pc - 1
         for var in block.current_locals:
@@ -231,37 +360,61 @@ class _ProgramState:
             proto.release_local(var.index)
         self.proto.locals.merge(block.current_locals)
 
+    def lookup_const(self, name: str) -> "Expression | None":
+        # Finds the compile time constant the name refers to,
+        # unless it is shadowed by a variable.
+        for depth in range(len(self.proto_stack) - 1, -1, -1):
+            for block in reversed(self.proto_stack[depth].block_stack):
+                if name in block.const_locals:
+                    self._escape(name, depth)
+                    return block.const_locals[name]
+                if block.current_locals.has_name(name):
+                    self._escape(name, depth)
+                    return None
+        self._escape(name, -1)
+        return None
+
     def read(self, state: "_ProgramState", name: str):
         self._resolve(name, state, self._ResolveAction.LOAD)
 
     def assign(self, state: "_ProgramState", name: str):
         self._resolve(name, state, self._ResolveAction.STORE)
 
+    def _declares_env(self, limit: int | None = None) -> bool:
+        for proto in self.proto_stack[:limit]:
+            for block in proto.block_stack:
+                if block.current_locals.has_name("_ENV"):
+                    return True
+        return False
+
     def _resolve(self, name: str, state: "_ProgramState", action: _ResolveAction):
         current_proto = self.proto
         visited_protos = []  # these protos may need an upvalue passed down to them
         for proto in reversed(self.proto_stack):
-            visited_protos.append(proto)
             upvalue = self.proto != proto  # upvalues are locals from an enclosing function
             for block in reversed(proto.block_stack):
                 if name in block.const_locals:  # check consts first
+                    self._escape(name, len(self.proto_stack) - 1 - len(visited_protos))
                     block.const_locals[name].evaluate(state)
                     return
                 if block.current_locals.has_name(name):  # then check locals (and upvalues)
+                    self._escape(name, len(self.proto_stack) - 1 - len(visited_protos))
                     if upvalue:
                         # A local variable in an outer function. Create an
                         # upvalue and drill it through the proto stack.
-                        for vp in visited_protos:
-                            vp.get_upvalue_index(name)
-                        upvalue_index = current_proto.get_upvalue_index(name)
+                        var = block.current_locals.get_by_name(name)[-1]
+                        block.captured.add(var.index)
+                        upvalue_index = visited_protos[-1].get_upvalue_index(name, True, var.index)
+                        for vp in reversed(visited_protos[:-1]):
+                            upvalue_index = vp.get_upvalue_index(name, False, upvalue_index)
 
-                        opcode: str
+                        opcode: Opcode
                         if action == self._ResolveAction.LOAD:
-                            opcode = "load_upvalue"
+                            opcode = Opcode.LOAD_UPVALUE
                         else:
-                            opcode = "store_upvalue"
+                            opcode = Opcode.STORE_UPVALUE
 
-                        current_proto.add_opcode(f"{opcode} {upvalue_index}")
+                        current_proto.add_opcode(opcode, upvalue_index)
                     else:
                         # A local variable in the same function.
                         var = block.current_locals.get_by_name(name)[-1]
@@ -270,43 +423,155 @@ class _ProgramState:
                         if var.is_const:
                             if var.const_value:  # compile time constant
                                 const_index = current_proto.get_const_index(var.const_value)
-                                current_proto.add_opcode(f"push_const {const_index}")
+                                current_proto.add_opcode(Opcode.PUSH_CONST, const_index)
                             else:  # runtime constant
                                 if action == self._ResolveAction.STORE:
                                     raise CompilationError(f"Cannot reassign constant variable '{name}'.")
-                                current_proto.add_opcode(f"load_local {local_index}")
+                                current_proto.add_opcode(Opcode.LOAD_LOCAL, local_index)
                             return
 
-                        opcode: str
+                        opcode: Opcode
                         if action == self._ResolveAction.LOAD:
-                            opcode = "load_local"
+                            opcode = Opcode.LOAD_LOCAL
                         else:
-                            opcode = "store_local"
+                            opcode = Opcode.STORE_LOCAL
 
-                        current_proto.add_opcode(f"{opcode} {local_index}")
+                        current_proto.add_opcode(opcode, local_index)
                     return
+            visited_protos.append(proto)
 
         # If we could not find the local either in the same function or
         # in any of the enclosing ones, treat the variable as a global.
-        env_index: int
+        self._escape(name, -1)
+        if name != "_ENV" and self._declares_env():
+            # A variable named _ENV is in scope, so the global is its field.
+            self._resolve("_ENV", state, self._ResolveAction.LOAD)
+            current_proto.add_opcode(Opcode.PUSH_CONST, current_proto.get_const_index(name))
+            if action == self._ResolveAction.LOAD:
+                current_proto.add_opcode(Opcode.GET_TABLE)
+            else:
+                current_proto.add_opcode(Opcode.SET_TABLE)
+            return
+
+        env_index = 0
         for proto in self.proto_stack:
-            env_index = proto.get_upvalue_index("_ENV")
+            env_index = proto.get_upvalue_index("_ENV", False, env_index)
+        if name == "_ENV":
+            # noinspection PyUnboundLocalVariable
+            if action == self._ResolveAction.LOAD:
+                current_proto.add_opcode(Opcode.GET_UPVALUE, env_index)
+            else:
+                current_proto.add_opcode(Opcode.STORE_UPVALUE, env_index)
+            return
+
         name_index = current_proto.get_const_index(name)
-        # noinspection PyUnboundLocalVariable
-        current_proto.add_opcode(f"get_upvalue {env_index}")
-        current_proto.add_opcode(f"push_const {name_index}")
 
-        opcode: str
+        opcode: Opcode
         if action == self._ResolveAction.LOAD:
-            opcode = "get_table"
+            opcode = Opcode.GET_GLOBAL
         else:
-            opcode = "set_table"
-        current_proto.add_opcode(opcode)
+            opcode = Opcode.SET_GLOBAL
+        # noinspection PyUnboundLocalVariable
+        current_proto.add_opcode(opcode, env_index, name_index)
+
+    # Incremental compilation
+
+    def _escape(self, name: str, depth: int):
+        # The name was found in the function at the given depth of the
+        # stack, or nowhere if it is -1. What the functions nested in it
+        # emit depends on what the name refers to there.
+        if self.cache is not None:
+            for proto in self.proto_stack[depth + 1:]:
+                proto.escapes.add(name)
+
+    def _binding(self, name: str, limit: int) -> tuple[int, tuple]:
+        # What the name refers to in the functions below the given
+        # depth of the stack, and the depth it was found at.
+        for depth in range(limit - 1, -1, -1):
+            for block in reversed(self.proto_stack[depth].block_stack):
+                if name in block.const_locals:
+                    return depth, ("const", const_key(block.const_locals[name].fold(self)))
+                if block.current_locals.has_name(name):
+                    return depth, ("local",)
+        return -1, ("global", self._declares_env(limit))
+
+    def _capture(self, name: str, depth: int) -> tuple[bool, int]:
+        # Makes the variable available to a function nested in the one
+        # at the given depth of the stack, like resolving it from the
+        # nested function would, and returns the upvalue source.
+        proto = self.proto_stack[depth]
+        for block in reversed(proto.block_stack):
+            if block.current_locals.has_name(name):
+                var = block.current_locals.get_by_name(name)[-1]
+                block.captured.add(var.index)
+                return True, var.index
+        if depth == 0:
+            return False, proto.get_upvalue_index(name)
+        return False, proto.get_upvalue_index(name, *self._capture(name, depth - 1))
+
+    def fingerprint(self, body: "FuncBody") -> bytes:
+        digest = hashlib.blake2b(fingerprint(body, self._fingerprints, FuncBody), digest_size=16)
+        # Methods get their 'self' parameter after the body has been
+        # fingerprinted as a part of the enclosing function.
+        if body.params is not None:
+            digest.update(repr((body.params.names, body.params.has_varargs)).encode())
+        return digest.digest()
+
+    def reuse(self, fingerprint: bytes, func_name: str) -> int | None:
+        # Returns the index of the reused prototype, if there is one.
+        limit = len(self.proto_stack)
+        for entry in self.cache.find(fingerprint):
+            depths = []
+            for name, binding in zip(entry.names, entry.bindings):
+                depth, current = self._binding(name, limit)
+                if current != binding:
+                    break
+                depths.append(depth)
+            else:
+                break
+        else:
+            return None
+
+        index = len(self.protos)
+        for i, proto in enumerate(entry.prototypes()):
+            proto = proto.relocated(index - entry.base)
+            if i == 0:
+                proto.func_name = func_name
+            elif proto.func_name.startswith("$lambda#"):
+                # Lambdas are numbered in the order they are emitted.
+                proto.func_name = f"$lambda#{self.next_lambda_index()}"
+            self.protos.append(proto)
+        self.cache.reused += entry.size
+
+        root = self.protos[index]
+        if self.proto_stack:
+            root.upvalue_sources = [self._capture(name, limit - 1) for name in root.upvalues]
+        for name, depth in zip(entry.names, depths):
+            self._escape(name, depth)
+        return index
+
+    def record(self, proto: _ProtoState, index: int, fingerprint: bytes):
+        # Called when the function at the top of the stack has been emitted.
+        limit = len(self.proto_stack) - 1
+        proto.fingerprint = fingerprint
+        proto.names = tuple(sorted(proto.escapes))
+        proto.bindings = tuple(self._binding(name, limit)[1] for name in proto.names)
+        proto.subtree_size = len(self.protos) - index
+        self.cache.emitted += 1
+
+    def optimize(self, optimizer: Optimizer):
+        for proto in self.protos:
+            proto.optimize(optimizer)
+
+    def instruction_count(self) -> int:
+        return sum(len(proto.opcodes) for proto in self.protos) // INSTRUCTION_SIZE
 
     def compile(self) -> Program:
         program = Program()
         for proto in self.protos:
-            program.prototypes.append(proto.compile())
+            program.prototypes.append(proto.compile(program.constants))
+        if self.cache is not None:
+            self.cache.update(self.protos)
         return program
 
     def next_lambda_index(self) -> int:
@@ -326,6 +591,11 @@ class Expression(ABC):
     def evaluate(self, state: _ProgramState):
         raise NotImplementedError
 
+    def fold(self, state: _ProgramState):
+        # Returns the value of the expression if it is known at compile
+        # time, or NotImplemented otherwise.
+        return NotImplemented
+
 
 class MultiresExpression(ABC):
     @abstractmethod
@@ -337,7 +607,7 @@ def evaluate_single(state: _ProgramState, expr: Expression | MultiresExpression)
     if isinstance(expr, FuncCall):  # function/method calls
         expr.evaluate(state, 2)
     elif isinstance(expr, Varargs):
-        expr.evaluate(state, 1)
+        expr.evaluate(state, 2)
     elif isinstance(expr, Expression):  # standard singleres expression
         expr.evaluate(state)
     else:
@@ -364,21 +634,18 @@ def adjust_static(
 
     difference = count - len(expr_list)
     if difference > 0:  # append nils
-        if expr_list:
-            if isinstance(expr_list[-1], MultiresExpression):
-                expr: MultiresExpression = expr_list[-1]
-                expr.evaluate(state, 2 + difference)
-            else:
-                for _ in range(difference):
-                    state.proto.add_opcode("push_nil")
-                evaluate_single(state, expr_list[-1])
-        else:
-            for _ in range(difference):
-                state.proto.add_opcode("push_nil")
-
         for i in range(len(expr_list) - 1):
             expr = expr_list[i]
             evaluate_single(state, expr)
+
+        if expr_list and isinstance(expr_list[-1], MultiresExpression):
+            expr: MultiresExpression = expr_list[-1]
+            expr.evaluate(state, 2 + difference)
+        else:
+            if expr_list:
+                evaluate_single(state, expr_list[-1])
+            for _ in range(difference):
+                state.proto.add_opcode(Opcode.PUSH_NIL)
     else:
         # Even if there are more values then expected,
         # we still have to evaluate them all and simply
@@ -388,17 +655,20 @@ def adjust_static(
             expr = expr_list[i]
             evaluate_single(state, expr)
 
+        extra = -difference  # diff is <= 0 here, so negate it
         last = expr_list[-1]
         if isinstance(last, MultiresExpression):
             # Tell the VM to discard all values if
             # we're already beyond the list of names.
             return_count = 2 if (difference == 0) else 1
             last.evaluate(state, return_count)
+            if extra:
+                extra -= 1  # the last expression produced nothing
         else:
             evaluate_single(state, last)
 
-        for _ in range(-difference):  # diff is < 0 here, so negate it
-            state.proto.add_opcode("pop")  # discard extra values
+        for _ in range(extra):
+            state.proto.add_opcode(Opcode.POP)  # discard extra values
 
 
 @dataclass
@@ -407,33 +677,46 @@ class String(Ast, Expression):
 
     def evaluate(self, state: _ProgramState):
         index = state.proto.get_const_index(self.value)
-        state.proto.add_opcode(f"push_const {index}")
+        state.proto.add_opcode(Opcode.PUSH_CONST, index)
+
+    def fold(self, state: _ProgramState):
+        return self.value
 
 
 @dataclass
 class Number(Ast, Expression):
     value: int | float
 
+    def fold(self, state: _ProgramState):
+        return self.value
+
     def evaluate(self, state: _ProgramState):
         if isinstance(self.value, int):
-            state.proto.add_opcode(f"push_int {self.value}")
+            if OPERAND_MIN <= self.value <= OPERAND_MAX:
+                state.proto.add_opcode(Opcode.PUSH_INT, self.value)
+            else:  # does not fit into an operand
+                index = state.proto.get_const_index(self.value)
+                state.proto.add_opcode(Opcode.PUSH_CONST, index)
         elif isinstance(self.value, float):
             if math.isinf(self.value) or math.isnan(self.value):
                 index = state.proto.get_const_index(self.value)
-                state.proto.add_opcode(f"push_const {index}")
+                state.proto.add_opcode(Opcode.PUSH_CONST, index)
                 return
 
             frac = self.value - int(self.value)
-            if frac == 0.0:
-                state.proto.add_opcode(f"push_float {int(self.value)}")
+            if frac == 0.0 and OPERAND_MIN <= self.value <= OPERAND_MAX:
+                state.proto.add_opcode(Opcode.PUSH_FLOAT, int(self.value))
             else:
                 index = state.proto.get_const_index(self.value)
-                state.proto.add_opcode(f"push_const {index}")
+                state.proto.add_opcode(Opcode.PUSH_CONST, index)
 
 
 class NilValue(Expression):
     def evaluate(self, state: _ProgramState):
-        state.proto.add_opcode("push_nil")
+        state.proto.add_opcode(Opcode.PUSH_NIL)
+
+    def fold(self, state: _ProgramState):
+        return None
 
 
 NilValue.instance = NilValue()
@@ -441,7 +724,10 @@ NilValue.instance = NilValue()
 
 class TrueValue(Expression):
     def evaluate(self, state: _ProgramState):
-        state.proto.add_opcode("push_true")
+        state.proto.add_opcode(Opcode.PUSH_TRUE)
+
+    def fold(self, state: _ProgramState):
+        return True
 
 
 TrueValue.instance = TrueValue()
@@ -449,7 +735,10 @@ TrueValue.instance = TrueValue()
 
 class FalseValue(Expression):
     def evaluate(self, state: _ProgramState):
-        state.proto.add_opcode("push_false")
+        state.proto.add_opcode(Opcode.PUSH_FALSE)
+
+    def fold(self, state: _ProgramState):
+        return False
 
 
 FalseValue.instance = FalseValue()
@@ -457,31 +746,120 @@ FalseValue.instance = FalseValue()
 ConstExpr: TypeAlias = String | Number | NilValue | TrueValue | FalseValue
 
 
+def const_expr(value) -> ConstExpr:
+    if value is None:
+        return NilValue.instance
+    if value is True:
+        return TrueValue.instance
+    if value is False:
+        return FalseValue.instance
+    if isinstance(value, str):
+        return String(value)
+    return Number(value)
+
+
+def fold(state: _ProgramState, expr: Expression | MultiresExpression):
+    if isinstance(expr, Expression):
+        return expr.fold(state)
+    return NotImplemented
+
+
 @dataclass
 class BinaryOpExpression(Expression):
-    opcode: str
+    opcode: Opcode
     left: Expression
     right: Expression
 
     def evaluate(self, state: _ProgramState):
+        value = self.fold(state)
+        if value is not NotImplemented:
+            const_expr(value).evaluate(state)
+            return
+
         evaluate_single(state, self.left)
         evaluate_single(state, self.right)
         state.proto.add_opcode(self.opcode)
 
+    def fold(self, state: _ProgramState):
+        left = fold(state, self.left)
+        if left is NotImplemented:
+            return NotImplemented
+        right = fold(state, self.right)
+        if right is NotImplemented:
+            return NotImplemented
+        return fold_binary(self.opcode, left, right)
+
+
+@dataclass
+class LogicalExpression(Expression):
+    # 'and' and 'or' only evaluate the right operand if
+    # the left one does not decide the result.
+    is_or: bool
+    left: Expression
+    right: Expression
+
+    def evaluate(self, state: _ProgramState):
+        value = self.fold(state)
+        if value is not NotImplemented:
+            const_expr(value).evaluate(state)
+            return
+
+        # With a constant on the left, only one of the operands remains.
+        left = fold(state, self.left)
+        if left is not NotImplemented:
+            if _decides(left, self.is_or):
+                const_expr(left).evaluate(state)
+            else:
+                evaluate_single(state, self.right)
+            return
+
+        # The left operand stays on the stack as the result if it decides it.
+        proto = state.proto
+        evaluate_single(state, self.left)
+        proto.add_opcode(Opcode.TEST_SET, int(self.is_or))
+        jump_pc = proto.reserve_opcodes(1)
+        evaluate_single(state, self.right)
+        proto.set_jump(jump_pc)
+
+    def fold(self, state: _ProgramState):
+        left = fold(state, self.left)
+        if left is NotImplemented:
+            return NotImplemented
+        if _decides(left, self.is_or):
+            return left
+        return fold(state, self.right)
+
+
+def _decides(left, is_or: bool) -> bool:
+    # Whether the left operand of 'and'/'or' is also the result.
+    return (left is not None and left is not False) == is_or
+
 
 @dataclass
 class UnaryExpression(Expression):
-    opcode: str
+    opcode: Opcode
+    operand: Expression
 
     def evaluate(self, state: _ProgramState):
+        value = self.fold(state)
+        if value is not NotImplemented:
+            const_expr(value).evaluate(state)
+            return
+        evaluate_single(state, self.operand)
         state.proto.add_opcode(self.opcode)
 
+    def fold(self, state: _ProgramState):
+        operand = fold(state, self.operand)
+        if operand is NotImplemented:
+            return NotImplemented
+        return fold_unary(self.opcode, operand)
+
 
 class Varargs(Ast, MultiresExpression):
     def evaluate(self, state: _ProgramState, return_count: int):
         if not state.proto.is_variadic:
             raise CompilationError("Cannot access varargs from a non-variadic function.")
-        state.proto.add_opcode(f"get_varargs {return_count}")
+        state.proto.add_opcode(Opcode.GET_VARARGS, return_count)
 
 
 class AttribName(Ast):
@@ -517,8 +895,9 @@ class LocalAssignStmt(Ast, Statement):
                         tbc_index = i
                 case "const":  # compile or runtime const
                     if i < len(exprs):  # if there's an expression given for this name
-                        expr = exprs[i]
-                        if isinstance(expr, ConstExpr):
+                        value = fold(state, exprs[i])
+                        if value is not NotImplemented:
+                            exprs[i] = const_expr(value)
                             # noinspection PyTypeChecker
                             compile_time_consts.append(i)
                         else:
@@ -541,21 +920,40 @@ class LocalAssignStmt(Ast, Statement):
 
         # Filter out compile time consts from the expression list.
         exprs: list[Expression] = [x for x in exprs if (x is not None)]
-        adjust_static(state, len(variables), exprs)
+        if variables:
+            adjust_static(state, len(variables), exprs)
+        else:
+            # Only compile time consts: the remaining expressions are
+            # evaluated for their side effects alone.
+            for expr in exprs:
+                if isinstance(expr, MultiresExpression):
+                    expr.evaluate(state, 1)
+                else:
+                    evaluate_single(state, expr)
+                    proto.add_opcode(Opcode.POP)
 
-        # Assign values.
+        # Declare the variables only after evaluating
+        # the expressions, which can't see them yet.
+        indices = []
         for i in variables:
             name = self.attr_names[i].name
             index = proto.get_local_index(name)
-            proto.add_opcode(f"store_local {index}")
+            indices.append(index)
 
             if i in runtime_consts:
                 var = proto.get_local(index)
                 var.is_const = True
 
-        # Mark TBC.
+        # Assign values. The last one is on top of the stack.
+        for index in reversed(indices):
+            proto.add_opcode(Opcode.STORE_LOCAL, index)
+
+        # Mark TBC. Like constants, it cannot be assigned to.
         if tbc_index is not None:
-            proto.add_opcode(f"mark_tbc {tbc_index}")
+            index = indices[variables.index(tbc_index)]
+            proto.get_local(index).is_const = True
+            proto.add_opcode(Opcode.MARK_TBC, index)
+            block.tbc_locals.append(index)
 
 
 @dataclass
@@ -571,6 +969,12 @@ class Var(Ast, Expression):
     def evaluate(self, state: _ProgramState):
         state.read(state, self.name)
 
+    def fold(self, state: _ProgramState):
+        const = state.lookup_const(self.name)
+        if const is None:
+            return NotImplemented
+        return const.fold(state)
+
 
 @dataclass
 class DotAccess(Ast, Expression):
@@ -581,8 +985,8 @@ class DotAccess(Ast, Expression):
         proto = state.proto
         evaluate_single(state, self.expression)
         index = proto.get_const_index(self.name)
-        proto.add_opcode(f"push_const {index}")
-        proto.add_opcode("get_table")
+        proto.add_opcode(Opcode.PUSH_CONST, index)
+        proto.add_opcode(Opcode.GET_TABLE)
 
 
 @dataclass
@@ -594,7 +998,7 @@ class TableAccess(Ast, Expression):
         proto = state.proto
         evaluate_single(state, self.table)
         evaluate_single(state, self.key)
-        proto.add_opcode("get_table")
+        proto.add_opcode(Opcode.GET_TABLE)
 
 
 VarType: TypeAlias = Var | DotAccess | TableAccess
@@ -608,6 +1012,23 @@ class AssignStmt(Ast, Statement):
     def emit(self, state: _ProgramState):
         proto = state.proto
 
+        var = self.var_list[0]
+        if len(self.var_list) == 1 and not isinstance(var, Var):
+            # A single field assignment. The order of evaluation is
+            # undefined in Lua, so the table and the key are evaluated
+            # after the value and do not need to be cached.
+            adjust_static(state, 1, self.expr_list)
+            if isinstance(var, DotAccess):
+                evaluate_single(state, var.expression)
+                proto.add_opcode(Opcode.PUSH_CONST, proto.get_const_index(var.name))
+            elif isinstance(var, TableAccess):
+                evaluate_single(state, var.table)
+                evaluate_single(state, var.key)
+            else:
+                raise InternalCompilerError("Illegal assignment.")
+            proto.add_opcode(Opcode.SET_TABLE)
+            return
+
         # Cache variables used in dot/table accesses to
         # ensure the assignment does not affect them.
         temp_indices = []
@@ -620,17 +1041,17 @@ class AssignStmt(Ast, Statement):
                 index = proto.new_temporary()
                 temp_indices.append(index)
                 evaluate_single(state, var.expression)
-                proto.add_opcode(f"store_local {index}")
+                proto.add_opcode(Opcode.STORE_LOCAL, index)
             elif isinstance(var, TableAccess):
                 table_index = proto.new_temporary()
                 evaluate_single(state, var.table)
-                proto.add_opcode(f"store_local {table_index}")
+                proto.add_opcode(Opcode.STORE_LOCAL, table_index)
                 temp_indices.append(table_index)
 
                 if not isinstance(var.key, ConstExpr):
                     key_index = proto.new_temporary()
                     evaluate_single(state, var.key)
-                    proto.add_opcode(f"store_local {key_index}")
+                    proto.add_opcode(Opcode.STORE_LOCAL, key_index)
                     temp_indices.append(key_index)
 
             else:
@@ -648,21 +1069,23 @@ class AssignStmt(Ast, Statement):
                 temp_index -= 1
 
                 const_index: int = proto.get_const_index(var.name)
-                proto.add_opcode(f"load_local {local_index}")
-                proto.add_opcode(f"push_const {const_index}")
-                proto.add_opcode("set_table")
+                proto.add_opcode(Opcode.LOAD_LOCAL, local_index)
+                proto.add_opcode(Opcode.PUSH_CONST, const_index)
+                proto.add_opcode(Opcode.SET_TABLE)
             elif isinstance(var, TableAccess):
-                if isinstance(var.key, ConstExpr):
-                    evaluate_single(state, var.key)
-                else:
+                key_index = None
+                if not isinstance(var.key, ConstExpr):
                     key_index = temp_indices[temp_index]
                     temp_index -= 1
-                    proto.add_opcode(f"load_local {key_index}")
 
                 table_index = temp_indices[temp_index]
                 temp_index -= 1
-                proto.add_opcode(f"load_local {table_index}")
-                proto.add_opcode("set_table")
+                proto.add_opcode(Opcode.LOAD_LOCAL, table_index)
+                if key_index is None:
+                    evaluate_single(state, var.key)
+                else:
+                    proto.add_opcode(Opcode.LOAD_LOCAL, key_index)
+                proto.add_opcode(Opcode.SET_TABLE)
 
         for index in temp_indices:
             proto.release_local(index)
@@ -672,16 +1095,23 @@ class AssignStmt(Ast, Statement):
 class Block(Ast, AsList, Statement):
     statements: list[Statement]
 
-    def emit(self, state: _ProgramState):
+    def emit(self, state: _ProgramState, ends_scope: bool = True):
+        # The locals of a repeat-until body are still in scope in its condition.
         for statement in self.statements:
-            if isinstance(statement, Block):
-                state.push_block()
-                statement.emit(state)
-                state.pop_block()
-            elif isinstance(statement, FuncCall):
-                statement.evaluate(state, 1)
-            else:
-                statement.emit(state)
+            emit_statement(state, statement)
+        if ends_scope:
+            state.proto.end_statements()
+
+
+def emit_statement(state: _ProgramState, statement: Statement):
+    if isinstance(statement, Block):
+        state.push_block()
+        statement.emit(state)
+        state.pop_block()
+    elif isinstance(statement, FuncCall):
+        statement.evaluate(state, 1)
+    else:
+        statement.emit(state)
 
 
 @dataclass
@@ -741,37 +1171,59 @@ class FuncDef(Ast, Expression):
             my_number = state.next_lambda_index()
             self.name = f"$lambda#{my_number}"
 
-        proto, proto_index = state.push_proto(self.name)
-        block = state.push_block()
+        proto_index = None
+        fingerprint = None
+        if state.cache is not None:
+            fingerprint = state.fingerprint(self.body)
+            proto_index = state.reuse(fingerprint, self.name)
+        if proto_index is None:
+            proto_index = self._emit(state, fingerprint)
 
+        if state.proto:
+            state.proto.add_opcode(Opcode.CLOSURE, proto_index)
+
+    def _emit(self, state: _ProgramState, fingerprint: bytes | None) -> int:
+        proto, proto_index = self.begin(state)
         body = self.body.block
+        body.emit(state)
+        self.end(state, proto_index, body.statements[-1] if body.statements else None, fingerprint)
+        return proto_index
+
+    def begin(self, state: _ProgramState) -> tuple[_ProtoState, int]:
+        proto, proto_index = state.push_proto(self.name)
+        state.push_block()
+
         params = self.body.params
 
         if params:
             proto.fixed_params = len(params.names)
             proto.is_variadic = params.has_varargs
 
-            for name in params.names:
-                local_index = proto.get_local_index(name)
-                proto.add_opcode(f"store_local {local_index}")
+            # Arguments are on the stack, with the last one on top.
+            indices = [proto.get_local_index(name) for name in params.names]
+            for local_index in reversed(indices):
+                proto.add_opcode(Opcode.STORE_LOCAL, local_index)
+        return proto, proto_index
 
-        body.emit(state)
-        if not body.statements or not isinstance(body.statements[-1], ReturnStmt):
-            proto.add_opcode("return 1")
-
-        # Close all goto's
-        # TODO: review
-        for pc, data in block.gotos.items():
-            name, locals_count = data
-            if proto.num_locals != locals_count:
-                raise CompilationError("Cannot jump into a scope of a local variable.")
-            target = proto.get_label_target(name)
-            proto.set_jump(pc, target)
+    def end(
+            self,
+            state: _ProgramState,
+            proto_index: int,
+            last_statement: Statement | None,
+            fingerprint: bytes | None = None,
+    ):
+        # Called when the whole body has been emitted.
+        proto = state.proto
+        proto.end_statements()
+        if not isinstance(last_statement, ReturnStmt):
+            proto.add_opcode(Opcode.RETURN, 1)
 
         state.pop_block()
+        if proto.reserved:
+            raise InternalCompilerError(f"Reserved opcodes were never set at {sorted(proto.reserved)}.")
+        if fingerprint is not None:
+            state.record(proto, proto_index, fingerprint)
         state.pop_proto()
-        if state.proto:
-            state.proto.add_opcode(f"closure {proto_index}")
 
 
 @dataclass
@@ -801,9 +1253,18 @@ class LocalFuncDefStmt(Ast, Statement):
     body: FuncBody
 
     def emit(self, state: _ProgramState):
-        func_def = FuncDef(self.body, self.name)
-        assign_stmt = LocalAssignStmt([AttribName(self.name)], [func_def])
-        assign_stmt.emit(state)
+        # Unlike 'local f = function', the name is declared before
+        # the body, so that the function can call itself.
+        proto = state.proto
+        index = proto.get_local_index(self.name)
+        FuncDef(self.body, self.name).evaluate(state)
+        proto.add_opcode(Opcode.STORE_LOCAL, index)
+
+
+def _in_tbc_scope(proto: _ProtoState) -> bool:
+    # To-be-closed variables are closed after the call returns,
+    # so a return in their scope is never a tail call.
+    return any(block.tbc_locals for block in proto.block_stack)
 
 
 class ReturnStmt(Ast, Statement):
@@ -811,21 +1272,26 @@ class ReturnStmt(Ast, Statement):
         self.exprs: list[Expression] | None = exprs
 
     def emit(self, state: _ProgramState):
-        exprs = self.exprs[::-1] if self.exprs else []
+        exprs = self.exprs or []
         if exprs:
             for i in range(len(exprs) - 1):
                 expr = exprs[i]
                 evaluate_single(state, expr)
 
             last = exprs[-1]
-            if isinstance(last, MultiresExpression):
+            if len(exprs) == 1 and isinstance(last, FuncCall) and not _in_tbc_scope(state.proto):
+                # A tail call: the called function takes over the frame. The
+                # return passes the results on if it cannot, e.g. for builtins.
+                last.evaluate(state, 0, tail=True)
+                state.proto.add_opcode(Opcode.RETURN, 0)
+            elif isinstance(last, MultiresExpression):
                 last.evaluate(state, 0)
-                state.proto.add_opcode("return 0")
+                state.proto.add_opcode(Opcode.RETURN, -(len(exprs) - 1))
             else:
                 evaluate_single(state, last)
-                state.proto.add_opcode(f"return {1 + len(exprs)}")
+                state.proto.add_opcode(Opcode.RETURN, 1 + len(exprs))
         else:
-            state.proto.add_opcode("return 1")
+            state.proto.add_opcode(Opcode.RETURN, 1)
 
 
 @dataclass
@@ -849,34 +1315,41 @@ class TableConstructor(Ast, AsList, Expression):
 
     def evaluate(self, state: _ProgramState):
         proto = state.proto
-        proto.add_opcode("create_table")
+        proto.add_opcode(Opcode.CREATE_TABLE)
         table_local = proto.new_temporary()
-        proto.add_opcode(f"store_local {table_local}")
+        proto.add_opcode(Opcode.STORE_LOCAL, table_local)
 
         if self.fields:
+            list_index = 1  # index of the next positional field
             for i, field in enumerate(self.fields):
                 if isinstance(field, ExprField):
                     evaluate_single(state, field.value)
-                    proto.add_opcode(f"load_local {table_local}")
+                    proto.add_opcode(Opcode.LOAD_LOCAL, table_local)
                     evaluate_single(state, field.key)
-                    proto.add_opcode("set_table")
+                    proto.add_opcode(Opcode.SET_TABLE)
                 elif isinstance(field, NameField):
                     evaluate_single(state, field.value)
-                    proto.add_opcode(f"load_local {table_local}")
+                    proto.add_opcode(Opcode.LOAD_LOCAL, table_local)
                     const_index = proto.get_const_index(field.name)
-                    proto.add_opcode(f"push_const {const_index}")
+                    proto.add_opcode(Opcode.PUSH_CONST, const_index)
+                    proto.add_opcode(Opcode.SET_TABLE)
                 elif isinstance(field, MultiresExpression):
                     size = 0 if i == len(self.fields) - 1 else 2
                     field.evaluate(state, size)
-                    proto.add_opcode(f"load_local {table_local}")
+                    proto.add_opcode(Opcode.LOAD_LOCAL, table_local)
                     if size > 0:
-                        proto.add_opcode("store_list 1")
+                        proto.add_opcode(Opcode.STORE_LIST, 1, list_index)
                     else:
-                        proto.add_opcode("store_list 0")
+                        proto.add_opcode(Opcode.STORE_LIST, 0, list_index)
+                    list_index += 1
                 elif isinstance(field, Expression):
                     evaluate_single(state, field)
-                    proto.add_opcode(f"load_local {table_local}")
-                    proto.add_opcode("store_list 1")
+                    proto.add_opcode(Opcode.LOAD_LOCAL, table_local)
+                    proto.add_opcode(Opcode.STORE_LIST, 1, list_index)
+                    list_index += 1
+
+        proto.add_opcode(Opcode.LOAD_LOCAL, table_local)
+        proto.release_local(table_local)
 
 
 class FuncCallParams(Ast):
@@ -900,15 +1373,20 @@ class FuncCall(Ast, MultiresExpression):
         self.primary = primary
         self.params = params
 
-    def evaluate(self, state: _ProgramState, return_count: int = 1):
+    def evaluate(self, state: _ProgramState, return_count: int = 1, tail: bool = False):
         proto = state.proto
         param_count = self._eval_params(state)
         evaluate_single(state, self.primary)
-        proto.add_opcode(f"call {param_count} {return_count}")
+        if tail:
+            proto.add_opcode(Opcode.TAIL_CALL, param_count)
+        else:
+            proto.add_opcode(Opcode.CALL, param_count, return_count)
 
-    def _eval_params(self, state):
+    def _eval_params(self, state, fixed: int = 0) -> int:
+        # Returns the parameter count operand of 'call'. The 'fixed'
+        # parameters have already been pushed by the caller.
         exprs = self.params.exprs
-        param_count: int = 1 + len(exprs)
+        param_count: int = 1 + fixed + len(exprs)
         if exprs:
             for i in range(len(exprs) - 1):
                 expr = exprs[i]
@@ -917,7 +1395,7 @@ class FuncCall(Ast, MultiresExpression):
             last = exprs[-1]
             if isinstance(last, MultiresExpression):
                 last.evaluate(state, 0)
-                param_count = 0
+                param_count = -(fixed + len(exprs) - 1)
             else:
                 evaluate_single(state, last)
         return param_count
@@ -928,17 +1406,22 @@ class MethodCall(FuncCall):
         super().__init__(primary, params)
         self.name = name
 
-    def evaluate(self, state: _ProgramState, return_count: int = 1):
+    def evaluate(self, state: _ProgramState, return_count: int = 1, tail: bool = False):
         proto = state.proto
 
         evaluate_single(state, self.primary)
         self_index = proto.new_temporary()
-        proto.add_opcode(f"store_local {self_index}")
-
-        proto.add_opcode(f"load_local {self_index}")
-        param_count = self._eval_params(state)
-        evaluate_single(state, self.primary)
-        proto.add_opcode(f"call {param_count} {return_count}")
+        proto.add_opcode(Opcode.STORE_LOCAL, self_index)
+
+        proto.add_opcode(Opcode.LOAD_LOCAL, self_index)
+        param_count = self._eval_params(state, 1)
+        proto.add_opcode(Opcode.LOAD_LOCAL, self_index)
+        proto.add_opcode(Opcode.PUSH_CONST, proto.get_const_index(self.name))
+        proto.add_opcode(Opcode.GET_TABLE)
+        if tail:
+            proto.add_opcode(Opcode.TAIL_CALL, param_count)
+        else:
+            proto.add_opcode(Opcode.CALL, param_count, return_count)
 
         proto.release_local(self_index)
 
@@ -950,6 +1433,9 @@ class Primary(Ast, Expression):
     def evaluate(self, state: _ProgramState):
         evaluate_single(state, self.child)
 
+    def fold(self, state: _ProgramState):
+        return fold(state, self.child)
+
 
 @dataclass
 class WhileStmt(Ast, Statement):
@@ -961,11 +1447,11 @@ class WhileStmt(Ast, Statement):
 
         start = proto.pc
         evaluate_single(state, self.expr)
-        proto.add_opcode("test")
+        proto.add_opcode(Opcode.TEST)
         jump_pc = proto.reserve_opcodes(1)
 
         state.push_block()
-        proto.breaks.append([])
+        proto.enter_loop()
         self.block.emit(state)
         state.pop_block()
         proto.add_jump(start)
@@ -987,11 +1473,12 @@ class RepeatStmt(Ast, Statement):
 
         state.push_block()
         start = proto.pc
-        proto.breaks.append([])
-        self.block.emit(state)
+        proto.enter_loop()
+        self.block.emit(state, ends_scope=False)
 
         evaluate_single(state, self.expr)
-        proto.add_opcode("test")
+        proto.close_captured(proto.block)
+        proto.add_opcode(Opcode.TEST)
         proto.add_jump(start)
         block_end = state.proto.pc
         state.pop_block()
@@ -1003,6 +1490,11 @@ class RepeatStmt(Ast, Statement):
 
 class BreakStmt(Ast, Statement):
     def emit(self, state: _ProgramState):
+        # Closes the to-be-closed variables of the blocks it leaves.
+        for block in reversed(state.proto.block_stack):
+            state.proto.close_variables(block)
+            if block.is_loop:
+                break
         pc = state.proto.pc
         state.proto.reserve_opcodes(1)
         state.proto.breaks[-1].append(pc)
@@ -1038,7 +1530,7 @@ class IfStmt(Ast, AsList, Statement):
         skip_end_jump = not self.elze and len(self.elseifs) == 0
         self._emit_branch(state, self.condition, self.block, skip_end_jump)
         for i, el in enumerate(self.elseifs):
-            self._emit_branch(state, el.condition, el.block, i == len(self.elseifs) - 1)
+            self._emit_branch(state, el.condition, el.block, not self.elze and i == len(self.elseifs) - 1)
         if self.elze:
             state.push_block()
             self.elze.emit(state)
@@ -1056,7 +1548,7 @@ class IfStmt(Ast, AsList, Statement):
     ):
         proto = state.proto
         evaluate_single(state, condition)
-        proto.add_opcode("test")
+        proto.add_opcode(Opcode.TEST)
         jump_pc = proto.reserve_opcodes(1)
 
         state.push_block()
@@ -1073,17 +1565,20 @@ def emit_for_loop_body(
         state: _ProgramState,
         body: Block,
         loop_start_pc: int,
+        closing_val_index: int,
 ):
     proto = state.proto
     escape_jump_pc = proto.reserve_opcodes(1)
-    proto.breaks.append([])
+    proto.enter_loop()
     body.emit(state)
+    proto.close_captured(proto.block)  # each iteration gets fresh variables
     proto.add_jump(loop_start_pc)
 
     proto.set_jump(escape_jump_pc)
     for br in proto.breaks[-1]:
         proto.set_jump(br)
     proto.breaks.pop()
+    proto.add_opcode(Opcode.CLOSE, closing_val_index)  # however the loop ends
     state.pop_block()
 
 
@@ -1099,9 +1594,12 @@ class ForLoopNum(Ast, Statement):
         proto = state.proto
         state.push_block()
 
+        # The control variable is followed by the iteration count (or the
+        # limit of a float loop), the step and the internal loop index, so
+        # that assigning to the variable does not change the iterations.
         proto.linear_mode = True
         control_index = proto.new_local(self.control_name)
-        for _ in range(2):
+        for _ in range(3):
             proto.new_temporary()
         proto.linear_mode = False
 
@@ -1110,12 +1608,21 @@ class ForLoopNum(Ast, Statement):
         if self.step_expr:
             evaluate_single(state, self.step_expr)
         else:
-            proto.add_opcode("push_int 1")
-        proto.add_opcode(f"prepare_for_num {control_index}")
+            proto.add_opcode(Opcode.PUSH_INT, 1)
+        proto.add_opcode(Opcode.PREPARE_FOR_NUM, control_index)
+        escape_jump_pc = proto.reserve_opcodes(1)
 
-        loop_start_pc = proto.pc
-        proto.add_opcode(f"test_for {control_index}")
-        emit_for_loop_body(state, self.body, loop_start_pc)
+        body_start_pc = proto.pc
+        proto.enter_loop()
+        self.body.emit(state)
+        proto.close_captured(proto.block)  # each iteration gets fresh variables
+        proto.add_opcode(Opcode.FOR_LOOP, control_index, body_start_pc - proto.pc)
+
+        proto.set_jump(escape_jump_pc)
+        for br in proto.breaks[-1]:
+            proto.set_jump(br)
+        proto.breaks.pop()
+        state.pop_block()
 
 
 @dataclass
@@ -1146,23 +1653,23 @@ class ForLoopGen(Ast, AsList, Statement):
             index = proto.get_local_index(name)
             name_indices.append(index)
 
-        proto.add_opcode(f"mark_tbc {closing_val_index}")
         adjust_static(state, 4, self.expr_list)
-        proto.add_opcode(f"prepare_for_gen {iterator_index}")
+        proto.add_opcode(Opcode.PREPARE_FOR_GEN, iterator_index)
+        proto.add_opcode(Opcode.MARK_TBC, closing_val_index)
 
         # TODO: check param and retval orders
         loop_start_pc = proto.pc
-        proto.add_opcode(f"load_local {state_index}")
-        proto.add_opcode(f"load_local {control_index}")
-        proto.add_opcode(f"load_local {iterator_index}")
-        proto.add_opcode(f"call 3 {1 + len(self.name_list)}")
+        proto.add_opcode(Opcode.LOAD_LOCAL, state_index)
+        proto.add_opcode(Opcode.LOAD_LOCAL, control_index)
+        proto.add_opcode(Opcode.LOAD_LOCAL, iterator_index)
+        proto.add_opcode(Opcode.CALL, 3, 1 + len(self.name_list))
 
         for index in reversed(name_indices):
-            proto.add_opcode(f"store_local {index}")
+            proto.add_opcode(Opcode.STORE_LOCAL, index)
 
-        proto.add_opcode(f"load_local {control_index}")
-        proto.add_opcode(f"test_nil")
-        emit_for_loop_body(state, self.body, loop_start_pc)
+        proto.add_opcode(Opcode.LOAD_LOCAL, control_index)
+        proto.add_opcode(Opcode.TEST_NIL)
+        emit_for_loop_body(state, self.body, loop_start_pc, closing_val_index)
 
 
 @dataclass
@@ -1186,16 +1693,42 @@ class GotoStmt(Ast, Statement):
 class Chunk(Ast):
     block: Block
 
-    def emit(self) -> Program:
-        program_state = _ProgramState()
+    def generate(self, cache: FunctionCache | None = None) -> _ProgramState:
+        program_state = _ProgramState(cache)
         func_name = "$main"
         func_body = FuncBody(ParamList([Varargs()]), self.block)
         func_def = FuncDef(func_body, func_name)
         func_def.evaluate(program_state)
         program_state.get_proto(0).get_upvalue_index("_ENV")
+        return program_state
+
+    def emit(self, optimizer: Optimizer | None = None) -> Program:
+        program_state = self.generate()
+        if optimizer is not None:
+            program_state.optimize(optimizer)
         return program_state.compile()
 
 
+class ChunkEmitter:
+    # Emits the main function one statement at a time, for sources
+    # that are compiled while they are still being parsed.
+
+    def __init__(self):
+        self.state = _ProgramState()
+        self._main = FuncDef(FuncBody(ParamList([Varargs()]), Block([])), "$main")
+        self._main.begin(self.state)
+        self._last_statement: Statement | None = None
+
+    def emit(self, statement: Statement):
+        emit_statement(self.state, statement)
+        self._last_statement = statement
+
+    def finish(self) -> _ProgramState:
+        self._main.end(self.state, 0, self._last_statement)
+        self.state.get_proto(0).get_upvalue_index("_ENV")
+        return self.state
+
+
 # noinspection PyPep8Naming
 class LuarkTransformer(Transformer):
     def start(self, children):
@@ -1266,102 +1799,101 @@ class LuarkTransformer(Transformer):
         size = s.find("[", 1) + 1
         return s[size:-size].removeprefix("\n")
 
-    def _bin_num_op_expr(self, c: list, op: str, func: Callable):
-        if (isinstance(c[0], Number)
-                and isinstance(c[1], Number)):
-            return Number(func(c[0].value, c[1].value))
-        else:
-            return BinaryOpExpression(op, *c)
+    def _binary_expr(self, c: list, op: Opcode):
+        # Literals are folded right away. Expressions involving
+        # constant locals are folded during code generation.
+        if isinstance(c[0], ConstExpr) and isinstance(c[1], ConstExpr):
+            value = fold_binary(op, c[0].fold(None), c[1].fold(None))
+            if value is not NotImplemented:
+                return const_expr(value)
+        return BinaryOpExpression(op, *c)
+
+    def _logical_expr(self, c: list, is_or: bool):
+        if isinstance(c[0], ConstExpr):
+            if _decides(c[0].fold(None), is_or):
+                return c[0]
+            # Like the whole expression, the right operand yields a single value.
+            return Primary(c[1]) if isinstance(c[1], MultiresExpression) else c[1]
+        return LogicalExpression(is_or, *c)
+
+    def _unary_expr(self, c: list, op: Opcode):
+        if isinstance(c[0], ConstExpr):
+            value = fold_unary(op, c[0].fold(None))
+            if value is not NotImplemented:
+                return const_expr(value)
+        return UnaryExpression(op, c[0])
 
     def or_expr(self, c):
-        return BinaryOpExpression("or", *c)
+        return self._logical_expr(c, True)
 
     def and_expr(self, c):
-        return BinaryOpExpression("and", *c)
+        return self._logical_expr(c, False)
 
     def comp_lt(self, c):
-        return BinaryOpExpression("lt", *c)
+        return self._binary_expr(c, Opcode.LT)
 
     def comp_gt(self, c):
-        return BinaryOpExpression("gt", *c)
+        return self._binary_expr(c, Opcode.GT)
 
     def comp_le(self, c):
-        return BinaryOpExpression("le", *c)
+        return self._binary_expr(c, Opcode.LE)
 
     def comp_ge(self, c):
-        return BinaryOpExpression("ge", *c)
+        return self._binary_expr(c, Opcode.GE)
 
     def comp_eq(self, c):
-        return BinaryOpExpression("eq", *c)
+        return self._binary_expr(c, Opcode.EQ)
 
     def comp_neq(self, c):
-        return BinaryOpExpression("neq", *c)
+        return self._binary_expr(c, Opcode.NEQ)
 
     def bw_or_expr(self, c):
-        return BinaryOpExpression("bor", *c)
+        return self._binary_expr(c, Opcode.BOR)
 
     def bw_xor_expr(self, c):
-        return BinaryOpExpression("bxor", *c)
+        return self._binary_expr(c, Opcode.BXOR)
 
     def bw_and_expr(self, c):
-        return BinaryOpExpression("band", *c)
+        return self._binary_expr(c, Opcode.BAND)
 
     def lsh_expr(self, c):
-        return BinaryOpExpression("lsh", *c)
+        return self._binary_expr(c, Opcode.LSH)
 
     def rsh_expr(self, c):
-        return BinaryOpExpression("rsh", *c)
+        return self._binary_expr(c, Opcode.RSH)
 
     def concat_expr(self, c):
-        if (isinstance(c[0], String)
-                and isinstance(c[1], String)):
-            return String(c[0].value + c[1].value)
-        else:
-            return BinaryOpExpression("concat", *c)
+        return self._binary_expr(c, Opcode.CONCAT)
 
     def add_expr(self, c):
-        return self._bin_num_op_expr(c, "add", lambda x, y: x + y)
+        return self._binary_expr(c, Opcode.ADD)
 
     def sub_expr(self, c):
-        return self._bin_num_op_expr(c, "sub", lambda x, y: x - y)
+        return self._binary_expr(c, Opcode.SUB)
 
     def mul_expr(self, c):
-        return self._bin_num_op_expr(c, "mul", lambda x, y: x * y)
-
-    def _divide(self, x: int | float, y: int | float):  # TODO: review
-        if y != 0:
-            return x / y
-        else:
-            if x > 0:
-                return float("inf")
-            elif x == 0:
-                return float("nan")
-            else:
-                return float("-inf")
+        return self._binary_expr(c, Opcode.MUL)
 
     def div_expr(self, c):
-        return self._bin_num_op_expr(c, "div", self._divide)
+        return self._binary_expr(c, Opcode.DIV)
 
     def fdiv_expr(self, c):
-        return self._bin_num_op_expr(c, "fdiv", lambda x, y: math.floor(self._divide(x, y)))
+        return self._binary_expr(c, Opcode.FDIV)
 
     def mod_expr(self, c):
-        return self._bin_num_op_expr(c, "mod", lambda x, y: x % y)
+        return self._binary_expr(c, Opcode.MOD)
 
     def unary_minus(self, c):
-        if isinstance(c[0], Number):
-            return Number(-c[0].value)
-        else:
-            return UnaryExpression("negate")
+        return self._unary_expr(c, Opcode.NEGATE)
 
-    def unary_not(self, _):
-        return UnaryExpression("not")
+    def unary_not(self, c):
+        return self._unary_expr(c, Opcode.NOT)
 
-    def unary_length(self, _):
-        return UnaryExpression("len")
+    def unary_length(self, c):
+        return self._unary_expr(c, Opcode.LEN)
 
-    def unary_bw_not(self, _):
-        return UnaryExpression("bnot")
+    def unary_bw_not(self, c):
+        return self._unary_expr(c, Opcode.BNOT)
 
     def exp_expr(self, c):
-        return self._bin_num_op_expr(c, "exp", lambda x, y: x ** y)
+        return self._binary_expr(c, Opcode.EXP)
@@ -0,0 +1,65 @@
+import sys
+from collections import Counter
+from pathlib import Path
+
+from luark.compiler.compiler import Compiler
+from luark.compiler.optimizer import Optimizer
+from luark.compiler.program import Program
+
+# Frequencies of opcode sequences in compiled code. The superinstructions
+# were picked from this report; to reproduce it for a corpus, run:
+#
+#   python -m luark.compiler.ngrams [-O<level>] <file or directory>...
+#
+# The code is compiled without superinstructions, so the report shows
+# the sequences they would replace.
+
+
+def count_ngrams(programs: list[Program], n: int) -> Counter[tuple[str, ...]]:
+    counts = Counter()
+    for program in programs:
+        for proto in program.prototypes:
+            mnemonics = [proto.decode(pc)[0].mnemonic for pc in range(len(proto))]
+            counts.update(zip(*(mnemonics[i:] for i in range(n))))
+    return counts
+
+
+def report(programs: list[Program], max_n: int = 3, top: int = 20) -> str:
+    total = sum(len(proto) for program in programs for proto in program.prototypes)
+    out = [f"{len(programs)} programs, {total} instructions"]
+    for n in range(1, max_n + 1):
+        out.append("")
+        out.append(f"{n}-grams:")
+        for sequence, count in count_ngrams(programs, n).most_common(top):
+            share = count / total * 100 if total else 0.0
+            out.append(f"{count:>8} {share:5.1f}%  {' '.join(sequence)}")
+    return "\n".join(out)
+
+
+def _collect(paths: list[str]) -> list[Path]:
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(path.rglob("*.lua")))
+        else:
+            files.append(path)
+    return files
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    level = 1
+    if args and args[0].startswith("-O"):
+        level = int(args.pop(0)[2:])
+
+    compiler = Compiler()
+    compiler.optimizer = Optimizer(level, superinstructions=False)
+    compiled = []
+    # Worker processes would use their own optimizer, so compile in this one.
+    files = _collect(args)
+    for file, result in zip(files, compiler.compile_many(files, workers=1)):
+        if isinstance(result, Program):
+            compiled.append(result)
+        else:
+            print(f"skipped {file}: {type(result).__name__}", file=sys.stderr)
+    print(report(compiled))
@@ -0,0 +1,387 @@
+from typing import Callable, TypeAlias
+
+from luark.compiler.program import Opcode, LocalVarIndex, INSTRUCTION_SIZE, new_code
+
+# Peephole optimizations performed on the emitted bytecode of each function
+# before it is compiled into a prototype. Passes work on a list of decoded
+# instructions where jump operands are absolute targets, so removing an
+# instruction only requires remapping the targets afterwards.
+
+MAX_LEVEL = 2
+MAX_ITERATIONS = 64
+
+# Instructions which may skip the instruction right after them. Nothing
+# may be inserted or removed inside those windows.
+_SKIPS_ONE = (Opcode.TEST, Opcode.TEST_NIL, Opcode.TEST_SET, Opcode.PREPARE_FOR_NUM)
+
+_TRUTHY_PUSHES = (Opcode.PUSH_TRUE, Opcode.PUSH_INT, Opcode.PUSH_FLOAT, Opcode.PUSH_CONST)
+_FALSY_PUSHES = (Opcode.PUSH_FALSE, Opcode.PUSH_NIL)
+
+
+class Code:
+    def __init__(self, instructions: list[list]):
+        self.instructions = instructions  # [opcode, a, b], mutable
+        self._removed: set[int] = set()
+        self._targets: set[int] | None = None
+
+    @classmethod
+    def decode(cls, opcodes) -> "Code":
+        instructions = []
+        for pc in range(len(opcodes) // INSTRUCTION_SIZE):
+            offset = pc * INSTRUCTION_SIZE
+            opcode, a, b = Opcode(opcodes[offset]), opcodes[offset + 1], opcodes[offset + 2]
+            if opcode == Opcode.JUMP:
+                a += pc
+            elif opcode == Opcode.FOR_LOOP:
+                b += pc
+            instructions.append([opcode, a, b])
+        return cls(instructions)
+
+    def encode(self):
+        code = new_code()
+        for pc, (opcode, a, b) in enumerate(self.instructions):
+            if opcode == Opcode.JUMP:
+                a -= pc
+            elif opcode == Opcode.FOR_LOOP:
+                b -= pc
+            code.extend((opcode, a, b))
+        return code
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def __getitem__(self, pc: int) -> list:
+        return self.instructions[pc]
+
+    def opcode(self, pc: int) -> Opcode | None:
+        if 0 <= pc < len(self.instructions):
+            return self.instructions[pc][0]
+        return None
+
+    def jump_targets(self) -> set[int]:
+        # Kept until the code changes, see 'changed'.
+        targets = self._targets
+        if targets is None:
+            targets = self._targets = set()
+            for opcode, a, b in self.instructions:
+                if opcode == Opcode.JUMP:
+                    targets.add(a)
+                elif opcode == Opcode.FOR_LOOP:
+                    targets.add(b)
+        return targets
+
+    def changed(self):
+        self._targets = None
+
+    def is_pinned(self, pc: int) -> bool:
+        # The instruction lies in the window of an instruction that
+        # skips over it, so it must stay where it is.
+        return self.opcode(pc - 1) in _SKIPS_ONE
+
+    def successors(self, pc: int) -> tuple[int, ...]:
+        opcode, a, b = self.instructions[pc]
+        if opcode == Opcode.JUMP:
+            return (a,)
+        if opcode == Opcode.RETURN:
+            return ()
+        if opcode in _SKIPS_ONE:
+            return pc + 1, pc + 2
+        if opcode == Opcode.FOR_LOOP:
+            return pc + 1, b
+        return (pc + 1,)
+
+    def remove(self, pc: int):
+        self._removed.add(pc)
+
+    def compact(self) -> list[int] | None:
+        # Drops the removed instructions and returns the mapping from old
+        # to new positions. A removed instruction maps to the position
+        # of the next instruction that is kept.
+        if not self._removed:
+            return None
+        mapping = []
+        kept = []
+        for pc, instruction in enumerate(self.instructions):
+            mapping.append(len(kept))
+            if pc not in self._removed:
+                kept.append(instruction)
+        mapping.append(len(kept))  # jumps to the very end of the function
+
+        for instruction in kept:
+            if instruction[0] == Opcode.JUMP:
+                instruction[1] = mapping[instruction[1]]
+            elif instruction[0] == Opcode.FOR_LOOP:
+                instruction[2] = mapping[instruction[2]]
+        self.instructions = kept
+        self._removed.clear()
+        self._targets = None
+        return mapping
+
+
+Pass: TypeAlias = Callable[[Code], bool]
+
+
+def thread_jumps(code: Code) -> bool:
+    # A jump to another jump can go straight to the final target.
+    changed = False
+    for instruction in code.instructions:
+        if instruction[0] != Opcode.JUMP:
+            continue
+        target = instruction[1]
+        seen = set()
+        while code.opcode(target) == Opcode.JUMP and target not in seen:
+            seen.add(target)
+            target = code[target][1]
+        if target != instruction[1]:
+            instruction[1] = target
+            changed = True
+    return changed
+
+
+def fold_constant_tests(code: Code) -> bool:
+    # 'push_true; test' always skips the next instruction,
+    # while 'push_false; test' never does.
+    changed = False
+    instructions = code.instructions
+    for pc in range(len(instructions) - 2):
+        if instructions[pc + 1][0] != Opcode.TEST or pc + 1 in code.jump_targets():
+            continue
+        opcode = instructions[pc][0]
+        if opcode in _TRUTHY_PUSHES:
+            instructions[pc][:] = [Opcode.JUMP, pc + 3, 0]
+            code.remove(pc + 1)
+            changed = True
+        elif opcode in _FALSY_PUSHES and not code.is_pinned(pc):
+            code.remove(pc)
+            code.remove(pc + 1)
+            changed = True
+    return changed
+
+
+def remove_jumps_to_next(code: Code) -> bool:
+    changed = False
+    for pc, (opcode, a, _) in enumerate(code.instructions):
+        if opcode == Opcode.JUMP and a == pc + 1 and not code.is_pinned(pc):
+            code.remove(pc)
+            changed = True
+    return changed
+
+
+def remove_unreachable(code: Code) -> bool:
+    # Also takes care of consecutive returns and of the
+    # code after a 'break' or an unconditional jump.
+    if not code.instructions:
+        return False
+    size = len(code)
+    reachable = set()
+    pending = [0]
+    while pending:
+        pc = pending.pop()
+        if pc in reachable or pc >= size:
+            continue
+        reachable.add(pc)
+        pending.extend(code.successors(pc))
+    if len(reachable) == size:
+        return False
+
+    changed = False
+    for pc in range(size):
+        if pc not in reachable and not code.is_pinned(pc):
+            code.remove(pc)
+            changed = True
+    return changed
+
+
+def jumps_to_returns(code: Code) -> bool:
+    # A jump to a return might as well return itself.
+    changed = False
+    for instruction in code.instructions:
+        if instruction[0] == Opcode.JUMP and code.opcode(instruction[1]) == Opcode.RETURN:
+            instruction[:] = code[instruction[1]]
+            changed = True
+    return changed
+
+
+def remove_popped_pushes(code: Code) -> bool:
+    # Values which are pushed only to be popped right away.
+    changed = False
+    instructions = code.instructions
+    for pc in range(len(instructions) - 1):
+        if instructions[pc + 1][0] != Opcode.POP:
+            continue
+        opcode = instructions[pc][0]
+        if (
+                (opcode in _TRUTHY_PUSHES or opcode in _FALSY_PUSHES or opcode == Opcode.LOAD_LOCAL)
+                and pc + 1 not in code.jump_targets()
+                and not code.is_pinned(pc)
+        ):
+            code.remove(pc)
+            code.remove(pc + 1)
+            changed = True
+    return changed
+
+
+def remove_redundant_moves(code: Code) -> bool:
+    # 'load_local x; store_local x' is left behind when a temporary
+    # and the variable it is assigned to share the same slot.
+    changed = False
+    instructions = code.instructions
+    for pc in range(len(instructions) - 1):
+        opcode, a, _ = instructions[pc]
+        following = instructions[pc + 1]
+        if (
+                opcode == Opcode.LOAD_LOCAL
+                and following[0] == Opcode.STORE_LOCAL
+                and following[1] == a
+                and pc + 1 not in code.jump_targets()
+                and not code.is_pinned(pc)
+        ):
+            code.remove(pc)
+            code.remove(pc + 1)
+            changed = True
+    return changed
+
+
+def _match_superinstruction(code: Code, pc: int, targets: set[int]) -> tuple[list, int] | None:
+    # Returns the fused instruction starting at the given position
+    # and the number of instructions it replaces.
+    def window(size: int) -> list[Opcode] | None:
+        # Jumps may only land on the first instruction of a sequence.
+        if pc + size > len(code) or any(pc + i in targets for i in range(1, size)):
+            return None
+        return [code[pc + i][0] for i in range(size)]
+
+    opcode, a, b = code[pc]
+    if opcode == Opcode.LOAD_LOCAL:
+        opcodes = window(3)
+        if opcodes == [Opcode.LOAD_LOCAL, Opcode.PUSH_CONST, Opcode.SET_TABLE]:
+            return [Opcode.SET_FIELD_LOCAL, a, code[pc + 1][1]], 3
+        if opcodes == [Opcode.LOAD_LOCAL, Opcode.PUSH_INT, Opcode.ADD]:
+            return [Opcode.LOAD_LOCAL_CONST_ADD, a, code[pc + 1][1]], 3
+        if opcodes == [Opcode.LOAD_LOCAL, Opcode.PUSH_INT, Opcode.SUB]:
+            return [Opcode.LOAD_LOCAL_CONST_SUB, a, code[pc + 1][1]], 3
+
+        opcodes = window(2)
+        if opcodes == [Opcode.LOAD_LOCAL, Opcode.STORE_LIST] and code[pc + 1][1] == 1:
+            return [Opcode.STORE_LIST_LOCAL, a, code[pc + 1][2]], 2
+        if opcodes == [Opcode.LOAD_LOCAL, Opcode.LOAD_LOCAL]:
+            # Leave the second load to a longer sequence starting with it.
+            following = _match_superinstruction(code, pc + 1, targets)
+            if following is None or following[1] <= 2:
+                return [Opcode.LOAD_LOCALS, a, code[pc + 1][1]], 2
+    elif opcode in (Opcode.GET_UPVALUE, Opcode.LOAD_UPVALUE):
+        if window(3) == [opcode, Opcode.PUSH_CONST, Opcode.GET_TABLE]:
+            return [Opcode.GET_UPVALUE_FIELD, a, code[pc + 1][1]], 3
+    elif opcode == Opcode.PUSH_CONST:
+        opcodes = window(2)
+        if opcodes == [Opcode.PUSH_CONST, Opcode.GET_TABLE]:
+            return [Opcode.GET_FIELD, a, 0], 2
+        if opcodes == [Opcode.PUSH_CONST, Opcode.SET_TABLE]:
+            return [Opcode.SET_FIELD, a, 0], 2
+    return None
+
+
+# Opcodes which superinstructions start with.
+_FUSION_STARTS = (Opcode.LOAD_LOCAL, Opcode.GET_UPVALUE, Opcode.LOAD_UPVALUE, Opcode.PUSH_CONST)
+
+
+def fuse_superinstructions(code: Code) -> bool:
+    changed = False
+    targets = code.jump_targets()
+    instructions = code.instructions
+    size = len(instructions)
+    pc = 0
+    while pc < size:
+        if instructions[pc][0] not in _FUSION_STARTS or code.is_pinned(pc):
+            pc += 1
+            continue
+        fused = _match_superinstruction(code, pc, targets)
+        if fused is None:
+            pc += 1
+            continue
+        instruction, count = fused
+        instructions[pc][:] = instruction
+        for i in range(pc + 1, pc + count):
+            code.remove(i)
+        changed = True
+        pc += count
+    return changed
+
+
+# Passes which run once, after the others are done. Fusing instructions
+# does not make way for any other optimization.
+_FINAL_PASSES = (fuse_superinstructions,)
+
+# Passes run at each optimization level, in order.
+PIPELINES: dict[int, list[Pass]] = {
+    0: [],
+    1: [
+        thread_jumps,
+        fold_constant_tests,
+        remove_jumps_to_next,
+        remove_unreachable,
+        remove_redundant_moves,
+        fuse_superinstructions,
+    ],
+    2: [
+        thread_jumps,
+        jumps_to_returns,
+        fold_constant_tests,
+        remove_popped_pushes,
+        remove_jumps_to_next,
+        remove_unreachable,
+        remove_redundant_moves,
+        fuse_superinstructions,
+    ],
+}
+
+
+class Optimizer:
+    def __init__(self, level: int = 1, passes: list[Pass] | None = None, superinstructions: bool = True):
+        if not 0 <= level <= MAX_LEVEL:
+            raise ValueError(f"Optimization level must be between 0 and {MAX_LEVEL}, got {level}.")
+        self.level = level
+        if passes is None:
+            passes = [p for p in PIPELINES[level] if superinstructions or p is not fuse_superinstructions]
+        self.passes = passes
+
+    def optimize(self, opcodes, locals_: LocalVarIndex | None = None):
+        # Runs the passes in turn until none of them has changed anything
+        # since the last change, then the final ones once. Returns the new
+        # code array, or None if nothing could be optimized.
+        if not self.passes:
+            return None
+        code = Code.decode(opcodes)
+        mappings = []
+        passes = [p for p in self.passes if p not in _FINAL_PASSES]
+        unchanged = 0  # passes run since the last change
+        for i in range(MAX_ITERATIONS * len(passes)):
+            if unchanged == len(passes):
+                break
+            if self._run(passes[i % len(passes)], code, mappings):
+                unchanged = 0
+            else:
+                unchanged += 1
+        for optimization in self.passes:
+            if optimization in _FINAL_PASSES:
+                self._run(optimization, code, mappings)
+        if not mappings and code.encode() == opcodes:
+            return None
+
+        if locals_ is not None:
+            for var in locals_:
+                for mapping in mappings:
+                    var.start = mapping[var.start] if var.start < len(mapping) else mapping[-1]
+                    if var.end is not None:
+                        var.end = max(mapping[min(var.end + 1, len(mapping) - 1)] - 1, var.start)
+        return code.encode()
+
+    @staticmethod
+    def _run(optimization: Pass, code: Code, mappings: list[list[int]]) -> bool:
+        changed = optimization(code)
+        if changed:
+            code.changed()
+        mapping = code.compact()
+        if mapping is not None:
+            mappings.append(mapping)
+        return changed
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import sys
+import threading
+from os import PathLike
+from pathlib import Path
+
+import lark
+from lark import Lark, Transformer, ast_utils
+
+import luark.compiler.luark_ast
+from luark.compiler.luark_ast import LuarkTransformer
+
+GRAMMAR_PATH = Path(__file__).parent / "grammar.lark"
+
+# Serialized parser tables shipped alongside the grammar. They are
+# generated by running `python -m luark.compiler.parser`, and rebuilt on
+# first use if they are missing or do not match the grammar.
+PARSER_TABLES_PATH = Path(__file__).parent / "grammar.lark.bin"
+
+_TABLES_MAGIC = b"LUARKP\0"
+_LARK_OPTIONS = {"parser": "lalr", "propagate_positions": True}
+
+_lock = threading.Lock()
+_shared_parser: Lark | None = None
+_shared_transformer: Transformer | None = None
+
+
+def _read_grammar() -> str:
+    with open(GRAMMAR_PATH) as file:
+        return file.read()
+
+
+def _tables_fingerprint(grammar: str) -> bytes:
+    # Tables are only valid for the grammar and Lark version they were built with.
+    digest = hashlib.sha256()
+    digest.update(grammar.encode())
+    digest.update(lark.__version__.encode())
+    digest.update(repr(sorted(_LARK_OPTIONS.items())).encode())
+    return digest.digest()
+
+
+def build_parser(debug: bool = False) -> Lark:
+    return Lark(grammar=_read_grammar(), cache=True, debug=debug, **_LARK_OPTIONS)
+
+
+def build_parser_tables(path: str | PathLike = PARSER_TABLES_PATH) -> Lark:
+    grammar = _read_grammar()
+    parser = Lark(grammar=grammar, **_LARK_OPTIONS)
+    # Written to a temporary file first, so that other processes
+    # never see the tables half-written.
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(_TABLES_MAGIC)
+            file.write(_tables_fingerprint(grammar))
+            parser.save(file)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return parser
+
+
+def load_parser_tables(path: str | PathLike = PARSER_TABLES_PATH) -> Lark | None:
+    # Returns None if the tables are missing or stale.
+    try:
+        with open(path, "rb") as file:
+            if file.read(len(_TABLES_MAGIC)) != _TABLES_MAGIC:
+                return None
+            fingerprint = file.read(hashlib.sha256().digest_size)
+            if fingerprint != _tables_fingerprint(_read_grammar()):
+                return None
+            return Lark.load(file)
+    except (OSError, EOFError, ValueError):
+        return None
+
+
+def create_transformer() -> Transformer:
+    return ast_utils.create_transformer(
+        sys.modules[luark.compiler.luark_ast.__name__],
+        LuarkTransformer(),
+    )
+
+
+def get_parser() -> Lark:
+    global _shared_parser
+    if _shared_parser is None:
+        with _lock:
+            if _shared_parser is None:
+                parser = load_parser_tables()
+                if parser is None:
+                    try:
+                        parser = build_parser_tables()
+                    except OSError:  # e.g. a read-only installation
+                        parser = build_parser()
+                _shared_parser = parser
+    return _shared_parser
+
+
+def get_transformer() -> Transformer:
+    global _shared_transformer
+    if _shared_transformer is None:
+        with _lock:
+            if _shared_transformer is None:
+                _shared_transformer = create_transformer()
+    return _shared_transformer
+
+
+if __name__ == "__main__":
+    build_parser_tables(sys.argv[1] if len(sys.argv) > 1 else PARSER_TABLES_PATH)
@@ -0,0 +1,265 @@
+import mmap
+import struct
+import sys
+from os import PathLike
+from typing import BinaryIO
+
+from luark.compiler.errors import InternalCompilerError, PrecompiledFormatError
+from luark.compiler.program import Program, Prototype, LocalVar, LocalVarIndex, ConstValue, ConstantPool, new_code
+
+# Layout of a precompiled file (all values little-endian):
+#
+#   header:    magic, format version, prototype count
+#   constants: count, then each constant of the program once
+#   prototype: name, fixed params, variadic flag, local count,
+#              constant indices, upvalues (name and source), local variable
+#              table, padding to a 4-byte boundary, instruction array
+#
+# Instruction arrays are stored exactly as they are laid out in memory,
+# so the loader can hand out views into the mapped file without copying.
+
+MAGIC = b"LUARKC\0"
+FORMAT_VERSION = 8
+EXTENSION = ".luarkc"
+
+_HEADER = struct.Struct("<7sHI")
+_PROTO_HEADER = struct.Struct("<IBIIIII")
+_LOCAL = struct.Struct("<iiiB")
+_UPVALUE_SOURCE = struct.Struct("<BI")
+_U32 = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_F64 = struct.Struct("<d")
+
+_TAG_NONE = 0
+_TAG_INT = 1
+_TAG_FLOAT = 2
+_TAG_STR = 3
+_TAG_BIG_INT = 4
+
+_NO_END = -1
+
+
+class _Writer:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def u32(self, value: int):
+        self.buffer += _U32.pack(value)
+
+    def string(self, value: str | None):
+        if value is None:
+            self.u32(0xFFFFFFFF)
+            return
+        data = value.encode("utf_8", "surrogatepass")
+        self.u32(len(data))
+        self.buffer += data
+
+    def const(self, value: ConstValue | None):
+        if value is None:
+            self.buffer.append(_TAG_NONE)
+        elif isinstance(value, int):
+            if -2 ** 63 <= value < 2 ** 63:
+                self.buffer.append(_TAG_INT)
+                self.buffer += _I64.pack(value)
+            else:
+                self.buffer.append(_TAG_BIG_INT)
+                self.string(str(value))
+        elif isinstance(value, float):
+            self.buffer.append(_TAG_FLOAT)
+            self.buffer += _F64.pack(value)
+        elif isinstance(value, str):
+            self.buffer.append(_TAG_STR)
+            self.string(value)
+        else:
+            raise InternalCompilerError(f"Cannot serialize constant of type '{type(value).__name__}'.")
+
+    def align(self, size: int):
+        padding = -len(self.buffer) % size
+        self.buffer += bytes(padding)
+
+
+class _Reader:
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.offset = 0
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        try:
+            values = fmt.unpack_from(self.view, self.offset)
+        except struct.error as e:
+            raise PrecompiledFormatError("Unexpected end of precompiled data.") from e
+        self.offset += fmt.size
+        return values
+
+    def u32(self) -> int:
+        return self.unpack(_U32)[0]
+
+    def byte(self) -> int:
+        if self.offset >= len(self.view):
+            raise PrecompiledFormatError("Unexpected end of precompiled data.")
+        value = self.view[self.offset]
+        self.offset += 1
+        return value
+
+    def bytes(self, size: int) -> memoryview:
+        end = self.offset + size
+        if end > len(self.view):
+            raise PrecompiledFormatError("Unexpected end of precompiled data.")
+        data = self.view[self.offset:end]
+        self.offset = end
+        return data
+
+    def string(self) -> str | None:
+        size = self.u32()
+        if size == 0xFFFFFFFF:
+            return None
+        return str(self.bytes(size), "utf_8", "surrogatepass")
+
+    def const(self) -> ConstValue | None:
+        tag = self.byte()
+        if tag == _TAG_NONE:
+            return None
+        elif tag == _TAG_INT:
+            return self.unpack(_I64)[0]
+        elif tag == _TAG_FLOAT:
+            return self.unpack(_F64)[0]
+        elif tag == _TAG_STR:
+            return self.string()
+        elif tag == _TAG_BIG_INT:
+            return int(self.string())
+        else:
+            raise PrecompiledFormatError(f"Unknown constant tag {tag}.")
+
+    def align(self, size: int):
+        self.offset += -self.offset % size
+
+
+def _write_prototype(writer: _Writer, proto: Prototype, constants: ConstantPool):
+    local_vars = list(proto.locals) if hasattr(proto, "locals") else []
+    writer.string(proto.func_name)
+    writer.buffer += _PROTO_HEADER.pack(
+        proto.fixed_params,
+        proto.is_variadic,
+        proto.num_locals,
+        len(proto.consts),
+        len(proto.upvalues),
+        len(local_vars),
+        len(proto.opcodes),
+    )
+
+    for const in proto.consts:
+        writer.u32(constants.add(const))
+    for upvalue, (in_stack, index) in zip(proto.upvalues, proto.upvalue_sources, strict=True):
+        writer.string(upvalue)
+        writer.buffer += _UPVALUE_SOURCE.pack(in_stack, index)
+    for var in local_vars:
+        end = _NO_END if var.end is None else var.end
+        writer.string(var.name)
+        writer.buffer += _LOCAL.pack(var.index, var.start, end, var.is_const)
+        writer.const(var.const_value)
+
+    writer.align(proto.opcodes.itemsize)
+    code = proto.opcodes
+    if sys.byteorder != "little":
+        code = new_code()
+        code.extend(proto.opcodes)
+        code.byteswap()
+    writer.buffer += memoryview(code).cast("B")
+
+
+def _read_prototype(reader: _Reader, constants: list[ConstValue]) -> Prototype:
+    proto = Prototype(reader.string())
+    (
+        proto.fixed_params,
+        is_variadic,
+        proto.num_locals,
+        num_consts,
+        num_upvalues,
+        num_local_vars,
+        code_size,
+    ) = reader.unpack(_PROTO_HEADER)
+    proto.is_variadic = bool(is_variadic)
+
+    try:
+        proto.consts = [constants[reader.u32()] for _ in range(num_consts)]
+    except IndexError:
+        raise PrecompiledFormatError("Constant index out of range.") from None
+    for _ in range(num_upvalues):
+        proto.upvalues.append(reader.string())
+        in_stack, index = reader.unpack(_UPVALUE_SOURCE)
+        proto.upvalue_sources.append((bool(in_stack), index))
+
+    proto.locals = LocalVarIndex()
+    for _ in range(num_local_vars):
+        name = reader.string()
+        index, start, end, is_const = reader.unpack(_LOCAL)
+        const_value = reader.const()
+        end = None if end == _NO_END else end
+        proto.locals.add(LocalVar(name, index, start, end, bool(is_const), const_value))
+
+    itemsize = new_code().itemsize
+    reader.align(itemsize)
+    code = reader.bytes(code_size * itemsize)
+    if sys.byteorder == "little":
+        proto.opcodes = code.cast(new_code().typecode)
+    else:
+        proto.opcodes = new_code()
+        proto.opcodes.frombytes(code)
+        proto.opcodes.byteswap()
+    return proto
+
+
+def dumps(program: Program) -> bytes:
+    writer = _Writer()
+    writer.buffer += _HEADER.pack(MAGIC, FORMAT_VERSION, len(program.prototypes))
+
+    # The pool is rebuilt from the prototypes, since the program's own
+    # pool may be shared with other programs.
+    constants = ConstantPool()
+    for proto in program.prototypes:
+        for const in proto.consts:
+            constants.add(const)
+    writer.u32(len(constants))
+    for const in constants.values:
+        writer.const(const)
+
+    for proto in program.prototypes:
+        _write_prototype(writer, proto, constants)
+    return bytes(writer.buffer)
+
+
+def dump(program: Program, file: str | PathLike | BinaryIO):
+    data = dumps(program)
+    if hasattr(file, "write"):
+        file.write(data)
+    else:
+        with open(file, "wb") as f:
+            f.write(data)
+
+
+def loads(data: bytes | bytearray | memoryview | mmap.mmap, constants: ConstantPool | None = None) -> Program:
+    # Instruction arrays of the loaded prototypes are read-only views into
+    # the given buffer, which is kept alive for as long as they are used.
+    # Programs loaded with the same constant pool share their constants.
+    reader = _Reader(memoryview(data))
+    magic, version, num_protos = reader.unpack(_HEADER)
+    if magic != MAGIC:
+        raise PrecompiledFormatError("Not a precompiled Luark program.")
+    if version != FORMAT_VERSION:
+        raise PrecompiledFormatError(
+            f"Unsupported precompiled format version {version} (expected {FORMAT_VERSION})."
+        )
+
+    program = Program()
+    if constants is not None:
+        program.constants = constants
+    values = [program.constants.intern(reader.const()) for _ in range(reader.u32())]
+    for _ in range(num_protos):
+        program.prototypes.append(_read_prototype(reader, values))
+    return program
+
+
+def load(path: str | PathLike, constants: ConstantPool | None = None) -> Program:
+    with open(path, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(data, constants)
@@ -0,0 +1,140 @@
+import json
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, IO
+
+from lark import Tree
+
+from luark.compiler.luark_ast import Ast, Statement, Expression, MultiresExpression
+
+# Instrumentation of the compiler phases. Observers registered on a compiler
+# are notified when each phase starts and finishes:
+#
+#   compile     the whole compilation, sized in instructions
+#   parse       source to parse tree, sized in tree nodes
+#   transform   parse tree to AST, sized in AST nodes
+#   emit        AST to bytecode, sized in instructions
+#   optimize    optimizer passes, sized in instructions
+#   stream      parse, transform and emit of a streamed source, interleaved,
+#               sized in instructions
+#
+# Nothing is measured while a compiler has no observers.
+
+_AST_TYPES = (Ast, Statement, Expression, MultiresExpression)
+
+
+@dataclass
+class PhaseEvent:
+    phase: str
+    name: str  # of the compiled file, or "<source>"
+    timestamp: float  # wall clock time of the start, in seconds since the epoch
+    duration: float  # in seconds
+    size: int | None = None
+    memory: int | None = None  # net allocated bytes, if traced
+    memory_peak: int | None = None  # peak allocated bytes above the start, if traced
+    error: str | None = None  # the exception type, if the phase failed
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class CompilerObserver:
+    def phase_started(self, phase: str, name: str):
+        pass
+
+    def phase_finished(self, event: PhaseEvent):
+        pass
+
+
+class EventRecorder(CompilerObserver):
+    def __init__(self):
+        self.events: list[PhaseEvent] = []
+
+    def phase_finished(self, event: PhaseEvent):
+        self.events.append(event)
+
+    def clear(self):
+        self.events.clear()
+
+    def to_dicts(self) -> list[dict[str, Any]]:
+        return [event.to_dict() for event in self.events]
+
+    def dump(self, file: IO[str]):
+        # One JSON object per line.
+        for event in self.events:
+            file.write(json.dumps(event.to_dict()))
+            file.write("\n")
+
+
+def tree_size(tree: Tree) -> int:
+    return sum(1 for _ in tree.iter_subtrees())
+
+
+def ast_size(node) -> int:
+    count = 0
+    seen = set()
+    pending = [node]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, list):
+            pending.extend(item)
+        elif isinstance(item, _AST_TYPES) and id(item) not in seen:
+            seen.add(id(item))
+            count += 1
+            pending.extend(vars(item).values())
+    return count
+
+
+class Profiler:
+    def __init__(self, observers: list[CompilerObserver], name: str, trace_memory: bool = False):
+        self.observers = observers
+        self.name = name
+        self.trace_memory = trace_memory
+        self._peaks: list[int] = []  # highest traced memory of each running phase
+
+    def run(self, phase: str, function: Callable, *args, size: Callable[[Any], int] | None = None):
+        if not self.observers:
+            return function(*args)
+
+        for observer in self.observers:
+            observer.phase_started(phase, self.name)
+
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            self._peaks.append(before)
+
+        event = PhaseEvent(phase, self.name, time.time(), 0.0)
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except BaseException as e:
+            event.error = type(e).__name__
+            raise
+        finally:
+            event.duration = time.perf_counter() - start
+            if self.trace_memory:
+                # Nested phases reset the peak, so it is carried over to the enclosing one.
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, self._peaks.pop())
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                event.memory = current - before
+                event.memory_peak = peak - before
+                if started_tracing:
+                    tracemalloc.stop()
+            if event.error is not None:
+                self.finish(event)
+
+        if size is not None:
+            event.size = size(result)
+        self.finish(event)
+        return result
+
+    def finish(self, event: PhaseEvent):
+        for observer in self.observers:
+            observer.phase_finished(event)
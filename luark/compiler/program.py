@@ -1,8 +1,154 @@
+import sys
+from array import array
 from dataclasses import dataclass
+from enum import IntEnum, auto
 from typing import Self, TypeAlias
 
 ConstValue: TypeAlias = int | float | str
 
+# Every instruction occupies a fixed number of slots in the code
+# array: the opcode itself followed by two (possibly unused) operands.
+INSTRUCTION_SIZE = 3
+OPERAND_MIN = -2 ** 31
+OPERAND_MAX = 2 ** 31 - 1
+
+
+class Opcode(IntEnum):
+    # Constants
+    PUSH_NIL = 0
+    PUSH_TRUE = auto()
+    PUSH_FALSE = auto()
+    PUSH_INT = auto()
+    PUSH_FLOAT = auto()
+    PUSH_CONST = auto()
+
+    # Variables
+    LOAD_LOCAL = auto()
+    STORE_LOCAL = auto()
+    LOAD_UPVALUE = auto()
+    STORE_UPVALUE = auto()
+    GET_UPVALUE = auto()
+    GET_VARARGS = auto()
+    MARK_TBC = auto()
+    CLOSE = auto()
+    POP = auto()
+
+    # Tables
+    CREATE_TABLE = auto()
+    GET_TABLE = auto()
+    SET_TABLE = auto()
+    STORE_LIST = auto()
+
+    # Functions
+    CLOSURE = auto()
+    CALL = auto()
+    RETURN = auto()
+
+    # Control flow
+    JUMP = auto()
+    TEST = auto()
+    TEST_NIL = auto()
+    TEST_SET = auto()
+    PREPARE_FOR_NUM = auto()
+    FOR_LOOP = auto()
+    PREPARE_FOR_GEN = auto()
+
+    # Binary operations
+    LT = auto()
+    GT = auto()
+    LE = auto()
+    GE = auto()
+    EQ = auto()
+    NEQ = auto()
+    BOR = auto()
+    BXOR = auto()
+    BAND = auto()
+    LSH = auto()
+    RSH = auto()
+    CONCAT = auto()
+    ADD = auto()
+    SUB = auto()
+    MUL = auto()
+    DIV = auto()
+    FDIV = auto()
+    MOD = auto()
+    EXP = auto()
+
+    # Unary operations
+    NEGATE = auto()
+    NOT = auto()
+    LEN = auto()
+    BNOT = auto()
+
+    # Superinstructions: fused forms of the most frequent sequences
+    # (see docs/superinstructions.md). They are only produced by the
+    # optimizer and are kept at the end to leave other numbers stable.
+    GET_FIELD = auto()  # push_const K; get_table
+    GET_UPVALUE_FIELD = auto()  # get_upvalue U; push_const K; get_table
+    SET_FIELD = auto()  # push_const K; set_table
+    SET_FIELD_LOCAL = auto()  # load_local L; push_const K; set_table
+    STORE_LIST_LOCAL = auto()  # load_local L; store_list 1 I
+    LOAD_LOCAL_CONST_ADD = auto()  # load_local L; push_int N; add
+    LOAD_LOCAL_CONST_SUB = auto()  # load_local L; push_int N; sub
+    LOAD_LOCALS = auto()  # load_local A; load_local B
+
+    # Globals: fields of the _ENV upvalue with a constant name.
+    GET_GLOBAL = auto()
+    SET_GLOBAL = auto()
+
+    # Calls in tail position ('return f(...)'), followed by 'return 0'.
+    TAIL_CALL = auto()
+
+    @property
+    def mnemonic(self) -> str:
+        return self.name.lower()
+
+    @property
+    def operand_count(self) -> int:
+        return _OPERAND_COUNTS.get(self, 0)
+
+
+_OPERAND_COUNTS: dict[Opcode, int] = {
+    Opcode.PUSH_INT: 1,
+    Opcode.PUSH_FLOAT: 1,
+    Opcode.PUSH_CONST: 1,
+    Opcode.LOAD_LOCAL: 1,
+    Opcode.STORE_LOCAL: 1,
+    Opcode.LOAD_UPVALUE: 1,
+    Opcode.STORE_UPVALUE: 1,
+    Opcode.GET_UPVALUE: 1,
+    Opcode.GET_VARARGS: 1,
+    Opcode.MARK_TBC: 1,
+    Opcode.CLOSE: 1,
+    Opcode.STORE_LIST: 2,
+    Opcode.CLOSURE: 1,
+    Opcode.CALL: 2,
+    Opcode.RETURN: 1,
+    Opcode.JUMP: 1,
+    Opcode.TEST_SET: 1,
+    Opcode.PREPARE_FOR_NUM: 1,
+    Opcode.FOR_LOOP: 2,
+    Opcode.PREPARE_FOR_GEN: 1,
+    Opcode.GET_FIELD: 1,
+    Opcode.GET_UPVALUE_FIELD: 2,
+    Opcode.SET_FIELD: 1,
+    Opcode.SET_FIELD_LOCAL: 2,
+    Opcode.STORE_LIST_LOCAL: 2,
+    Opcode.LOAD_LOCAL_CONST_ADD: 2,
+    Opcode.LOAD_LOCAL_CONST_SUB: 2,
+    Opcode.LOAD_LOCALS: 2,
+    Opcode.GET_GLOBAL: 2,
+    Opcode.SET_GLOBAL: 2,
+    Opcode.TAIL_CALL: 1,
+}
+
+# Lookup table from the raw opcode number to its enum member.
+OPCODES: list[Opcode] = list(Opcode)
+
+
+def new_code() -> array:
+    return array("i")
+
 
 @dataclass
 class LocalVar:
@@ -66,10 +212,22 @@ class Prototype:
         self.func_name = func_name
         self.fixed_params: int = 0
         self.is_variadic: bool = False
-        self.opcodes: list[str] = []
+        self.opcodes: array = new_code()
         self.consts: list[int | float | str] = []
         self.num_locals: int = 0
         self.upvalues: list[str] = []
+        # For each upvalue: (True, local index) when it captures a local of
+        # the enclosing function, (False, upvalue index) when it is passed
+        # down from one of the enclosing function's upvalues.
+        self.upvalue_sources: list[tuple[bool, int]] = []
+
+    def __len__(self) -> int:
+        return len(self.opcodes) // INSTRUCTION_SIZE
+
+    def decode(self, pc: int) -> tuple[Opcode, int, int]:
+        offset = pc * INSTRUCTION_SIZE
+        code = self.opcodes
+        return OPCODES[code[offset]], code[offset + 1], code[offset + 2]
 
     def __str__(self) -> str:
         out = [f"\tlocals({self.num_locals}):"]
@@ -79,7 +237,11 @@ class Prototype:
 
         out.append("\tupvalues:")
         for i, upvalue in enumerate(self.upvalues):
-            out.append(f"\t\t{i}\t\t\"{upvalue}\"")
+            line = f"\t\t{i}\t\t\"{upvalue}\""
+            if i < len(self.upvalue_sources):
+                in_stack, index = self.upvalue_sources[i]
+                line += f"  // {'local' if in_stack else 'upvalue'} {index}"
+            out.append(line)
 
         out.append("\tconsts:")
         for i, const in enumerate(self.consts):
@@ -87,39 +249,80 @@ class Prototype:
             out.append(f"\t\t{i}\t\t{value}")
 
         out.append("\topcodes:")
-        for i, opcode in enumerate(self.opcodes):
-            parts = opcode.split(" ")
-            own_name = parts[0]
-            result = f"\t\t{i}\t\t{opcode}"
-            if own_name.endswith("local"):
-                index = int(parts[1])
-                name = self.locals.get_by_index(index).name
+        for i in range(len(self)):
+            opcode, a, b = self.decode(i)
+            operands = (a, b)[:opcode.operand_count]
+            result = f"\t\t{i}\t\t{' '.join([opcode.mnemonic, *map(str, operands)])}"
+            if opcode in (Opcode.LOAD_LOCAL, Opcode.STORE_LOCAL):
+                name = self.locals.get_by_index(a).name
                 if not name:
                     name = "(temp)"
                 result += f"  // '{name}'"
-            elif own_name == "push_const":
-                index = int(parts[1])
-                result += f"  // {self.consts[index]}"
-            elif own_name == "get_upvalue":
-                index = int(parts[1])
-                result += f"  // '{self.upvalues[index]}'"
-            elif own_name == "jump":
-                target = i + int(parts[1])
-                result += f"  // to {target}"
-            elif own_name == "call":
-                params = int(parts[1])
-                returns = int(parts[2])
-                params = "(all)" if (params == 0) else params - 1
-                returns = "(all)" if (returns == 0) else returns - 1
+            elif opcode in (Opcode.PUSH_CONST, Opcode.GET_FIELD, Opcode.SET_FIELD):
+                result += f"  // {self.consts[a]}"
+            elif opcode == Opcode.GET_UPVALUE:
+                result += f"  // '{self.upvalues[a]}'"
+            elif opcode in (Opcode.GET_UPVALUE_FIELD, Opcode.GET_GLOBAL, Opcode.SET_GLOBAL):
+                result += f"  // '{self.upvalues[a]}'.{self.consts[b]}"
+            elif opcode == Opcode.SET_FIELD_LOCAL:
+                result += f"  // .{self.consts[b]}"
+            elif opcode == Opcode.JUMP:
+                result += f"  // to {i + a}"
+            elif opcode == Opcode.FOR_LOOP:
+                result += f"  // to {i + b}"
+            elif opcode == Opcode.CALL:
+                params = f"(all+{-a})" if (a <= 0) else a - 1
+                returns = "(all)" if (b == 0) else b - 1
                 result += f"  // par:{params} ret:{returns}"
             out.append(result)
         return "\n".join(out)
 
 
+def const_key(value: ConstValue) -> tuple:
+    # 1 and 1.0 (and 0.0 and -0.0) are equal in Python, but not the same
+    # constant in Lua. Floats are keyed by their exact representation,
+    # which also lets NaN be found again.
+    if value.__class__ is float:
+        return float, value.hex()
+    return value.__class__, value
+
+
+class ConstantPool:
+    # Constants shared by all prototypes of a program. Strings are interned,
+    # so every occurrence of a name refers to the same object, including
+    # across programs, and table lookups with it can compare by identity.
+
+    def __init__(self):
+        self.values: list[ConstValue] = []
+        self._indices: dict[tuple, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, index: int) -> ConstValue:
+        return self.values[index]
+
+    def add(self, value: ConstValue) -> int:
+        key = const_key(value)
+        index = self._indices.get(key)
+        if index is None:
+            if value.__class__ is str:
+                value = sys.intern(value)
+            index = len(self.values)
+            self.values.append(value)
+            self._indices[key] = index
+        return index
+
+    def intern(self, value: ConstValue) -> ConstValue:
+        return self.values[self.add(value)]
+
+
 class Program:
     def __init__(self):
         # By convention, the first prototype is the entry point.
         self.prototypes: list[Prototype] = []
+        # Prototype constants are taken from this pool.
+        self.constants = ConstantPool()
 
     def __str__(self) -> str:
         out: list[str] = []
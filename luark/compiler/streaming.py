@@ -0,0 +1,140 @@
+import re
+from typing import IO, Iterator
+
+from lark import Lark, Transformer, Tree
+from lark.exceptions import UnexpectedInput
+from lark.lexer import LexerThread
+
+from luark.compiler.errors import InternalCompilerError
+from luark.compiler.luark_ast import Chunk, Statement
+
+# Parsing of sources that are too large to be held in memory as a whole,
+# along with their parse tree. The source is read in chunks and lexed up to
+# the last line break that is not inside of a string or a comment, so that
+# no token is split between two chunks. Each piece is lexed and parsed by
+# Lark's interactive LALR parser, with the same contextual lexer as usual.
+# Statements of the main chunk are taken off the parser's value stack as soon
+# as they have been reduced, and are transformed into AST and handed over to
+# the caller right away.
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Everything that can span line breaks or hide the end of a line.
+_SPANNING = re.compile(r"--\[(=*)\[|\[(=*)\[|--|[\"'\n]")
+_SHORT_STRINGS = {
+    '"': re.compile(r'"(?:[^"\\]|\\.)*"', re.S),
+    "'": re.compile(r"'(?:[^'\\]|\\.)*'", re.S),
+}
+
+
+def _safe_end(text: str) -> int:
+    # Returns the length of the longest prefix of the text which ends with
+    # a line break outside of strings and comments, or 0 if there is none.
+    safe = 0
+    pos = 0
+    while True:
+        match = _SPANNING.search(text, pos)
+        if match is None:
+            return safe
+        start = match.start()
+        kind = match.group()
+        if kind == "\n":
+            pos = safe = start + 1
+        elif kind == "--":
+            end = text.find("\n", start)
+            if end < 0:
+                return safe
+            pos = end
+        elif kind in _SHORT_STRINGS:
+            string = _SHORT_STRINGS[kind].match(text, start)
+            if string is None:
+                return safe
+            pos = string.end()
+        else:
+            equals = match.group(1) if match.group(1) is not None else match.group(2)
+            end = text.find(f"]{equals}]", match.end())
+            if end < 0:
+                return safe
+            pos = end + len(equals) + 2
+
+
+def _top_level_statements(stack: list, shebang: bool) -> list | None:
+    # The statements of the main chunk which have been reduced so far are
+    # collected by the left recursive rule 'statement*' at the bottom of the
+    # value stack, right above the shebang if there is one. Lark extends the
+    # same list of children as more of them are reduced.
+    index = 1 if shebang else 0
+    if len(stack) > index:
+        item = stack[index]
+        if isinstance(item, Tree) and item.data.startswith("__block_star"):
+            return item.children
+    return None
+
+
+def parse_stream(
+        parser: Lark,
+        transformer: Transformer,
+        file: IO[str],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[Statement]:
+    # Yields the statements of the main chunk in order.
+    interactive = parser.parse_interactive()
+    lexer = interactive.lexer_thread.lexer
+    stack = interactive.parser_state.value_stack
+
+    shebang = False
+    first = True
+    buffer = ""
+    offset = 0  # characters before the buffer
+    line = 0  # lines before the buffer
+    eof = False
+    while not eof:
+        data = file.read(chunk_size)
+        eof = not data
+        buffer += data
+        end = len(buffer) if eof else _safe_end(buffer)
+        if end == 0 and not eof:
+            continue
+
+        text = buffer[:end]
+        buffer = buffer[end:]
+        tokens = LexerThread.from_text(lexer, text).lex(interactive.parser_state)
+        while True:
+            try:
+                token = next(tokens)
+            except StopIteration:
+                break
+            except UnexpectedInput as e:
+                # Positions of lexer errors are relative to the piece being lexed.
+                if isinstance(e.line, int):
+                    e.line += line
+                if isinstance(e.pos_in_stream, int):
+                    e.pos_in_stream += offset
+                raise
+            if line:
+                token.line += line
+                token.end_line += line
+                token.start_pos += offset
+                token.end_pos += offset
+            if first:
+                shebang = token.type == "SHEBANG"
+                first = False
+            interactive.feed_token(token)
+        offset += end
+        line += text.count("\n")
+
+        statements = _top_level_statements(stack, shebang)
+        if statements:
+            trees = statements[:]
+            del statements[:]
+            for tree in trees:
+                statement = transformer.transform(tree)
+                if statement is not None:  # empty statements are discarded
+                    yield statement
+            del trees
+
+    # The rest of the main chunk, including its return statement.
+    chunk = transformer.transform(interactive.feed_eof())
+    if not isinstance(chunk, Chunk):
+        raise InternalCompilerError("Attempted to compile something other than a chunk.")
+    yield from chunk.block.statements
@@ -0,0 +1,11 @@
+class LuaError(RuntimeError):
+    # Raised for errors at the Lua level. The error object itself may be
+    # any Lua value, as with the standard 'error' function.
+
+    def __init__(self, value=None):
+        super().__init__(value)
+        self.value = value
+
+    def __str__(self):
+        from luark.vm.values import tostring
+        return tostring(self.value)
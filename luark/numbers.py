@@ -0,0 +1,210 @@
+import math
+import re
+
+from luark.errors import LuaError
+
+# Lua's number semantics, shared by the VM and by constant folding in the
+# compiler. This module must not depend on the VM.
+
+INT_MIN = -0x8000000000000000
+INT_MAX = 0x7FFFFFFFFFFFFFFF
+_UINT_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def wrap_int(value: int) -> int:
+    # Lua integers are 64-bit and wrap around on overflow.
+    if INT_MIN <= value <= INT_MAX:
+        return value
+    return ((value - INT_MIN) & _UINT_MASK) + INT_MIN
+
+
+def truthy(value) -> bool:
+    return value is not None and value is not False
+
+
+def number_to_str(value: int | float) -> str:
+    if value.__class__ is int:
+        return str(value)
+    if math.isinf(value):
+        return "inf" if value > 0 else "-inf"
+    if value != value:
+        return "nan" if math.copysign(1.0, value) > 0 else "-nan"
+    text = "%.14g" % value
+    if re.fullmatch(r"-?\d+", text):
+        text += ".0"
+    return text
+
+
+def raw_equals(a, b) -> bool:
+    ca, cb = a.__class__, b.__class__
+    if ca is cb:
+        return a == b
+    if (ca is int and cb is float) or (ca is float and cb is int):
+        return a == b
+    return False
+
+
+_DEC_NUMBER = re.compile(r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+_HEX_NUMBER = re.compile(r"([+-]?)0[xX]([\da-fA-F]*)(?:\.([\da-fA-F]*))?(?:[pP]([+-]?\d+))?")
+
+
+def str_to_number(text: str) -> int | float | None:
+    text = text.strip()
+    if _DEC_NUMBER.fullmatch(text):
+        if re.fullmatch(r"[+-]?\d+", text):
+            value = int(text)
+            return value if INT_MIN <= value <= INT_MAX else float(value)
+        try:
+            return float(text)
+        except ValueError:
+            return None
+
+    match = _HEX_NUMBER.fullmatch(text)
+    if match:
+        sign, whole, frac, exp = match.groups()
+        if not whole and not frac:
+            return None
+        if frac is None and exp is None:
+            value = wrap_int(int(whole, 16))
+            return -value if sign == "-" else value
+        value = float(int(whole or "0", 16))
+        if frac:
+            value += int(frac, 16) / 16 ** len(frac)
+        if exp:
+            value = math.ldexp(value, int(exp))
+        return -value if sign == "-" else value
+    return None
+
+
+def tonumber(value) -> int | float | None:
+    cls = value.__class__
+    if cls is int or cls is float:
+        return value
+    if cls is str:
+        return str_to_number(value)
+    return None
+
+
+def tointeger(value) -> int | None:
+    cls = value.__class__
+    if cls is int:
+        return value
+    if cls is float:
+        if value.is_integer() and INT_MIN <= value <= INT_MAX:
+            return int(value)
+        return None
+    if cls is str:
+        return tointeger(str_to_number(value))
+    return None
+
+
+def arith_int_or_float(op: str, a, b):
+    # Arithmetic on two numbers, with Lua's integer/float rules.
+    # Returns NotImplemented for non-numbers.
+    if a.__class__ is str:
+        a = str_to_number(a)
+    if b.__class__ is str:
+        b = str_to_number(b)
+    ca, cb = a.__class__, b.__class__
+    if not (ca is int or ca is float) or not (cb is int or cb is float):
+        return NotImplemented
+
+    both_int = ca is int and cb is int
+    match op:
+        case "add":
+            return wrap_int(a + b) if both_int else float(a) + float(b)
+        case "sub":
+            return wrap_int(a - b) if both_int else float(a) - float(b)
+        case "mul":
+            return wrap_int(a * b) if both_int else float(a) * float(b)
+        case "div":
+            return float_div(float(a), float(b))
+        case "fdiv":
+            if both_int:
+                if b == 0:
+                    raise LuaError("attempt to perform 'n//0'")
+                return wrap_int(a // b)
+            return float_floor_div(float(a), float(b))
+        case "mod":
+            if both_int:
+                if b == 0:
+                    raise LuaError("attempt to perform 'n%0'")
+                return a % b
+            return float_mod(float(a), float(b))
+        case "exp":
+            return float_pow(float(a), float(b))
+    raise LuaError(f"unknown arithmetic operation '{op}'")
+
+
+def float_div(a: float, b: float) -> float:
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a == 0.0 or a != a:
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+
+def float_floor_div(a: float, b: float) -> float:
+    quotient = float_div(a, b)
+    return float(math.floor(quotient)) if math.isfinite(quotient) else quotient
+
+
+def float_mod(a: float, b: float) -> float:
+    if b == 0.0:
+        return math.nan
+    if math.isinf(b):
+        if a != a or math.isinf(a):
+            return math.nan
+        if (a >= 0) == (b > 0):
+            return a
+        return b
+    result = math.fmod(a, b)
+    if result != 0.0 and (result < 0) != (b < 0):
+        result += b
+    return result
+
+
+def float_pow(a: float, b: float) -> float:
+    try:
+        return math.pow(a, b)
+    except OverflowError:
+        return math.inf
+    except ValueError:
+        return math.nan
+
+
+def to_bit_int(value) -> int | None:
+    cls = value.__class__
+    if cls is int:
+        return value
+    if cls is float or cls is str:
+        result = tointeger(value)
+        if result is None and tonumber(value) is not None:
+            raise LuaError("number has no integer representation")
+        return result
+    return None
+
+
+def bitwise(op: str, a: int, b: int) -> int:
+    match op:
+        case "band":
+            return wrap_int(a & b)
+        case "bor":
+            return wrap_int(a | b)
+        case "bxor":
+            return wrap_int(a ^ b)
+        case "lsh":
+            return shift_left(a, b)
+        case "rsh":
+            return shift_left(a, -b)
+    raise LuaError(f"unknown bitwise operation '{op}'")
+
+
+def shift_left(a: int, b: int) -> int:
+    # Shifts are logical: vacated bits are always filled with zeros.
+    if b <= -64 or b >= 64:
+        return 0
+    if b >= 0:
+        return wrap_int((a << b) & _UINT_MASK)
+    return wrap_int((a & _UINT_MASK) >> -b)
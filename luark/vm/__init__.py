@@ -0,0 +1,8 @@
+from luark.vm.errors import LuaError, PoolError, WorkerCrashError, JobTimeoutError
+from luark.vm.objects import LuaFunction, VMFunction, Task
+from luark.vm.table import LuaTable
+from luark.vm.luavm import LuaVM
+from luark.vm.memory import MemoryStats
+from luark.vm.pool import Pool
+from luark.vm.profiler import VMProfile
+from luark.vm.scheduler import Scheduler
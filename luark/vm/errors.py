@@ -0,0 +1,14 @@
+from luark.errors import LuaError
+
+
+class PoolError(RuntimeError):
+    # A job of a worker pool could not be run or its results not be sent back.
+    pass
+
+
+class WorkerCrashError(PoolError):
+    pass
+
+
+class JobTimeoutError(PoolError):
+    pass
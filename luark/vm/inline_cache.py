@@ -0,0 +1,82 @@
+from luark.vm.table import LuaTable
+
+# Inline caches for field reads with a constant string key. When the field
+# is not in the table itself, the lookup goes through the '__index' chain of
+# its metatable, e.g. to find a method in a class table. Every instruction
+# remembers the result of its last such lookup together with the tables it
+# has visited and their versions. As long as the receiver has the same
+# metatable and none of those tables changed or got another metatable,
+# the result still holds.
+# A few metatables are remembered per instruction, so that code working on
+# objects of several classes does not keep evicting its own entries.
+
+MAX_ENTRIES = 4
+
+
+class FieldCache:
+    __slots__ = ("key", "entries", "hits", "misses")
+
+    def __init__(self, key: str):
+        self.key = key
+        # Metatable of the receiver -> (visited tables and their versions, value).
+        self.entries: dict[LuaTable, tuple[tuple[tuple[LuaTable, int], ...], object]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, meta: LuaTable):
+        # Returns the cached value, or NotImplemented on a miss.
+        entry = self.entries.get(meta)
+        if entry is not None:
+            for table, version in entry[0]:
+                if table.version != version:
+                    break
+            else:
+                self.hits += 1
+                return entry[1]
+        self.misses += 1
+        return NotImplemented
+
+    def fill(self, meta: LuaTable) -> object:
+        # Follows the '__index' chain from the metatable. Returns
+        # NotImplemented if it ends up at something other than a table,
+        # which is left to the VM to handle.
+        key = self.key
+        start = meta
+        visited = []
+        value = None
+        while True:
+            visited.append(meta)
+            handler = meta.get("__index")
+            if handler is None:
+                break
+            if handler.__class__ is not LuaTable or len(visited) > 100:
+                return NotImplemented
+            visited.append(handler)
+            value = handler.get(key)
+            if value is not None:
+                break
+            meta = handler.metatable
+            if meta is None:
+                break
+
+        entries = self.entries
+        if start not in entries and len(entries) >= MAX_ENTRIES:
+            entries.clear()
+        entries[start] = tuple((table, table.version) for table in visited), value
+        return value
+
+
+class GlobalCache:
+    # The value of a global at one instruction, valid for as long as the
+    # environment table keeps the same version. Setting its metatable
+    # changes the version too, since a missing global may then be found
+    # through '__index'.
+    __slots__ = ("key", "env", "version", "value", "hits", "misses")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.env: LuaTable | None = None
+        self.version = -1
+        self.value = None
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,664 @@
+import math
+import random
+import time
+
+from luark.vm import values
+from luark.vm.errors import LuaError
+from luark.vm.memory import STRING_SIZE, COROUTINE_SIZE
+from luark.vm.objects import VMFunction, LuaFunction, Coroutine
+from luark.vm.table import LuaTable
+from luark.vm.values import lua_type, tostring, tonumber, tointeger
+
+# Host functions receive Lua values as positional arguments. They return
+# a single value, a tuple for multiple values, or None for no values.
+
+
+def _check_table(value, position: int, name: str) -> LuaTable:
+    if value.__class__ is not LuaTable:
+        raise LuaError(f"bad argument #{position} to '{name}' (table expected, got {_type_name(value)})")
+    return value
+
+
+def _check_int(value, position: int, name: str) -> int:
+    result = tointeger(value)
+    if result is None:
+        if tonumber(value) is not None:
+            raise LuaError(f"bad argument #{position} to '{name}' (number has no integer representation)")
+        raise LuaError(f"bad argument #{position} to '{name}' (number expected, got {_type_name(value)})")
+    return result
+
+
+def _check_number(value, position: int, name: str) -> int | float:
+    result = tonumber(value)
+    if result is None:
+        raise LuaError(f"bad argument #{position} to '{name}' (number expected, got {_type_name(value)})")
+    return result
+
+
+def _check_coroutine(value, position: int, name: str) -> Coroutine:
+    if value.__class__ is not Coroutine:
+        raise LuaError(f"bad argument #{position} to '{name}' (coroutine expected, got {_type_name(value)})")
+    return value
+
+
+def _check_function(value, position: int, name: str):
+    if lua_type(value) != "function":
+        raise LuaError(f"bad argument #{position} to '{name}' (function expected, got {_type_name(value)})")
+    return value
+
+
+def _check_str(value, position: int, name: str) -> str:
+    cls = value.__class__
+    if cls is str:
+        return value
+    if cls is int or cls is float:
+        return tostring(value)
+    raise LuaError(f"bad argument #{position} to '{name}' (string expected, got {_type_name(value)})")
+
+
+def _type_name(value) -> str:
+    return "no value" if value is None else lua_type(value)
+
+
+def _table_of(functions: dict) -> LuaTable:
+    table = LuaTable()
+    for name, value in functions.items():
+        table.set(name, value)
+    return table
+
+
+def open_libs(vm):
+    env = vm.env
+    env.set("_G", env)
+    env.set("_VERSION", "Lua 5.4")
+    for name, value in _base_lib(vm).items():
+        env.set(name, value)
+
+    string = _table_of(_string_lib(vm))
+    env.set("string", string)
+    vm.string_meta = _table_of({"__index": string})
+
+    env.set("table", _table_of(_table_lib(vm)))
+    env.set("coroutine", _table_of(_coroutine_lib(vm)))
+    env.set("math", _table_of(_math_lib()))
+    env.set("os", _table_of(_os_lib()))
+
+
+def _base_lib(vm) -> dict:
+    def print_(*args):
+        vm.stdout.write("\t".join(vm.tostring(arg) for arg in args) + "\n")
+
+    def type_(*args):
+        if not args:
+            raise LuaError("bad argument #1 to 'type' (value expected)")
+        return lua_type(args[0])
+
+    def tostring_(value=None, *_):
+        return vm.tostring(value)
+
+    def tonumber_(value=None, base=None, *_):
+        if base is None:
+            return tonumber(value)
+        base = _check_int(base, 2, "tonumber")
+        text = _check_str(value, 1, "tonumber").strip().lower()
+        try:
+            return values.wrap_int(int(text, base))
+        except ValueError:
+            return None
+
+    def next_(table=None, key=None, *_):
+        _check_table(table, 1, "next")
+        key, value = table.next(key)
+        if key is None:
+            return None
+        return key, value
+
+    def pairs(table=None, *_):
+        handler = vm.get_metamethod(table, "__pairs")
+        if handler is not None:
+            return tuple(vm.call(handler, table)[:3])
+        _check_table(table, 1, "pairs")
+        return next_, table, None
+
+    def ipairs_next(table, index, *_):
+        index = values.wrap_int(index + 1)
+        value = vm.index(table, index)
+        if value is None:
+            return None
+        return index, value
+
+    def ipairs(table=None, *_):
+        if table is None:
+            raise LuaError("bad argument #1 to 'ipairs' (table expected, got no value)")
+        return ipairs_next, table, 0
+
+    def select(n=None, *args):
+        if n == "#":
+            return len(args)
+        n = _check_int(n, 1, "select")
+        if n < 0:
+            n += len(args)
+            if n < 0:
+                raise LuaError("bad argument #1 to 'select' (index out of range)")
+            return args[n:]
+        if n == 0:
+            raise LuaError("bad argument #1 to 'select' (index out of range)")
+        return args[n - 1:]
+
+    def error(value=None, level=None, *_):
+        raise LuaError(value)
+
+    def assert_(*args):
+        if not args or not values.truthy(args[0]):
+            message = args[1] if len(args) > 1 else "assertion failed!"
+            raise LuaError(message)
+        return args
+
+    def pcall(vm_, frame, args, expected):
+        if not args:
+            raise LuaError("bad argument #1 to 'pcall' (value expected)")
+        function, *rest = args
+        if function.__class__ is LuaFunction:
+            new_frame = vm_._call_value(frame, function, rest, expected)
+        else:
+            # Other functions are called by a frame of their own, so
+            # that they can yield or await like Lua functions.
+            new_frame = vm_._trampoline(function, rest, frame, expected)
+        new_frame.protected = True
+        return new_frame
+
+    def rawget(table=None, key=None, *_):
+        return _check_table(table, 1, "rawget").get(key)
+
+    def rawset(table=None, key=None, value=None, *_):
+        _check_table(table, 1, "rawset").set(key, value)
+        return table
+
+    def rawequal(a=None, b=None, *_):
+        return values.raw_equals(a, b)
+
+    def rawlen(value=None, *_):
+        if value.__class__ is LuaTable:
+            return value.length()
+        if value.__class__ is str:
+            return len(value)
+        raise LuaError("table or string expected")
+
+    def setmetatable(table=None, meta=None, *_):
+        _check_table(table, 1, "setmetatable")
+        if meta is not None and meta.__class__ is not LuaTable:
+            raise LuaError("bad argument #2 to 'setmetatable' (nil or table expected)")
+        if table.metatable is not None and table.metatable.get("__metatable") is not None:
+            raise LuaError("cannot change a protected metatable")
+        table.set_metatable(meta)
+        return table
+
+    def getmetatable(value=None, *_):
+        meta = vm.get_metatable(value)
+        if meta is None:
+            return None
+        protected = meta.get("__metatable")
+        return protected if protected is not None else meta
+
+    return {
+        "print": print_,
+        "type": type_,
+        "tostring": tostring_,
+        "tonumber": tonumber_,
+        "next": next_,
+        "pairs": pairs,
+        "ipairs": ipairs,
+        "select": select,
+        "error": error,
+        "assert": assert_,
+        "pcall": VMFunction("pcall", pcall),
+        "rawget": rawget,
+        "rawset": rawset,
+        "rawequal": rawequal,
+        "rawlen": rawlen,
+        "setmetatable": setmetatable,
+        "getmetatable": getmetatable,
+    }
+
+
+def _string_lib(vm) -> dict:
+    def _range(length: int, i: int, j: int) -> tuple[int, int]:
+        if i < 0:
+            i = max(length + i + 1, 1)
+        elif i == 0:
+            i = 1
+        if j < 0:
+            j = length + j + 1
+        elif j > length:
+            j = length
+        return i, j
+
+    def len_(s=None, *_):
+        return len(_check_str(s, 1, "len"))
+
+    def sub(s=None, i=1, j=-1, *_):
+        s = _check_str(s, 1, "sub")
+        i, j = _range(len(s), _check_int(i, 2, "sub"), _check_int(j, 3, "sub"))
+        return s[i - 1:j] if i <= j else ""
+
+    def upper(s=None, *_):
+        return _check_str(s, 1, "upper").upper()
+
+    def lower(s=None, *_):
+        return _check_str(s, 1, "lower").lower()
+
+    def rep(s=None, n=None, sep="", *_):
+        s = _check_str(s, 1, "rep")
+        n = _check_int(n, 2, "rep")
+        if n <= 0:
+            return ""
+        sep = _check_str(sep, 3, "rep")
+        if vm.memory is not None:
+            vm.memory.allocate(STRING_SIZE + len(s) * n + len(sep) * (n - 1))
+        return sep.join([s] * n)
+
+    def reverse(s=None, *_):
+        return _check_str(s, 1, "reverse")[::-1]
+
+    def byte(s=None, i=1, j=None, *_):
+        s = _check_str(s, 1, "byte")
+        i = _check_int(i, 2, "byte")
+        i, j = _range(len(s), i, i if j is None else _check_int(j, 3, "byte"))
+        return tuple(ord(c) for c in s[i - 1:j])
+
+    def char(*codes):
+        return "".join(chr(_check_int(code, i + 1, "char")) for i, code in enumerate(codes))
+
+    def find(s=None, pattern=None, init=1, plain=None, *_):
+        # Only plain searches are supported; patterns are matched literally.
+        s = _check_str(s, 1, "find")
+        pattern = _check_str(pattern, 2, "find")
+        init, _ = _range(len(s), _check_int(init, 3, "find"), len(s))
+        index = s.find(pattern, init - 1)
+        if index < 0:
+            return None
+        return index + 1, index + len(pattern)
+
+    def format_(fmt=None, *args):
+        fmt = _check_str(fmt, 1, "format")
+        out = []
+        arg = 0
+        i = 0
+        while i < len(fmt):
+            c = fmt[i]
+            if c != "%":
+                out.append(c)
+                i += 1
+                continue
+            j = i + 1
+            while j < len(fmt) and fmt[j] in "-+ #0123456789.":
+                j += 1
+            if j >= len(fmt):
+                raise LuaError("invalid conversion to format string")
+            spec, conversion = fmt[i:j], fmt[j]
+            i = j + 1
+            if conversion == "%":
+                out.append("%")
+                continue
+            if arg >= len(args):
+                raise LuaError(f"bad argument #{arg + 2} to 'format' (no value)")
+            value = args[arg]
+            arg += 1
+            match conversion:
+                case "d" | "i":
+                    out.append((spec + "d") % _check_int(value, arg + 1, "format"))
+                case "u" | "c" | "o" | "x" | "X":
+                    if conversion == "c":
+                        out.append(chr(_check_int(value, arg + 1, "format")))
+                    else:
+                        out.append((spec + conversion.replace("u", "d")) % _check_int(value, arg + 1, "format"))
+                case "e" | "E" | "f" | "F" | "g" | "G":
+                    out.append((spec + conversion) % _check_number(value, arg + 1, "format"))
+                case "a" | "A":
+                    out.append(float(_check_number(value, arg + 1, "format")).hex())
+                case "s":
+                    out.append((spec + "s") % vm.tostring(value))
+                case "q":
+                    out.append(_quote(value))
+                case _:
+                    raise LuaError(f"invalid conversion '{spec}{conversion}' to 'format'")
+        return "".join(out)
+
+    return {
+        "len": len_,
+        "sub": sub,
+        "upper": upper,
+        "lower": lower,
+        "rep": rep,
+        "reverse": reverse,
+        "byte": byte,
+        "char": char,
+        "find": find,
+        "format": format_,
+    }
+
+
+def _quote(value) -> str:
+    if value.__class__ is not str:
+        return tostring(value)
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+    escaped = escaped.replace("\0", "\\0")
+    return f'"{escaped}"'
+
+
+def _coroutine_lib(vm) -> dict:
+    def create(function=None, *_):
+        function = _check_function(function, 1, "create")
+        if vm.memory is not None:
+            vm.memory.allocate(COROUTINE_SIZE)
+        return Coroutine(function)
+
+    def resume(vm_, frame, args, expected):
+        co = _check_coroutine(args[0] if args else None, 1, "resume")
+        return vm_.resume(co, frame, args[1:], expected)
+
+    def yield_(vm_, frame, args, expected):
+        return vm_.yield_(frame, args, expected)
+
+    def wrap(function=None, *_):
+        function = _check_function(function, 1, "wrap")
+        if vm.memory is not None:
+            vm.memory.allocate(COROUTINE_SIZE)
+        co = Coroutine(function)
+
+        def resume_wrapped(vm_, frame, args, expected):
+            return vm_.resume(co, frame, args, expected, wrapped=True)
+
+        return VMFunction("wrap", resume_wrapped)
+
+    def status(co=None, *_):
+        return _check_coroutine(co, 1, "status").status
+
+    def running(*_):
+        return vm.current, vm.current.caller is None
+
+    def isyieldable(*_):
+        return vm.current.caller is not None
+
+    def close(co=None, *_):
+        _check_coroutine(co, 1, "close")
+        if co.status != "suspended" and co.status != "dead":
+            raise LuaError(f"cannot close a {co.status} coroutine")
+        error = vm.close_coroutine(co)
+        if error is not None:
+            return False, error.value
+        return True
+
+    return {
+        "create": create,
+        "resume": VMFunction("resume", resume),
+        "yield": VMFunction("yield", yield_),
+        "wrap": wrap,
+        "status": status,
+        "running": running,
+        "isyieldable": isyieldable,
+        "close": close,
+    }
+
+
+def _table_lib(vm) -> dict:
+    def length(table) -> int:
+        size = vm.length(table)
+        if size.__class__ is not int:
+            raise LuaError("object length is not an integer")
+        return size
+
+    def insert(table=None, *args):
+        _check_table(table, 1, "insert")
+        size = length(table)
+        if len(args) == 1:
+            vm.set_index(table, size + 1, args[0])
+        elif len(args) == 2:
+            position = _check_int(args[0], 2, "insert")
+            if position < 1 or position > size + 1:
+                raise LuaError("bad argument #2 to 'insert' (position out of bounds)")
+            for i in range(size, position - 1, -1):
+                vm.set_index(table, i + 1, vm.index(table, i))
+            vm.set_index(table, position, args[1])
+        else:
+            raise LuaError("wrong number of arguments to 'insert'")
+
+    def remove(table=None, position=None, *_):
+        _check_table(table, 1, "remove")
+        size = length(table)
+        if position is None:
+            position = size
+        else:
+            position = _check_int(position, 2, "remove")
+            if size + 1 == position:
+                value = vm.index(table, position)
+                vm.set_index(table, position, None)
+                return value
+            if size > 0 and (position < 1 or position > size + 1):
+                raise LuaError("bad argument #2 to 'remove' (position out of bounds)")
+        value = vm.index(table, position)
+        for i in range(position, size):
+            vm.set_index(table, i, vm.index(table, i + 1))
+        if position <= size:
+            vm.set_index(table, size, None)
+        return value
+
+    def concat(table=None, sep="", i=1, j=None, *_):
+        _check_table(table, 1, "concat")
+        sep = _check_str(sep, 2, "concat")
+        i = _check_int(i, 3, "concat")
+        j = length(table) if j is None else _check_int(j, 4, "concat")
+        parts = []
+        for k in range(i, j + 1):
+            value = vm.index(table, k)
+            if value.__class__ not in (str, int, float):
+                raise LuaError(f"invalid value (at index {k}) in table for 'concat'")
+            parts.append(tostring(value))
+        if vm.memory is not None:
+            vm.memory.allocate(STRING_SIZE + sum(map(len, parts)) + len(sep) * max(len(parts) - 1, 0))
+        return sep.join(parts)
+
+    def unpack(table=None, i=1, j=None, *_):
+        i = _check_int(i, 2, "unpack")
+        j = length(table) if j is None else _check_int(j, 3, "unpack")
+        if j - i >= 1_000_000:
+            raise LuaError("too many results to unpack")
+        return tuple(vm.index(table, k) for k in range(i, j + 1))
+
+    def pack(*args):
+        table = LuaTable(vm.memory)
+        for i, value in enumerate(args):
+            table.set(i + 1, value)
+        table.set("n", len(args))
+        return table
+
+    def move(a1=None, f=None, e=None, t=None, a2=None, *_):
+        _check_table(a1, 1, "move")
+        f = _check_int(f, 2, "move")
+        e = _check_int(e, 3, "move")
+        t = _check_int(t, 4, "move")
+        if a2 is None:
+            a2 = a1
+        else:
+            _check_table(a2, 5, "move")
+        if e >= f:
+            if t > e or t <= f or a1 is not a2:
+                for i in range(e - f + 1):
+                    vm.set_index(a2, t + i, vm.index(a1, f + i))
+            else:
+                for i in range(e - f, -1, -1):
+                    vm.set_index(a2, t + i, vm.index(a1, f + i))
+        return a2
+
+    def sort(table=None, comparator=None, *_):
+        _check_table(table, 1, "sort")
+        size = length(table)
+        items = [vm.index(table, i) for i in range(1, size + 1)]
+
+        if comparator is None:
+            def less(a, b):
+                return vm.less_than(a, b)
+        else:
+            def less(a, b):
+                results = vm.call(comparator, a, b)
+                return bool(results) and values.truthy(results[0])
+
+        _merge_sort(items, less)
+        for i, value in enumerate(items):
+            vm.set_index(table, i + 1, value)
+
+    return {
+        "insert": insert,
+        "remove": remove,
+        "concat": concat,
+        "unpack": unpack,
+        "pack": pack,
+        "move": move,
+        "sort": sort,
+    }
+
+
+def _merge_sort(items: list, less):
+    # Python's sort wants a key function, while Lua comparators are
+    # arbitrary 'less than' predicates, so sort by hand.
+    if len(items) <= 1:
+        return
+    middle = len(items) // 2
+    left, right = items[:middle], items[middle:]
+    _merge_sort(left, less)
+    _merge_sort(right, less)
+    i = j = k = 0
+    while i < len(left) and j < len(right):
+        if less(right[j], left[i]):
+            items[k] = right[j]
+            j += 1
+        else:
+            items[k] = left[i]
+            i += 1
+        k += 1
+    items[k:] = left[i:] + right[j:]
+
+
+def _math_lib() -> dict:
+    def floor(x=None, *_):
+        if x.__class__ is int:
+            return x
+        x = _check_number(x, 1, "floor")
+        result = math.floor(x) if math.isfinite(x) else x
+        return values.tointeger(float(result)) if values.tointeger(float(result)) is not None else float(result)
+
+    def ceil(x=None, *_):
+        if x.__class__ is int:
+            return x
+        x = _check_number(x, 1, "ceil")
+        result = math.ceil(x) if math.isfinite(x) else x
+        return values.tointeger(float(result)) if values.tointeger(float(result)) is not None else float(result)
+
+    def abs_(x=None, *_):
+        x = _check_number(x, 1, "abs")
+        return values.wrap_int(abs(x)) if x.__class__ is int else abs(x)
+
+    def max_(*args):
+        if not args:
+            raise LuaError("bad argument #1 to 'max' (number expected, got no value)")
+        result = _check_number(args[0], 1, "max")
+        for i, x in enumerate(args[1:]):
+            x = _check_number(x, i + 2, "max")
+            if x > result:
+                result = x
+        return result
+
+    def min_(*args):
+        if not args:
+            raise LuaError("bad argument #1 to 'min' (number expected, got no value)")
+        result = _check_number(args[0], 1, "min")
+        for i, x in enumerate(args[1:]):
+            x = _check_number(x, i + 2, "min")
+            if x < result:
+                result = x
+        return result
+
+    def fmod(a=None, b=None, *_):
+        a = _check_number(a, 1, "fmod")
+        b = _check_number(b, 2, "fmod")
+        if a.__class__ is int and b.__class__ is int:
+            if b == 0:
+                raise LuaError("bad argument #2 to 'fmod' (zero)")
+            return int(math.fmod(a, b))
+        return math.fmod(a, b) if b != 0 else math.nan
+
+    def math_type(x=None, *_):
+        if x.__class__ is int:
+            return "integer"
+        if x.__class__ is float:
+            return "float"
+        return None
+
+    def random_(m=None, n=None, *_):
+        if m is None:
+            return random.random()
+        m = _check_int(m, 1, "random")
+        if n is None:
+            m, n = 1, m
+        else:
+            n = _check_int(n, 2, "random")
+        if m > n:
+            raise LuaError("bad argument to 'random' (interval is empty)")
+        return random.randint(m, n)
+
+    def randomseed(seed=None, *_):
+        random.seed(seed)
+
+    def sqrt(x=None, *_):
+        x = float(_check_number(x, 1, "sqrt"))
+        return math.sqrt(x) if x >= 0 else math.nan
+
+    def log(x=None, base=None, *_):
+        x = float(_check_number(x, 1, "log"))
+        if x <= 0:
+            return -math.inf if x == 0 else math.nan
+        if base is None:
+            return math.log(x)
+        return math.log(x, float(_check_number(base, 2, "log")))
+
+    def tointeger_(x=None, *_):
+        if x.__class__ is int or x.__class__ is float:
+            return values.tointeger(x)
+        return None
+
+    def _float_function(function, name):
+        def wrapper(x=None, *_):
+            return function(float(_check_number(x, 1, name)))
+
+        return wrapper
+
+    return {
+        "floor": floor,
+        "ceil": ceil,
+        "abs": abs_,
+        "max": max_,
+        "min": min_,
+        "fmod": fmod,
+        "type": math_type,
+        "random": random_,
+        "randomseed": randomseed,
+        "sqrt": sqrt,
+        "log": log,
+        "exp": _float_function(math.exp, "exp"),
+        "sin": _float_function(math.sin, "sin"),
+        "cos": _float_function(math.cos, "cos"),
+        "tan": _float_function(math.tan, "tan"),
+        "tointeger": tointeger_,
+        "ult": lambda a, b, *_: (a & 0xFFFFFFFFFFFFFFFF) < (b & 0xFFFFFFFFFFFFFFFF),
+        "huge": math.inf,
+        "pi": math.pi,
+        "maxinteger": values.INT_MAX,
+        "mininteger": values.INT_MIN,
+    }
+
+
+def _os_lib() -> dict:
+    return {
+        "clock": lambda *_: time.process_time(),
+        "time": lambda *_: int(time.time()),
+    }
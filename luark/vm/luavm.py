@@ -1,4 +1,1427 @@
-class LuaVM:
+import inspect
+import sys
+
+from luark.compiler.program import Program, Prototype, Opcode
+from luark.vm import values
+from luark.vm.errors import LuaError
+from luark.vm.inline_cache import FieldCache, GlobalCache
+from luark.vm.memory import MemoryStats, STRING_SIZE, CLOSURE_SIZE, UPVALUE_SIZE
+from luark.vm.objects import Upvalue, LuaFunction, VMFunction, Frame, Coroutine, Task
+from luark.vm.profiler import VMProfile
+from luark.vm.table import LuaTable
+from luark.vm.values import wrap_int, lua_type, tostring
+
+# Value of Frame.expected for frames whose results go back to the host.
+_TO_HOST = -1
+# Value of Frame.expected for the bottom frame of a coroutine.
+_TO_COROUTINE = -2
+
+# Classes of Lua values, which host functions return far more often than
+# awaitables. Results of other classes are checked for being awaitable.
+_VALUE_CLASSES = frozenset((bool, int, float, str, LuaTable, LuaFunction, VMFunction, Coroutine))
+
+# Instruction budget of runs that cannot be preempted.
+_UNLIMITED = sys.maxsize
+
+_INT_MIN = values.INT_MIN
+_INT_MAX = values.INT_MAX
+
+_ARITH_EVENTS = {
+    "add": "__add",
+    "sub": "__sub",
+    "mul": "__mul",
+    "div": "__div",
+    "fdiv": "__idiv",
+    "mod": "__mod",
+    "exp": "__pow",
+    "band": "__band",
+    "bor": "__bor",
+    "bxor": "__bxor",
+    "lsh": "__shl",
+    "rsh": "__shr",
+}
+
+# Opcodes that only push a value. They are decoded into a single handler
+# with the value itself as the operand.
+_PUSH_OPCODES = (
+    Opcode.PUSH_NIL,
+    Opcode.PUSH_TRUE,
+    Opcode.PUSH_FALSE,
+    Opcode.PUSH_INT,
+    Opcode.PUSH_FLOAT,
+    Opcode.PUSH_CONST,
+)
+
+# Superinstructions with a constant index as an operand. The constant
+# itself is stored in the decoded instruction instead.
+_CONST_A_OPCODES = (Opcode.GET_FIELD, Opcode.SET_FIELD)
+_CONST_B_OPCODES = (Opcode.GET_UPVALUE_FIELD, Opcode.SET_FIELD_LOCAL, Opcode.SET_GLOBAL)
+
+
+class _Return(BaseException):
+    # Raised when a frame returns its results to the host.
+    def __init__(self, results: list):
+        super().__init__()
+        self.results = results
+
+
+class _Suspend(BaseException):
+    # Raised to suspend a script that runs in steps, see '_run_step'.
     def __init__(self):
-        self.call_stack = []
-        self.env = {}
+        super().__init__()
+        self.frame: Frame | None = None  # continues from here
+        self.current: Coroutine | None = None  # running when suspended
+
+
+class _Await(_Suspend):
+    # Raised when a host function called by a script run with 'run_async'
+    # returns an awaitable. The script is suspended until it is done.
+    def __init__(self, awaitable, expected: int):
+        super().__init__()
+        self.awaitable = awaitable
+        self.expected = expected  # result count of the call
+
+
+class _Preempt(_Suspend):
+    # Raised when a task run with 'run_slice' has used up its budget.
+    pass
+
+
+class LuaVM:
+    def __init__(
+            self,
+            stdlib: bool = True,
+            max_depth: int = 200_000,
+            preemptible: bool = False,
+            memory_limit: int | None = None,
+            track_memory: bool = False,
+    ):
+        # Memory allocated for the scripts, see memory.py. It is only
+        # counted when there is a limit or it is asked for.
+        self.memory: MemoryStats | None = None
+        if memory_limit is not None or track_memory:
+            self.memory = MemoryStats(memory_limit)
+        self.env = LuaTable(self.memory)
+        self.max_depth = max_depth
+        self.preemptible = preemptible  # counts backward jumps and calls, see 'run_slice'
+        self.stdout = sys.stdout
+        self.string_meta: LuaTable | None = None
+        self.profile: VMProfile | None = None
+
+        # The main program runs in a coroutine of its own, which cannot yield.
+        self.main_coroutine = Coroutine(None)
+        self.main_coroutine.status = "running"
+        self.current = self.main_coroutine
+        self._host_depth = 0  # VM calls made by the host which are still running
+        self._await_depth = 0  # host depth of the running 'run_async' step, if any
+
+        # Backward jumps and calls left until the running task is preempted.
+        self.budget = _UNLIMITED
+        self._slice = _UNLIMITED  # budget of the running slice
+        self._preempt_depth = 0  # host depth of the running 'run_slice' step, if any
+
+        # Decoded code of every loaded prototype.
+        self._code: dict[Prototype, list] = {}
+
+        # Dispatch table indexed by opcode.
+        self._handlers = [getattr(self, "_op_" + opcode.mnemonic) for opcode in Opcode]
+
+        if stdlib:
+            from luark.vm.lib import open_libs
+            open_libs(self)
+
+    # Loading and calling
+
+    def load(self, program: Program) -> LuaFunction:
+        for proto in program.prototypes:
+            if proto not in self._code:
+                self._code[proto] = []
+        for proto in program.prototypes:
+            code = self._code[proto]
+            if not code:
+                code.extend(self._decode(program, proto))
+
+        main = program.prototypes[0]
+        upvalues = []
+        for name in main.upvalues:
+            cells = [self.env if name == "_ENV" else None]
+            upvalues.append(Upvalue(cells, 0))
+        return LuaFunction(main, self._code[main], upvalues)
+
+    def _decode(self, program: Program, proto: Prototype) -> list:
+        handlers = self._handlers
+        code = []
+        for pc in range(len(proto)):
+            opcode, a, b = proto.decode(pc)
+            handler = handlers[opcode]
+            if opcode in _PUSH_OPCODES:
+                handler = self._op_push
+                a = self._push_value(proto, opcode, a)
+            elif opcode == Opcode.JUMP:
+                if a <= 0 and self.preemptible:
+                    handler = self._op_jump_back
+                a = pc + a  # jumps are decoded to absolute targets
+            elif opcode == Opcode.FOR_LOOP:
+                if self.preemptible:
+                    handler = self._op_for_loop_back
+                b = pc + b
+            elif opcode == Opcode.CLOSURE:
+                a = program.prototypes[a]
+            elif opcode == Opcode.GET_FIELD:
+                a = proto.consts[a]
+                b = FieldCache(a) if a.__class__ is str else None
+            elif opcode == Opcode.GET_GLOBAL:
+                b = GlobalCache(proto.consts[b])
+            elif opcode in _CONST_A_OPCODES:
+                a = proto.consts[a]
+            elif opcode in _CONST_B_OPCODES:
+                b = proto.consts[b]
+            code.append((handler, a, b))
+        return code
+
+    @staticmethod
+    def _push_value(proto: Prototype, opcode: Opcode, operand: int):
+        match opcode:
+            case Opcode.PUSH_NIL:
+                return None
+            case Opcode.PUSH_TRUE:
+                return True
+            case Opcode.PUSH_FALSE:
+                return False
+            case Opcode.PUSH_INT:
+                return operand
+            case Opcode.PUSH_FLOAT:
+                return float(operand)
+            case Opcode.PUSH_CONST:
+                return proto.consts[operand]
+
+    def run(self, program: Program, *args) -> list:
+        return self.call(self.load(program), *args)
+
+    def call(self, function, *args) -> list:
+        # Runs the function in a trampoline frame which calls it
+        # and hands all of its results back to the host.
+        frame = self._trampoline(function, list(args), None, _TO_HOST)
+        self._host_depth += 1
+        try:
+            return self._execute(frame)
+        finally:
+            self._host_depth -= 1
+
+    def _trampoline(self, function, args: list, parent: Frame | None, expected: int) -> Frame:
+        # A frame which calls the function and returns all of its results.
+        code = [(self._op_call, len(args) + 1, 0), (self._op_return, 0, 0)]
+        args.append(function)
+        return Frame(None, code, args, [], 0, parent, expected)
+
+    async def run_async(self, program: Program, *args) -> list:
+        return await self.call_async(self.load(program), *args)
+
+    async def call_async(self, function, *args) -> list:
+        # Like 'call', but host functions may return awaitables (e.g. when
+        # they are 'async def' functions). The script is suspended while
+        # one is pending and the event loop runs other tasks, possibly other
+        # scripts of the same VM, until the results of the call are there.
+        frame = self._trampoline(function, list(args), None, _TO_HOST)
+        current = Coroutine(None)  # the main coroutine of the script
+        current.status = "running"
+        error = None
+        while True:
+            try:
+                return self._run_step(frame, current, error)
+            except _Await as w:
+                frame = w.frame
+                current = w.current
+                expected = w.expected
+                awaitable = w.awaitable
+            results = None
+            error = None
+            try:
+                results = await awaitable
+            except LuaError as e:
+                error = e
+            except Exception as e:
+                error = LuaError(str(e))
+                error.__cause__ = e
+            if error is None:
+                if results is None:
+                    results = ()
+                elif results.__class__ is not tuple:
+                    results = (results,)
+                self._push_results(frame.stack, results, expected)
+
+    def start(self, function, *args) -> Task:
+        # A task which calls the function when it is run with 'run_slice'.
+        return Task(self._trampoline(function, list(args), None, _TO_HOST))
+
+    def run_slice(self, task: Task, budget: int) -> bool:
+        # Runs the task until it is done or has made 'budget' backward jumps
+        # and frame switches (calls, returns, resumes and yields), and
+        # returns whether it is done. The error of a failed task is raised
+        # and kept by the task. Only VMs created with 'preemptible' count
+        # them, so that the others do not pay for it.
+        if not self.preemptible:
+            raise RuntimeError("The VM is not preemptible.")
+        try:
+            task.results = self._run_step(task.frame, task.current, budget=budget)
+        except _Preempt as p:
+            task.frame = p.frame
+            task.current = p.current
+            return False
+        except LuaError as e:
+            task.frame = None
+            task.error = e
+            raise
+        task.frame = None
+        return True
+
+    def _run_step(
+            self,
+            frame: Frame,
+            current: Coroutine,
+            error: LuaError | None = None,
+            budget: int | None = None,
+    ) -> list:
+        # Runs a script until it returns, or is suspended. Scripts run without
+        # a budget are suspended when they await, see 'call_async', others
+        # when the budget is used up.
+        previous = self.current
+        await_depth = self._await_depth
+        preempt_depth = self._preempt_depth
+        outer_budget = self.budget
+        outer_slice = self._slice
+        self.current = current
+        self._host_depth += 1
+        if budget is None:
+            self._await_depth = self._host_depth
+            self._preempt_depth = 0
+            self.budget = self._slice = _UNLIMITED
+        else:
+            self._await_depth = 0
+            self._preempt_depth = self._host_depth
+            self.budget = self._slice = budget
+        try:
+            if error is not None:
+                frame = self._unwind(frame, error)
+            return self._execute(frame)
+        except _Suspend as s:
+            s.current = self.current
+            raise
+        finally:
+            self.current = previous
+            self._await_depth = await_depth
+            self._preempt_depth = preempt_depth
+            self.budget = outer_budget
+            self._slice = outer_slice
+            self._host_depth -= 1
+
+    def _out_of_budget(self):
+        if not self._preempt_depth:
+            self.budget = _UNLIMITED
+        elif self._host_depth == self._preempt_depth:
+            raise _Preempt()
+        elif self.budget <= -self._slice:
+            # Like yields, preemption cannot suspend a Python call of the
+            # VM. Such calls get one more slice to return in.
+            raise LuaError("instruction budget exceeded")
+
+    def start_profiling(self) -> VMProfile:
+        # Counters are kept until profiling is stopped, even across runs.
+        if self.profile is None:
+            self.profile = VMProfile()
+        return self.profile
+
+    def stop_profiling(self) -> VMProfile | None:
+        profile = self.profile
+        self.profile = None
+        return profile
+
+    def _execute(self, frame: Frame) -> list:
+        if self.profile is not None:
+            return self._execute_profiled(frame, self.profile)
+        if self.preemptible:
+            return self._execute_preemptible(frame)
+        while True:
+            try:
+                while True:
+                    handler, a, b = frame.code[frame.pc]
+                    frame.pc += 1
+                    next_frame = handler(frame, a, b)
+                    if next_frame is not None:
+                        frame = next_frame
+            except _Return as r:
+                return r.results
+            except _Suspend as s:
+                s.frame = frame
+                raise
+            except LuaError as e:
+                frame = self._unwind(frame, e)
+            except RecursionError:
+                frame = self._unwind(frame, LuaError("stack overflow"))
+            except Exception as e:
+                error = LuaError(str(e))
+                error.__cause__ = e
+                frame = self._unwind(frame, error)
+
+    def _execute_preemptible(self, frame: Frame) -> list:
+        # Same as _execute, but counts frame switches against the budget.
+        while True:
+            try:
+                while True:
+                    handler, a, b = frame.code[frame.pc]
+                    frame.pc += 1
+                    next_frame = handler(frame, a, b)
+                    if next_frame is not None:
+                        frame = next_frame
+                        self.budget -= 1
+                        if self.budget <= 0:
+                            self._out_of_budget()
+            except _Return as r:
+                return r.results
+            except _Suspend as s:
+                s.frame = frame
+                raise
+            except LuaError as e:
+                frame = self._unwind(frame, e)
+            except RecursionError:
+                frame = self._unwind(frame, LuaError("stack overflow"))
+            except Exception as e:
+                error = LuaError(str(e))
+                error.__cause__ = e
+                frame = self._unwind(frame, error)
+
+    def _execute_profiled(self, frame: Frame, profile: VMProfile) -> list:
+        # Same as _execute, but counts every instruction and
+        # lets the profile know when another frame takes over.
+        base = profile.depth
+        profile.switch(frame, base)
+        try:
+            while True:
+                counts = profile.counters(frame)
+                try:
+                    while True:
+                        pc = frame.pc
+                        handler, a, b = frame.code[pc]
+                        counts[pc] += 1
+                        frame.pc = pc + 1
+                        next_frame = handler(frame, a, b)
+                        if next_frame is not None:
+                            frame = next_frame
+                            profile.switch(frame, base)
+                            counts = profile.counters(frame)
+                            if self.preemptible:
+                                self.budget -= 1
+                                if self.budget <= 0:
+                                    self._out_of_budget()
+                except _Return as r:
+                    return r.results
+                except _Suspend as s:
+                    s.frame = frame
+                    raise
+                except LuaError as e:
+                    frame = self._unwind(frame, e)
+                except RecursionError:
+                    frame = self._unwind(frame, LuaError("stack overflow"))
+                except Exception as e:
+                    error = LuaError(str(e))
+                    error.__cause__ = e
+                    frame = self._unwind(frame, error)
+                profile.switch(frame, base)
+        finally:
+            profile.finish(base)
+
+    def _unwind(self, frame: Frame, error: LuaError) -> Frame:
+        # Finds the innermost protected call and delivers the error
+        # to its caller. Errors without one propagate to the host,
+        # or end the coroutine they were raised in. The to-be-closed
+        # variables of the frames it leaves are closed on the way.
+        while frame is not None:
+            if frame.tbc:
+                error = self._close_variables(frame, error)
+            if frame.protected:
+                break
+            if frame.expected == _TO_COROUTINE:
+                return self._fail_coroutine(error)
+            frame = frame.parent
+        if frame is None:
+            raise error
+        caller = frame.parent
+        self._push_results(caller.stack, [False, error.value], frame.expected)
+        return caller
+
+    # To-be-closed variables
+
+    def _close(self, value, error):
+        handler = self.get_metamethod(value, "__close")
+        if handler is None:
+            raise LuaError("attempt to call a nil value (metamethod 'close')")
+        self.call(handler, value, error)
+
+    def _close_variables(self, frame: Frame, error: LuaError | None) -> LuaError | None:
+        # Closes all variables of the frame after an error. An error in a
+        # '__close' metamethod replaces the one the others are closed with.
+        tbc = frame.tbc
+        while tbc:
+            try:
+                self._close(tbc.pop()[1], error.value if error is not None else None)
+            except LuaError as e:
+                error = e
+        return error
+
+    def close_coroutine(self, co: Coroutine) -> LuaError | None:
+        # Called by 'coroutine.close'. Closes the variables of a suspended
+        # coroutine and returns the error of a '__close' metamethod, if any.
+        frame = co.frame
+        co.status = "dead"
+        co.function = co.frame = None
+        error = None
+        while frame is not None:
+            if frame.tbc:
+                error = self._close_variables(frame, error)
+            if frame.expected == _TO_COROUTINE:
+                break
+            frame = frame.parent
+        return error
+
+    @staticmethod
+    def _local_name(frame: Frame, index: int) -> str:
+        # Temporaries may share the slot, the only one marked is the
+        # closing value of a generic for.
+        pc = frame.pc - 1
+        name = "?"
+        for var in frame.function.proto.locals:
+            if var.index == index and var.start <= pc and (var.end is None or pc <= var.end):
+                if var.name:
+                    return var.name
+                name = "(for state)"
+        return name
+
+    # Calls
+
+    @staticmethod
+    def _push_results(stack: list, results: list | tuple, expected: int):
+        if expected > 0:
+            n = expected - 1
+            count = len(results)
+            if count == n:
+                stack.extend(results)
+            elif count > n:
+                stack.extend(results[:n])
+            else:
+                stack.extend(results)
+                stack.extend([None] * (n - count))
+        else:
+            stack.extend(results)
+            stack.append(len(results))
+
+    def _call_value(self, frame: Frame, function, args: list, expected: int) -> Frame | None:
+        cls = function.__class__
+        if cls is LuaFunction:
+            proto = function.proto
+            fixed = proto.fixed_params
+            if len(args) > fixed:
+                varargs = args[fixed:] if proto.is_variadic else []
+                del args[fixed:]
+            else:
+                varargs = []
+                if len(args) < fixed:
+                    args.extend([None] * (fixed - len(args)))
+            new_frame = Frame(function, function.code, args, varargs, proto.num_locals, frame, expected)
+            if new_frame.depth > self.max_depth:
+                raise LuaError("stack overflow")
+            return new_frame
+        elif cls is VMFunction:
+            return function.function(self, frame, args, expected)
+        elif callable(function) and cls is not LuaTable:
+            results = function(*args)
+            if results is None:
+                results = ()
+            elif results.__class__ is not tuple:
+                if results.__class__ not in _VALUE_CLASSES and inspect.isawaitable(results):
+                    self._await(results, expected)
+                results = (results,)
+            self._push_results(frame.stack, results, expected)
+            return None
+        else:
+            handler = self.get_metamethod(function, "__call")
+            if handler is None:
+                raise LuaError(f"attempt to call a {lua_type(function)} value")
+            args.insert(0, function)
+            return self._call_value(frame, handler, args, expected)
+
+    def _await(self, awaitable, expected: int):
+        if self._host_depth != self._await_depth:
+            if inspect.iscoroutine(awaitable):
+                awaitable.close()  # never awaited
+            if not self._await_depth:
+                raise LuaError("attempt to await outside run_async")
+            # Like yields, awaits cannot suspend a Python call of the VM.
+            raise LuaError("attempt to await across a C-call boundary")
+        raise _Await(awaitable, expected)
+
+    # Coroutines. Switching to another coroutine is only a matter of
+    # continuing with another frame, so they never use the Python stack.
+
+    def resume(self, co: Coroutine, frame: Frame, args: list, expected: int, wrapped: bool = False) -> Frame | None:
+        # Called by 'coroutine.resume' and by functions made by 'coroutine.wrap'.
+        if co.status != "suspended":
+            message = f"cannot resume {'dead' if co.status == 'dead' else 'non-suspended'} coroutine"
+            if wrapped:
+                raise LuaError(message)
+            self._push_results(frame.stack, [False, message], expected)
+            return None
+
+        co.status = "running"
+        co.caller = frame
+        co.caller_expected = expected
+        co.wrapped = wrapped
+        co.previous = self.current
+        co.previous.status = "normal"
+        co.host_depth = self._host_depth
+        self.current = co
+
+        if co.frame is not None:
+            resumed = co.frame
+            co.frame = None
+            self._push_results(resumed.stack, args, co.resume_expected)
+            return resumed
+
+        function = co.function
+        co.function = None
+        if function.__class__ is LuaFunction:
+            return self._call_value(None, function, args, _TO_COROUTINE)
+        # Other functions run to completion, they cannot yield.
+        try:
+            results = self.call(function, *args)
+        except LuaError as e:
+            return self._fail_coroutine(e)
+        co.status = "dead"
+        return self._leave_coroutine(results)
+
+    def yield_(self, frame: Frame, args: list, expected: int) -> Frame:
+        co = self.current
+        if co.caller is None:  # the main coroutine of a script
+            raise LuaError("attempt to yield from outside a coroutine")
+        if self._host_depth != co.host_depth:
+            # The frames of the host call are executed by a Python call
+            # of the VM, which cannot be suspended.
+            raise LuaError("attempt to yield across a C-call boundary")
+        co.status = "suspended"
+        co.frame = frame
+        co.resume_expected = expected
+        return self._leave_coroutine(args)
+
+    def _leave_coroutine(self, results: list) -> Frame:
+        # The running coroutine yields or returns, and its resumer continues.
+        co = self.current
+        caller = co.caller
+        self.current = co.previous
+        self.current.status = "running"
+        co.caller = co.previous = None
+        if not co.wrapped:
+            results.insert(0, True)
+        self._push_results(caller.stack, results, co.caller_expected)
+        return caller
+
+    def _fail_coroutine(self, error: LuaError) -> Frame:
+        co = self.current
+        co.status = "dead"
+        caller = co.caller
+        self.current = co.previous
+        self.current.status = "running"
+        co.caller = co.previous = None
+        if co.wrapped:
+            return self._unwind(caller, error)
+        self._push_results(caller.stack, [False, error.value], co.caller_expected)
+        return caller
+
+    # Metatables
+
+    def get_metatable(self, value) -> LuaTable | None:
+        cls = value.__class__
+        if cls is LuaTable:
+            return value.metatable
+        if cls is str:
+            return self.string_meta
+        return None
+
+    def get_metamethod(self, value, event: str):
+        meta = self.get_metatable(value)
+        if meta is None:
+            return None
+        return meta.get(event)
+
+    def index(self, obj, key):
+        for _ in range(2000):
+            if obj.__class__ is LuaTable:
+                value = obj.get(key)
+                if value is not None:
+                    return value
+                meta = obj.metatable
+                if meta is None:
+                    return None
+                handler = meta.get("__index")
+                if handler is None:
+                    return None
+            else:
+                handler = self.get_metamethod(obj, "__index")
+                if handler is None:
+                    raise LuaError(f"attempt to index a {lua_type(obj)} value")
+
+            if handler.__class__ is LuaTable or handler.__class__ is str:
+                obj = handler
+            else:
+                results = self.call(handler, obj, key)
+                return results[0] if results else None
+        raise LuaError("'__index' chain too long; possible loop")
+
+    def set_index(self, obj, key, value):
+        for _ in range(2000):
+            if obj.__class__ is LuaTable:
+                meta = obj.metatable
+                if meta is None or obj.get(key) is not None:
+                    obj.set(key, value)
+                    return
+                handler = meta.get("__newindex")
+                if handler is None:
+                    obj.set(key, value)
+                    return
+            else:
+                handler = self.get_metamethod(obj, "__newindex")
+                if handler is None:
+                    raise LuaError(f"attempt to index a {lua_type(obj)} value")
+
+            if handler.__class__ is LuaTable:
+                obj = handler
+            else:
+                self.call(handler, obj, key, value)
+                return
+        raise LuaError("'__newindex' chain too long; possible loop")
+
+    def _call_metamethod(self, event: str, a, b):
+        handler = self.get_metamethod(a, event)
+        if handler is None:
+            handler = self.get_metamethod(b, event)
+            if handler is None:
+                return NotImplemented
+        results = self.call(handler, a, b)
+        return results[0] if results else None
+
+    def arith(self, op: str, a, b):
+        result = values.arith_int_or_float(op, a, b)
+        if result is NotImplemented:
+            result = self._call_metamethod(_ARITH_EVENTS[op], a, b)
+            if result is NotImplemented:
+                culprit = b if values.tonumber(a) is not None else a
+                kind = "perform arithmetic on"
+                raise LuaError(f"attempt to {kind} a {lua_type(culprit)} value")
+        return result
+
+    def bitwise(self, op: str, a, b):
+        x = values.to_bit_int(a)
+        y = values.to_bit_int(b)
+        if x is None or y is None:
+            result = self._call_metamethod(_ARITH_EVENTS[op], a, b)
+            if result is NotImplemented:
+                culprit = b if x is not None else a
+                raise LuaError(f"attempt to perform bitwise operation on a {lua_type(culprit)} value")
+            return result
+        return values.bitwise(op, x, y)
+
+    def equals(self, a, b) -> bool:
+        ca, cb = a.__class__, b.__class__
+        if ca is cb:
+            if a == b:
+                return True
+            if ca is LuaTable:
+                result = self._call_metamethod("__eq", a, b)
+                return result is not NotImplemented and values.truthy(result)
+            return False
+        if (ca is int and cb is float) or (ca is float and cb is int):
+            return a == b
+        return False
+
+    def less_than(self, a, b) -> bool:
+        ca, cb = a.__class__, b.__class__
+        if (ca is int or ca is float) and (cb is int or cb is float):
+            return a < b
+        if ca is str and cb is str:
+            return a < b
+        result = self._call_metamethod("__lt", a, b)
+        if result is NotImplemented:
+            self._compare_error(a, b)
+        return values.truthy(result)
+
+    def less_equal(self, a, b) -> bool:
+        ca, cb = a.__class__, b.__class__
+        if (ca is int or ca is float) and (cb is int or cb is float):
+            return a <= b
+        if ca is str and cb is str:
+            return a <= b
+        result = self._call_metamethod("__le", a, b)
+        if result is NotImplemented:
+            self._compare_error(a, b)
+        return values.truthy(result)
+
+    @staticmethod
+    def _compare_error(a, b):
+        ta, tb = lua_type(a), lua_type(b)
+        if ta == tb:
+            raise LuaError(f"attempt to compare two {ta} values")
+        raise LuaError(f"attempt to compare {ta} with {tb}")
+
+    def concat(self, a, b):
+        ca, cb = a.__class__, b.__class__
+        if (ca is str or ca is int or ca is float) and (cb is str or cb is int or cb is float):
+            a = tostring(a)
+            b = tostring(b)
+            if self.memory is not None:
+                self.memory.allocate(STRING_SIZE + len(a) + len(b))
+            return a + b
+        result = self._call_metamethod("__concat", a, b)
+        if result is NotImplemented:
+            culprit = b if (ca is str or ca is int or ca is float) else a
+            raise LuaError(f"attempt to concatenate a {lua_type(culprit)} value")
+        return result
+
+    def length(self, value):
+        cls = value.__class__
+        if cls is str:
+            return len(value)
+        handler = self.get_metamethod(value, "__len")
+        if handler is not None:
+            results = self.call(handler, value)
+            return results[0] if results else None
+        if cls is LuaTable:
+            return value.length()
+        raise LuaError(f"attempt to get length of a {lua_type(value)} value")
+
+    def tostring(self, value) -> str:
+        handler = self.get_metamethod(value, "__tostring")
+        if handler is not None:
+            results = self.call(handler, value)
+            result = results[0] if results else None
+            if result.__class__ is not str:
+                raise LuaError("'__tostring' must return a string")
+            return result
+        meta = self.get_metatable(value)
+        if meta is not None:
+            name = meta.get("__name")
+            if name.__class__ is str:
+                return f"{name}: 0x{id(value):08x}"
+        return tostring(value)
+
+    # Opcode handlers. Each one receives the current frame and the two
+    # decoded operands, and returns the frame to continue with if it
+    # transfers control to another function.
+
+    def _op_push(self, frame: Frame, a, b):
+        frame.stack.append(a)
+
+    _op_push_nil = _op_push_true = _op_push_false = _op_push
+    _op_push_int = _op_push_float = _op_push_const = _op_push
+
+    def _op_load_local(self, frame: Frame, a, b):
+        frame.stack.append(frame.locals[a])
+
+    def _op_store_local(self, frame: Frame, a, b):
+        frame.locals[a] = frame.stack.pop()
+
+    def _op_load_upvalue(self, frame: Frame, a, b):
+        upvalue = frame.upvalues[a]
+        frame.stack.append(upvalue.cells[upvalue.index])
+
+    _op_get_upvalue = _op_load_upvalue
+
+    def _op_store_upvalue(self, frame: Frame, a, b):
+        upvalue = frame.upvalues[a]
+        upvalue.cells[upvalue.index] = frame.stack.pop()
+
+    def _op_get_varargs(self, frame: Frame, a, b):
+        self._push_results(frame.stack, frame.varargs, a)
+
+    def _op_mark_tbc(self, frame: Frame, a, b):
+        value = frame.locals[a]
+        if value is None or value is False:
+            return
+        if self.get_metamethod(value, "__close") is None:
+            raise LuaError(f"variable '{self._local_name(frame, a)}' got a non-closable value")
+        if frame.tbc is None:
+            frame.tbc = []
+        frame.tbc.append((a, value))
+
+    def _op_close(self, frame: Frame, a, b):
+        # The local goes out of scope: close it if it is to be closed,
+        # and give its upvalue a cell of its own.
+        tbc = frame.tbc
+        if tbc and tbc[-1][0] == a:
+            self._close(tbc.pop()[1], None)
+        opened = frame.open_upvalues
+        if opened is not None:
+            upvalue = opened.pop(a, None)
+            if upvalue is not None:
+                upvalue.cells = [frame.locals[a]]
+                upvalue.index = 0
+
+    def _op_pop(self, frame: Frame, a, b):
+        frame.stack.pop()
+
+    def _op_create_table(self, frame: Frame, a, b):
+        frame.stack.append(LuaTable(self.memory))
+
+    def _op_get_table(self, frame: Frame, a, b):
+        stack = frame.stack
+        key = stack.pop()
+        table = stack[-1]
+        if table.__class__ is LuaTable:
+            value = table.get(key)
+            if value is None and table.metatable is not None:
+                value = self.index(table, key)
+            stack[-1] = value
+        else:
+            stack[-1] = self.index(table, key)
+
+    def _op_set_table(self, frame: Frame, a, b):
+        stack = frame.stack
+        key = stack.pop()
+        table = stack.pop()
+        value = stack.pop()
+        if table.__class__ is LuaTable and table.metatable is None:
+            table.set(key, value)
+        else:
+            self.set_index(table, key, value)
+
+    def _op_store_list(self, frame: Frame, a, b):
+        stack = frame.stack
+        table = stack.pop()
+        if a > 0:
+            table.set(b, stack.pop())
+        else:
+            count = stack.pop()
+            items = stack[-count:] if count else []
+            del stack[-count:]
+            for i, item in enumerate(items):
+                table.set(b + i, item)
+
+    def _op_closure(self, frame: Frame, a: Prototype, b):
+        upvalues = []
+        for in_stack, index in a.upvalue_sources:
+            if in_stack:
+                opened = frame.open_upvalues
+                if opened is None:
+                    opened = frame.open_upvalues = {}
+                upvalue = opened.get(index)
+                if upvalue is None:
+                    if self.memory is not None:
+                        self.memory.allocate(UPVALUE_SIZE)
+                    upvalue = opened[index] = Upvalue(frame.locals, index)
+                upvalues.append(upvalue)
+            else:
+                upvalues.append(frame.upvalues[index])
+        if self.memory is not None:
+            self.memory.allocate(CLOSURE_SIZE)
+        frame.stack.append(LuaFunction(a, self._code[a], upvalues))
+
+    def _op_call(self, frame: Frame, a, b):
+        stack = frame.stack
+        function = stack.pop()
+        if a > 0:
+            count = a - 1
+        else:
+            count = stack.pop() - a  # values of the multires expression plus fixed ones
+        if count:
+            args = stack[-count:]
+            del stack[-count:]
+        else:
+            args = []
+        return self._call_value(frame, function, args, b)
+
+    def _op_tail_call(self, frame: Frame, a, b):
+        # A Lua function called in tail position replaces the calling frame,
+        # so tail recursion runs in constant space. Locals captured by
+        # closures stay alive, since frames never reuse their locals. Other
+        # callees are called like with 'call', and the 'return 0' after this
+        # instruction passes their results on.
+        stack = frame.stack
+        function = stack.pop()
+        if a > 0:
+            count = a - 1
+        else:
+            count = stack.pop() - a
+        if count:
+            args = stack[-count:]
+            del stack[-count:]
+        else:
+            args = []
+        if function.__class__ is not LuaFunction or frame.tbc:
+            # The variables of the frame are closed by the return, e.g.
+            # the closing value of a generic for.
+            return self._call_value(frame, function, args, 0)
+        new_frame = self._call_value(frame.parent, function, args, frame.expected)
+        new_frame.protected = frame.protected
+        return new_frame
+
+    def _op_return(self, frame: Frame, a, b):
+        stack = frame.stack
+        if a > 0:
+            count = a - 1
+        else:
+            count = stack.pop() - a
+        results = stack[-count:] if count else []
+        tbc = frame.tbc
+        while tbc:
+            self._close(tbc.pop()[1], None)
+        if frame.protected:
+            results.insert(0, True)
+
+        expected = frame.expected
+        if expected < 0:
+            if expected == _TO_HOST:
+                raise _Return(results)
+            self.current.status = "dead"
+            return self._leave_coroutine(results)
+        parent = frame.parent
+        self._push_results(parent.stack, results, expected)
+        return parent
+
+    def _op_jump(self, frame: Frame, a, b):
+        frame.pc = a
+
+    def _op_test(self, frame: Frame, a, b):
+        value = frame.stack.pop()
+        if value is not None and value is not False:
+            frame.pc += 1
+
+    def _op_test_nil(self, frame: Frame, a, b):
+        if frame.stack.pop() is not None:
+            frame.pc += 1
+
+    def _op_test_set(self, frame: Frame, a, b):
+        # Leaves the value for the jump that follows if its truthiness
+        # is 'a', otherwise pops it and skips the jump.
+        stack = frame.stack
+        value = stack[-1]
+        if (value is not None and value is not False) != a:
+            stack.pop()
+            frame.pc += 1
+
+    def _op_prepare_for_num(self, frame: Frame, a, b):
+        # Sets up the loop variables and either enters the body by skipping
+        # the exit jump that follows, or exits the loop.
+        stack = frame.stack
+        step = stack.pop()
+        limit = stack.pop()
+        initial = stack.pop()
+        local_vars = frame.locals
+
+        if initial.__class__ is int and step.__class__ is int:
+            if step == 0:
+                raise LuaError("'for' step is zero")
+            limit = self._for_limit(limit, step)
+            if limit is None or (initial > limit if step > 0 else initial < limit):
+                return
+            # Integer loops precompute the iteration count, so the
+            # control variable never overflows.
+            local_vars[a] = initial
+            local_vars[a + 1] = (limit - initial) // step
+            local_vars[a + 2] = step
+            local_vars[a + 3] = initial
+            frame.pc += 1
+        else:
+            initial = self._for_number(initial, "initial")
+            limit = self._for_number(limit, "limit")
+            step = self._for_number(step, "step")
+            if step == 0:
+                raise LuaError("'for' step is zero")
+            if initial <= limit if step > 0 else initial >= limit:
+                local_vars[a] = local_vars[a + 3] = float(initial)
+                local_vars[a + 1] = float(limit)
+                local_vars[a + 2] = float(step)
+                frame.pc += 1
+
+    @staticmethod
+    def _for_number(value, what: str) -> int | float:
+        if value.__class__ is int or value.__class__ is float:
+            return value
+        raise LuaError(f"'for' {what} value must be a number")
+
+    @staticmethod
+    def _for_limit(limit, step: int) -> int | None:
+        if limit.__class__ is int:
+            return limit
+        if limit.__class__ is not float:
+            raise LuaError("'for' limit must be a number")
+        if limit != limit:
+            return None
+        if step > 0:
+            return _INT_MAX if limit >= 2.0 ** 63 else (int(limit // 1) if limit > _INT_MIN else None)
+        return _INT_MIN if limit < -2.0 ** 63 else (-int(-limit // 1) if limit < _INT_MAX else None)
+
+    def _op_for_loop(self, frame: Frame, a, b):
+        # Advances the loop and jumps back to the start of the body
+        # if it continues. Integer loops count down the iterations
+        # left, float loops compare the index with the limit.
+        local_vars = frame.locals
+        count = local_vars[a + 1]
+        if count.__class__ is int:
+            if count:
+                local_vars[a + 1] = count - 1
+                local_vars[a] = local_vars[a + 3] = local_vars[a + 3] + local_vars[a + 2]
+                frame.pc = b
+        else:
+            step = local_vars[a + 2]
+            value = local_vars[a + 3] + step
+            if value <= count if step > 0 else value >= count:
+                local_vars[a] = local_vars[a + 3] = value
+                frame.pc = b
+
+    def _op_prepare_for_gen(self, frame: Frame, a, b):
+        stack = frame.stack
+        local_vars = frame.locals
+        local_vars[a + 3] = stack.pop()  # closing value
+        local_vars[a + 2] = stack.pop()  # control
+        local_vars[a + 1] = stack.pop()  # state
+        local_vars[a] = stack.pop()  # iterator
+
+    # Backward jumps of preemptible VMs, they count against the budget.
+
+    def _op_jump_back(self, frame: Frame, a, b):
+        frame.pc = a
+        self.budget -= 1
+        if self.budget <= 0:
+            self._out_of_budget()
+
+    def _op_for_loop_back(self, frame: Frame, a, b):
+        self._op_for_loop(frame, a, b)
+        if frame.pc == b:
+            self.budget -= 1
+            if self.budget <= 0:
+                self._out_of_budget()
+
+    # Superinstructions
+
+    def _op_get_field(self, frame: Frame, a, b: FieldCache | None):
+        stack = frame.stack
+        table = stack[-1]
+        if table.__class__ is LuaTable:
+            value = table.get(a)
+            if value is None and table.metatable is not None:
+                value = self.index(table, a) if b is None else self._index_cached(b, table, table.metatable)
+            stack[-1] = value
+        elif table.__class__ is str and b is not None:
+            stack[-1] = self._index_cached(b, table, self.string_meta)
+        else:
+            stack[-1] = self.index(table, a)
+
+    def _index_cached(self, cache: FieldCache, obj, meta: LuaTable | None):
+        # Looks the field up through the metatable of 'obj', which
+        # does not have it itself (or is a string).
+        if meta is None:
+            return self.index(obj, cache.key)
+        value = cache.lookup(meta)
+        if value is NotImplemented:
+            value = cache.fill(meta)
+            if value is NotImplemented:
+                return self.index(obj, cache.key)
+        return value
+
+    def inline_cache_stats(self) -> list[dict]:
+        # Hits and misses of every cache that has been used, busiest first.
+        stats = []
+        for proto, code in self._code.items():
+            for pc, (_, _, cache) in enumerate(code):
+                if (cache.__class__ is FieldCache or cache.__class__ is GlobalCache) and (cache.hits or cache.misses):
+                    stats.append({
+                        "function": proto.func_name,
+                        "pc": pc,
+                        "key": cache.key,
+                        "hits": cache.hits,
+                        "misses": cache.misses,
+                    })
+        stats.sort(key=lambda item: item["hits"] + item["misses"], reverse=True)
+        return stats
+
+    def _op_get_upvalue_field(self, frame: Frame, a, b):
+        upvalue = frame.upvalues[a]
+        table = upvalue.cells[upvalue.index]
+        if table.__class__ is LuaTable:
+            value = table.get(b)
+            if value is None and table.metatable is not None:
+                value = self.index(table, b)
+        else:
+            value = self.index(table, b)
+        frame.stack.append(value)
+
+    def _op_set_field(self, frame: Frame, a, b):
+        stack = frame.stack
+        table = stack.pop()
+        value = stack.pop()
+        if table.__class__ is LuaTable and table.metatable is None:
+            table.set(a, value)
+        else:
+            self.set_index(table, a, value)
+
+    def _op_set_field_local(self, frame: Frame, a, b):
+        table = frame.locals[a]
+        value = frame.stack.pop()
+        if table.__class__ is LuaTable and table.metatable is None:
+            table.set(b, value)
+        else:
+            self.set_index(table, b, value)
+
+    def _op_store_list_local(self, frame: Frame, a, b):
+        frame.locals[a].set(b, frame.stack.pop())
+
+    def _op_load_local_const_add(self, frame: Frame, a, b):
+        value = frame.locals[a]
+        if value.__class__ is int:
+            result = value + b
+            frame.stack.append(result if _INT_MIN <= result <= _INT_MAX else wrap_int(result))
+        elif value.__class__ is float:
+            frame.stack.append(value + b)
+        else:
+            frame.stack.append(self.arith("add", value, b))
+
+    def _op_load_local_const_sub(self, frame: Frame, a, b):
+        value = frame.locals[a]
+        if value.__class__ is int:
+            result = value - b
+            frame.stack.append(result if _INT_MIN <= result <= _INT_MAX else wrap_int(result))
+        elif value.__class__ is float:
+            frame.stack.append(value - b)
+        else:
+            frame.stack.append(self.arith("sub", value, b))
+
+    def _op_load_locals(self, frame: Frame, a, b):
+        local_vars = frame.locals
+        stack = frame.stack
+        stack.append(local_vars[a])
+        stack.append(local_vars[b])
+
+    # Globals
+
+    def _op_get_global(self, frame: Frame, a, b: GlobalCache):
+        upvalue = frame.upvalues[a]
+        env = upvalue.cells[upvalue.index]
+        if env is b.env and env.version == b.version:
+            b.hits += 1
+            frame.stack.append(b.value)
+            return
+
+        b.misses += 1
+        if env.__class__ is LuaTable:
+            value = env.hash.get(b.key)
+            if value is None and env.metatable is not None:
+                # The result of '__index' is not cached.
+                b.env = None
+                frame.stack.append(self.index(env, b.key))
+                return
+            b.env = env
+            b.version = env.version
+            b.value = value
+        else:
+            value = self.index(env, b.key)
+        frame.stack.append(value)
+
+    def _op_set_global(self, frame: Frame, a, b):
+        upvalue = frame.upvalues[a]
+        env = upvalue.cells[upvalue.index]
+        value = frame.stack.pop()
+        if env.__class__ is LuaTable and env.metatable is None:
+            env.set(b, value)
+        else:
+            self.set_index(env, b, value)
+
+    # Binary operations. The right operand is on top of the stack.
+
+    def _op_eq(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        cls = left.__class__
+        if cls is right.__class__ and cls is not LuaTable:
+            stack[-1] = left == right
+        else:
+            stack[-1] = self.equals(left, right)
+
+    def _op_neq(self, frame: Frame, a, b):
+        self._op_eq(frame, a, b)
+        frame.stack[-1] = not frame.stack[-1]
+
+    def _op_lt(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is int and right.__class__ is int:
+            stack[-1] = left < right
+        else:
+            stack[-1] = self.less_than(left, right)
+
+    def _op_le(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is int and right.__class__ is int:
+            stack[-1] = left <= right
+        else:
+            stack[-1] = self.less_equal(left, right)
+
+    def _op_gt(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is int and right.__class__ is int:
+            stack[-1] = left > right
+        else:
+            stack[-1] = self.less_than(right, left)
+
+    def _op_ge(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is int and right.__class__ is int:
+            stack[-1] = left >= right
+        else:
+            stack[-1] = self.less_equal(right, left)
+
+    def _op_add(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is int and right.__class__ is int:
+            result = left + right
+            stack[-1] = result if _INT_MIN <= result <= _INT_MAX else wrap_int(result)
+        elif left.__class__ is float and right.__class__ is float:
+            stack[-1] = left + right
+        else:
+            stack[-1] = self.arith("add", left, right)
+
+    def _op_sub(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is int and right.__class__ is int:
+            result = left - right
+            stack[-1] = result if _INT_MIN <= result <= _INT_MAX else wrap_int(result)
+        elif left.__class__ is float and right.__class__ is float:
+            stack[-1] = left - right
+        else:
+            stack[-1] = self.arith("sub", left, right)
+
+    def _op_mul(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is int and right.__class__ is int:
+            result = left * right
+            stack[-1] = result if _INT_MIN <= result <= _INT_MAX else wrap_int(result)
+        elif left.__class__ is float and right.__class__ is float:
+            stack[-1] = left * right
+        else:
+            stack[-1] = self.arith("mul", left, right)
+
+    def _op_div(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        stack[-1] = self.arith("div", stack[-1], right)
+
+    def _op_fdiv(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        stack[-1] = self.arith("fdiv", stack[-1], right)
+
+    def _op_mod(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is int and right.__class__ is int and right != 0:
+            stack[-1] = left % right
+        else:
+            stack[-1] = self.arith("mod", left, right)
+
+    def _op_exp(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        stack[-1] = self.arith("exp", stack[-1], right)
+
+    def _op_concat(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        left = stack[-1]
+        if left.__class__ is str and right.__class__ is str:
+            if self.memory is not None:
+                self.memory.allocate(STRING_SIZE + len(left) + len(right))
+            stack[-1] = left + right
+        else:
+            stack[-1] = self.concat(left, right)
+
+    def _op_band(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        stack[-1] = self.bitwise("band", stack[-1], right)
+
+    def _op_bor(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        stack[-1] = self.bitwise("bor", stack[-1], right)
+
+    def _op_bxor(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        stack[-1] = self.bitwise("bxor", stack[-1], right)
+
+    def _op_lsh(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        stack[-1] = self.bitwise("lsh", stack[-1], right)
+
+    def _op_rsh(self, frame: Frame, a, b):
+        stack = frame.stack
+        right = stack.pop()
+        stack[-1] = self.bitwise("rsh", stack[-1], right)
+
+    # Unary operations
+
+    def _op_negate(self, frame: Frame, a, b):
+        stack = frame.stack
+        value = stack[-1]
+        if value.__class__ is int:
+            stack[-1] = wrap_int(-value)
+        elif value.__class__ is float:
+            stack[-1] = -value
+        else:
+            number = values.tonumber(value) if value.__class__ is str else None
+            if number is not None:
+                stack[-1] = wrap_int(-number) if number.__class__ is int else -number
+                return
+            handler = self.get_metamethod(value, "__unm")
+            if handler is None:
+                raise LuaError(f"attempt to perform arithmetic on a {lua_type(value)} value")
+            results = self.call(handler, value, value)
+            stack[-1] = results[0] if results else None
+
+    def _op_not(self, frame: Frame, a, b):
+        stack = frame.stack
+        value = stack[-1]
+        stack[-1] = value is None or value is False
+
+    def _op_len(self, frame: Frame, a, b):
+        stack = frame.stack
+        value = stack[-1]
+        if value.__class__ is LuaTable and value.metatable is None:
+            stack[-1] = value.length()
+        else:
+            stack[-1] = self.length(value)
+
+    def _op_bnot(self, frame: Frame, a, b):
+        stack = frame.stack
+        value = stack[-1]
+        number = values.to_bit_int(value)
+        if number is not None:
+            stack[-1] = wrap_int(~number)
+            return
+        handler = self.get_metamethod(value, "__bnot")
+        if handler is None:
+            raise LuaError(f"attempt to perform bitwise operation on a {lua_type(value)} value")
+        results = self.call(handler, value, value)
+        stack[-1] = results[0] if results else None
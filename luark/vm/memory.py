@@ -0,0 +1,122 @@
+import gc
+import weakref
+from typing import Any
+
+from luark.vm.errors import LuaError
+from luark.vm.objects import LuaFunction, Coroutine
+from luark.vm.table import LuaTable, TABLE_SIZE, SLOT_SIZE, ENTRY_SIZE
+
+# Approximate accounting of the memory a VM allocates for its scripts. Tables,
+# closures, coroutines and the strings made by concatenation and repetition
+# are counted when they are made, and tables again whenever they get a new
+# field. The VM keeps a weak reference to each of its tables, along with how
+# much it counted for it: removed fields are taken off the count at once, and
+# the whole table when it is freed. Other frees go unnoticed until the count
+# would exceed the limit: the VM then counts again what its live tables hold,
+# and if that is still too much, collects garbage to free unreachable cycles,
+# much like Lua runs a full collection before it gives up on an allocation.
+# Values that are only held by locals are not counted by such a recount.
+
+# Approximate sizes in bytes, along with the ones in table.py.
+STRING_SIZE = 49  # plus one per character
+CLOSURE_SIZE = 120
+UPVALUE_SIZE = 112
+COROUTINE_SIZE = 350  # with a frame
+
+
+class _TableRef(weakref.ref):
+    __slots__ = ("size",)  # counted for the table
+
+
+class MemoryStats:
+    def __init__(self, limit: int | None = None):
+        self.limit = limit  # in bytes, None for no limit
+        self.allocated = 0  # counted by the last recount and since then
+        self.peak = 0
+        self.collections = 0  # recounts
+        self.errors = 0  # allocations that were refused
+        self._tables: set[_TableRef] = set()  # of the VM
+
+    def allocate(self, size: int):
+        # Called before the memory is allocated. The limit only needs to be
+        # checked when the count exceeds the peak, which never exceeds it.
+        allocated = self.allocated + size
+        if allocated > self.peak:
+            if self.limit is not None and allocated > self.limit:
+                allocated = self.collect(self.limit - size) + size
+                if allocated > self.limit:
+                    self.errors += 1
+                    raise LuaError("not enough memory")
+            if allocated > self.peak:
+                self.peak = allocated
+        self.allocated = allocated
+
+    def add_table(self, table: LuaTable):
+        # The reference is kept by the table too, so that its count can be
+        # changed along with the table.
+        self.allocate(TABLE_SIZE)
+        ref = _TableRef(table, self._free)
+        ref.size = TABLE_SIZE
+        self._tables.add(ref)
+        table.memory_ref = ref
+
+    def shrink(self, table: LuaTable, size: int):
+        self.allocated -= size
+        table.memory_ref.size -= size
+
+    def _free(self, ref: _TableRef):
+        # Called when the table is freed.
+        self._tables.discard(ref)
+        self.allocated -= ref.size
+
+    def collect(self, target: int = 0) -> int:
+        # Counts the live tables of the VM along with the strings, closures
+        # and coroutines in them. Unreachable cycles are only freed by a
+        # garbage collection, which is run when the count exceeds 'target';
+        # the tables it frees are taken off the count as any other ones.
+        size = self._recount()
+        if size > target:
+            gc.collect()
+            size = self.allocated
+        return size
+
+    def _recount(self) -> int:
+        size = 0
+        for ref in list(self._tables):
+            table = ref()
+            if table is not None:
+                ref.size = _table_size(table)
+                size += ref.size
+        self.allocated = size
+        self.collections += 1
+        return size
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "allocated": self.allocated,
+            "peak": self.peak,
+            "collections": self.collections,
+            "errors": self.errors,
+        }
+
+
+def _table_size(table: LuaTable) -> int:
+    size = TABLE_SIZE + len(table.array) * SLOT_SIZE + len(table.hash) * ENTRY_SIZE
+    for value in table.array:
+        if value.__class__ is str:
+            size += STRING_SIZE + len(value)
+        elif value.__class__ is LuaFunction:
+            size += CLOSURE_SIZE + UPVALUE_SIZE * len(value.upvalues)
+        elif value.__class__ is Coroutine:
+            size += COROUTINE_SIZE
+    for key, value in table.hash.items():
+        if key.__class__ is str:
+            size += STRING_SIZE + len(key)
+        if value.__class__ is str:
+            size += STRING_SIZE + len(value)
+        elif value.__class__ is LuaFunction:
+            size += CLOSURE_SIZE + UPVALUE_SIZE * len(value.upvalues)
+        elif value.__class__ is Coroutine:
+            size += COROUTINE_SIZE
+    return size
@@ -0,0 +1,147 @@
+from typing import Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Importing the compiler here would import this package again through it.
+    from luark.compiler.program import Prototype
+
+
+class Upvalue:
+    # A reference to a variable slot. While the enclosing function is
+    # running, 'cells' is the locals list of its frame; upvalues created
+    # by the VM for the main chunk get a list of their own.
+    __slots__ = ("cells", "index")
+
+    def __init__(self, cells: list, index: int):
+        self.cells = cells
+        self.index = index
+
+    def get(self):
+        return self.cells[self.index]
+
+    def set(self, value):
+        self.cells[self.index] = value
+
+
+class LuaFunction:
+    __slots__ = ("proto", "code", "upvalues", "__weakref__")
+
+    def __init__(self, proto: "Prototype", code: list, upvalues: list[Upvalue]):
+        self.proto = proto
+        self.code = code
+        self.upvalues = upvalues
+
+    def __repr__(self):
+        return f"function: 0x{id(self):08x}"
+
+
+class VMFunction:
+    # A built-in function that needs access to the VM internals, e.g. to
+    # run another function in protected mode or to switch coroutines.
+    # It is called as 'function(vm, frame, args, expected)' and either
+    # pushes its results onto the caller frame and returns None, or
+    # returns the frame execution should continue with.
+    __slots__ = ("name", "function")
+
+    def __init__(self, name: str, function: Callable):
+        self.name = name
+        self.function = function
+
+    def __repr__(self):
+        return f"builtin: {self.name}"
+
+
+class Frame:
+    __slots__ = (
+        "function",
+        "code",
+        "pc",
+        "locals",
+        "stack",
+        "varargs",
+        "upvalues",
+        "parent",
+        "expected",
+        "depth",
+        "open_upvalues",
+        "protected",
+        "tbc",
+    )
+
+    def __init__(
+            self,
+            function: LuaFunction | None,
+            code: list,
+            stack: list,
+            varargs: list,
+            num_locals: int,
+            parent: "Frame | None",
+            expected: int,
+    ):
+        self.function = function
+        self.code = code
+        self.pc = 0
+        self.locals = [None] * num_locals
+        self.stack = stack
+        self.varargs = varargs
+        self.upvalues = function.upvalues if function is not None else None
+        self.parent = parent
+        self.expected = expected  # encoded like the return count of 'call'
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.open_upvalues: dict[int, Upvalue] | None = None
+        self.protected = False  # true for frames started by 'pcall'
+        self.tbc: list[tuple[int, object]] | None = None  # to-be-closed variables: (local, value)
+
+
+
+class Coroutine:
+    # A Lua thread. Its frames live on the heap like all the others, with
+    # the bottom one returning to the coroutine instead of a parent frame.
+    # A suspended coroutine keeps the frame that called 'yield', and
+    # resuming it makes that frame the current one again.
+    __slots__ = (
+        "function",
+        "status",
+        "frame",
+        "resume_expected",
+        "caller",
+        "caller_expected",
+        "previous",
+        "wrapped",
+        "host_depth",
+    )
+
+    def __init__(self, function):
+        self.function = function  # until the first resume
+        self.status = "suspended"  # or "running", "normal", "dead"
+        self.frame: Frame | None = None  # suspended in 'yield'
+        self.resume_expected = 0  # result count of that 'yield'
+        self.caller: Frame | None = None  # resumed it while running, main coroutines have none
+        self.caller_expected = 0
+        self.previous: Coroutine | None = None  # was running before
+        self.wrapped = False  # resumed through 'coroutine.wrap'
+        self.host_depth = 0  # nested VM calls of the host when resumed
+
+    def __repr__(self):
+        return f"thread: 0x{id(self):08x}"
+
+
+class Task:
+    # A script run in slices with 'LuaVM.run_slice', see scheduler.py.
+    __slots__ = ("frame", "current", "weight", "results", "error")
+
+    def __init__(self, frame: Frame):
+        self.frame: Frame | None = frame  # continues from here, None when done
+        self.current = Coroutine(None)  # the running coroutine, the task's own at first
+        self.current.status = "running"
+        self.weight = 1  # share of the time given by a scheduler
+        self.results: list | None = None
+        self.error: Exception | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.frame is None
+
+    def result(self) -> list:
+        if self.error is not None:
+            raise self.error
+        return self.results
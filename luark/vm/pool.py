@@ -0,0 +1,293 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future
+from multiprocessing.connection import Connection, wait
+
+from luark.compiler import precompiled
+from luark.compiler.program import Program
+from luark.vm.errors import LuaError, PoolError, WorkerCrashError, JobTimeoutError
+from luark.vm.objects import LuaFunction, VMFunction, Coroutine
+from luark.vm.table import LuaTable
+
+# Runs Lua programs in a pool of worker processes, so that independent
+# scripts can use more than one core. Every worker keeps a VM with the
+# standard library, and each job gets fresh globals. Programs are sent to a
+# worker in the precompiled format the first time it runs them, and are
+# referred to by their hash after that; both sides evict the least recently
+# used ones in the same order, so they always agree on what a worker has.
+# A dispatcher thread sends the jobs and collects the results. A worker that
+# dies or runs a job for longer than its timeout is replaced by a new one.
+
+DEFAULT_MAX_PROGRAMS = 64
+
+
+class _Pickler(pickle.Pickler):
+    # Functions and coroutines are tied to the VM that made them.
+    def reducer_override(self, obj):
+        if obj.__class__ is LuaFunction or obj.__class__ is VMFunction:
+            raise PoolError("cannot send a function value to another process")
+        if obj.__class__ is Coroutine:
+            raise PoolError("cannot send a thread value to another process")
+        return NotImplemented
+
+
+def _dumps(value) -> bytes:
+    buffer = io.BytesIO()
+    _Pickler(buffer, pickle.HIGHEST_PROTOCOL).dump(value)
+    return buffer.getvalue()
+
+
+class _Job:
+    __slots__ = ("future", "digest", "data", "args", "timeout")
+
+    def __init__(self, future: Future, digest: bytes, data: bytes, args: bytes, timeout: float | None):
+        self.future = future
+        self.digest = digest
+        self.data = data  # the precompiled program
+        self.args = args  # pickled
+        self.timeout = timeout
+
+
+class _Worker:
+    __slots__ = ("process", "conn", "programs", "job", "deadline")
+
+    def __init__(self, process, conn: Connection):
+        self.process = process
+        self.conn = conn
+        self.programs: OrderedDict[bytes, None] = OrderedDict()  # the worker has, by hash
+        self.job: _Job | None = None
+        self.deadline: float | None = None
+
+
+class Pool(Executor):
+    def __init__(
+            self,
+            workers: int | None = None,
+            timeout: float | None = None,
+            max_programs: int = DEFAULT_MAX_PROGRAMS,
+            mp_context=None,
+    ):
+        self.timeout = timeout  # of jobs submitted without one, in seconds
+        self.max_programs = max_programs  # kept by every worker
+        self._context = mp_context if mp_context is not None else multiprocessing.get_context()
+        self._lock = threading.Lock()
+        self._jobs: deque[_Job] = deque()
+        self._closed = False
+        # Precompiled programs and their hashes.
+        self._programs: weakref.WeakKeyDictionary[Program, tuple[bytes, bytes]] = weakref.WeakKeyDictionary()
+        self._wakeup_reader, self._wakeup_writer = self._context.Pipe(duplex=False)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._workers = [self._start_worker() for _ in range(workers)]
+        self._thread = threading.Thread(target=self._dispatch, name="luark-pool", daemon=True)
+        self._thread.start()
+
+    def submit(self, program: Program, /, *args, timeout: float | None = None) -> Future:
+        # The future gets the list of results of the main function, or the
+        # error it raised. Arguments and results are pickled, so they may
+        # not contain functions or coroutines.
+        digest, data = self._precompiled(program)
+        job = _Job(Future(), digest, data, _dumps(args), timeout if timeout is not None else self.timeout)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("cannot schedule new jobs after shutdown")
+            self._jobs.append(job)
+        self._wakeup_writer.send_bytes(b"")
+        return job.future
+
+    def run(self, program: Program, *args, timeout: float | None = None) -> list:
+        return self.submit(program, *args, timeout=timeout).result()
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self._lock:
+            self._closed = True
+            if cancel_futures:
+                while self._jobs:
+                    self._jobs.popleft().future.cancel()
+        self._wakeup_writer.send_bytes(b"")
+        if wait:
+            self._thread.join()
+
+    def _precompiled(self, program: Program) -> tuple[bytes, bytes]:
+        with self._lock:
+            entry = self._programs.get(program)
+        if entry is None:
+            data = precompiled.dumps(program)
+            entry = (hashlib.blake2b(data, digest_size=16).digest(), data)
+            with self._lock:
+                self._programs[program] = entry
+        return entry
+
+    # Dispatcher thread
+
+    def _start_worker(self) -> _Worker:
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(child_conn, self.max_programs),
+            name="luark-pool-worker",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        return _Worker(process, conn)
+
+    def _dispatch(self):
+        while True:
+            started = []
+            with self._lock:
+                for worker in self._workers:
+                    if not self._jobs:
+                        break
+                    if worker.job is None:
+                        job = self._jobs.popleft()
+                        if job.future.set_running_or_notify_cancel():
+                            started.append((worker, job))
+                if self._closed and not self._jobs and not started:
+                    if all(worker.job is None for worker in self._workers):
+                        break
+            for worker, job in started:
+                self._send(worker, job)
+
+            objects = [self._wakeup_reader]
+            deadlines = []
+            for worker in self._workers:
+                objects.append(worker.process.sentinel)
+                if worker.job is not None:
+                    objects.append(worker.conn)
+                if worker.deadline is not None:
+                    deadlines.append(worker.deadline)
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            ready = wait(objects, timeout)
+
+            if self._wakeup_reader in ready:
+                while self._wakeup_reader.poll():
+                    self._wakeup_reader.recv_bytes()
+            for worker in list(self._workers):
+                if worker.job is not None and worker.conn in ready:
+                    try:
+                        reply = worker.conn.recv_bytes()
+                    except (EOFError, OSError):
+                        self._replace(worker, None)
+                        continue
+                    job = worker.job
+                    worker.job = None
+                    worker.deadline = None
+                    self._finish(job, reply)
+                elif worker.process.sentinel in ready:
+                    self._replace(worker, None)
+            now = time.monotonic()
+            for worker in list(self._workers):
+                if worker.deadline is not None and worker.deadline <= now:
+                    self._replace(worker, JobTimeoutError(f"job timed out after {worker.job.timeout} seconds"))
+
+        for worker in self._workers:
+            try:
+                worker.conn.send_bytes(pickle.dumps(None))
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join()
+            worker.conn.close()
+
+    def _send(self, worker: _Worker, job: _Job):
+        data = None
+        if job.digest in worker.programs:
+            worker.programs.move_to_end(job.digest)
+        else:
+            data = job.data
+            worker.programs[job.digest] = None
+            if len(worker.programs) > self.max_programs:
+                worker.programs.popitem(last=False)
+        worker.job = job
+        if job.timeout is not None:
+            worker.deadline = time.monotonic() + job.timeout
+        try:
+            worker.conn.send_bytes(pickle.dumps((job.digest, data, job.args), pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            self._replace(worker, None)
+
+    def _replace(self, worker: _Worker, error: PoolError | None):
+        # Kills the worker, fails its job and starts a new worker instead.
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join()
+        worker.conn.close()
+        job = worker.job
+        if job is not None:
+            if error is None:
+                error = WorkerCrashError(f"worker process exited with code {worker.process.exitcode}")
+            job.future.set_exception(error)
+        self._workers[self._workers.index(worker)] = self._start_worker()
+
+    @staticmethod
+    def _finish(job: _Job, reply: bytes):
+        try:
+            ok, value = pickle.loads(reply)
+        except Exception as e:
+            job.future.set_exception(PoolError(f"cannot receive the results: {e}"))
+            return
+        if ok:
+            job.future.set_result(value)
+        else:
+            job.future.set_exception(value)
+
+
+def _worker_main(conn: Connection, max_programs: int):
+    from luark.vm.lib import open_libs
+    from luark.vm.luavm import LuaVM
+
+    vm = LuaVM(stdlib=False)
+    programs: OrderedDict[bytes, Program] = OrderedDict()
+    while True:
+        try:
+            message = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        digest, data, args = message
+        if data is not None:
+            programs[digest] = precompiled.loads(data)
+            if len(programs) > max_programs:
+                _, evicted = programs.popitem(last=False)
+                for proto in evicted.prototypes:
+                    vm._code.pop(proto, None)
+        else:
+            programs.move_to_end(digest)
+
+        vm.env = LuaTable()
+        open_libs(vm)
+        try:
+            reply = (True, vm.run(programs[digest], *pickle.loads(args)))
+        except Exception as e:
+            reply = (False, e)
+        conn.send_bytes(_reply_bytes(reply))
+
+
+def _reply_bytes(reply: tuple) -> bytes:
+    try:
+        data = _dumps(reply)
+        if not reply[0]:
+            pickle.loads(data)
+        return data
+    except Exception as e:
+        ok, value = reply
+        if ok:
+            error = e if isinstance(e, PoolError) else PoolError(f"cannot send the results: {e}")
+        else:
+            # As with compile errors, exceptions that cannot be restored in
+            # the parent process are replaced with a plain error.
+            error = LuaError(str(value))
+        try:
+            return _dumps((False, error))
+        except Exception:
+            return _dumps((False, LuaError(str(error))))
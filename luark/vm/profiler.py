@@ -0,0 +1,157 @@
+import time
+from collections import Counter
+from typing import Any
+
+from luark.compiler.program import Prototype, Opcode
+from luark.vm.objects import Frame
+
+# Execution counters of a VM with profiling enabled. Every executed
+# instruction is counted per (prototype, pc); opcode totals are derived from
+# these when a report is made. Calls are timed per prototype: the total
+# time of a function only counts its outermost activation, so recursion is
+# not counted twice, while the self time excludes the functions it calls.
+
+
+class _FunctionStats:
+    __slots__ = ("calls", "total_time", "self_time", "active")
+
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        self.active = 0  # activations currently running
+
+
+class VMProfile:
+    def __init__(self):
+        self.counts: dict[Prototype, list[int]] = {}
+        self.functions: dict[Prototype, _FunctionStats] = {}
+        self._running: list[list] = []  # [frame, start, time spent in callees]
+
+    def reset(self):
+        self.counts.clear()
+        self.functions.clear()
+
+    # Called by the VM
+
+    def counters(self, frame: Frame) -> list[int]:
+        if frame.function is None:
+            return [0] * len(frame.code)  # host call trampolines are not counted
+        proto = frame.function.proto
+        counts = self.counts.get(proto)
+        if counts is None:
+            counts = self.counts[proto] = [0] * len(frame.code)
+        return counts
+
+    def switch(self, frame: Frame, base: int):
+        # Execution continues in another frame: either a called function,
+        # one of the callers after a return or an error, or a function
+        # called in tail position, which replaces the running one.
+        running = self._running
+        if len(running) > base and frame.parent is running[-1][0]:
+            self._enter(frame)
+            return
+        now = time.perf_counter()
+        parent = frame.parent
+        while len(running) > base and running[-1][0] is not frame and running[-1][0] is not parent:
+            self._leave(now)
+        if len(running) == base or running[-1][0] is parent:
+            self._enter(frame)
+
+    def finish(self, base: int):
+        # Execution that started at the given depth has ended.
+        now = time.perf_counter()
+        while len(self._running) > base:
+            self._leave(now)
+
+    @property
+    def depth(self) -> int:
+        return len(self._running)
+
+    def _enter(self, frame: Frame):
+        if frame.function is not None:
+            stats = self.functions.get(frame.function.proto)
+            if stats is None:
+                stats = self.functions[frame.function.proto] = _FunctionStats()
+            stats.calls += 1
+            stats.active += 1
+        self._running.append([frame, time.perf_counter(), 0.0])
+
+    def _leave(self, now: float):
+        frame, start, callees = self._running.pop()
+        elapsed = now - start
+        if self._running:
+            self._running[-1][2] += elapsed
+        if frame.function is not None:
+            stats = self.functions[frame.function.proto]
+            stats.active -= 1
+            stats.self_time += elapsed - callees
+            if stats.active == 0:
+                stats.total_time += elapsed
+
+    # Reports
+
+    def opcode_counts(self) -> Counter[Opcode]:
+        totals = Counter()
+        for proto, counts in self.counts.items():
+            for pc, count in enumerate(counts):
+                if count:
+                    totals[proto.decode(pc)[0]] += count
+        return totals
+
+    def hot_instructions(self, top: int = 20) -> list[tuple[str, int, Opcode, int]]:
+        # (function name, pc, opcode, count), most executed first.
+        hot = []
+        for proto, counts in self.counts.items():
+            for pc, count in enumerate(counts):
+                if count:
+                    hot.append((proto.func_name, pc, proto.decode(pc)[0], count))
+        hot.sort(key=lambda item: item[3], reverse=True)
+        return hot[:top]
+
+    def function_stats(self) -> list[dict[str, Any]]:
+        # Sorted by self time.
+        result = []
+        for proto, stats in self.functions.items():
+            counts = self.counts.get(proto)
+            result.append({
+                "function": proto.func_name,
+                "calls": stats.calls,
+                "total_time": stats.total_time,
+                "self_time": stats.self_time,
+                "instructions": sum(counts) if counts is not None else 0,
+            })
+        result.sort(key=lambda item: item["self_time"], reverse=True)
+        return result
+
+    def to_dict(self, top: int = 50) -> dict[str, Any]:
+        return {
+            "opcodes": {opcode.mnemonic: count for opcode, count in self.opcode_counts().most_common()},
+            "hot_instructions": [
+                {"function": name, "pc": pc, "opcode": opcode.mnemonic, "count": count}
+                for name, pc, opcode, count in self.hot_instructions(top)
+            ],
+            "functions": self.function_stats(),
+        }
+
+    def report(self, top: int = 20) -> str:
+        opcodes = self.opcode_counts()
+        total = sum(opcodes.values())
+        out = [f"{total} instructions executed", "", "opcodes:"]
+        for opcode, count in opcodes.most_common(top):
+            out.append(f"{count:>12} {count / total * 100:5.1f}%  {opcode.mnemonic}")
+
+        out.append("")
+        out.append("hot instructions:")
+        for name, pc, opcode, count in self.hot_instructions(top):
+            out.append(f"{count:>12}  {name}:{pc} {opcode.mnemonic}")
+
+        out.append("")
+        out.append("functions:")
+        out.append(f"{'calls':>12} {'total s':>9} {'self s':>9} {'instructions':>13}  function")
+        for stats in self.function_stats()[:top]:
+            out.append(
+                f"{stats['calls']:>12} {stats['total_time']:9.3f} {stats['self_time']:9.3f} "
+                f"{stats['instructions']:>13}  {stats['function']}"
+            )
+        return "\n".join(out)
@@ -0,0 +1,50 @@
+from collections import deque
+
+from luark.compiler.program import Program
+from luark.vm.errors import LuaError
+from luark.vm.objects import Task
+
+# Time slicing of scripts which share a VM. Scripts only count their backward
+# jumps and frame switches (calls, returns, resumes and yields): anything else
+# runs for a bounded number of instructions between two of them. A task whose
+# budget is used up is suspended in the frame it was running and continues
+# there on its next turn, so a script that never ends cannot keep the other
+# ones from running.
+
+DEFAULT_QUANTUM = 1000
+
+
+class Scheduler:
+    # Weighted round robin: a task gets 'quantum' times its weight of
+    # backward jumps and frame switches per turn.
+
+    def __init__(self, vm, quantum: int = DEFAULT_QUANTUM):
+        self.vm = vm  # created with preemptible=True
+        self.quantum = quantum
+        self.tasks: deque[Task] = deque()  # not done yet, in the order of their next turns
+
+    def spawn(self, function, *args, weight: int = 1) -> Task:
+        if isinstance(function, Program):
+            function = self.vm.load(function)
+        task = self.vm.start(function, *args)
+        task.weight = weight
+        self.tasks.append(task)
+        return task
+
+    def step(self) -> bool:
+        # Gives the next task its turn, and returns whether any tasks are
+        # left. The error of a failed task is kept by the task.
+        if not self.tasks:
+            return False
+        task = self.tasks.popleft()
+        try:
+            done = self.vm.run_slice(task, self.quantum * task.weight)
+        except LuaError:
+            done = True
+        if not done:
+            self.tasks.append(task)
+        return bool(self.tasks)
+
+    def run(self):
+        while self.step():
+            pass
@@ -0,0 +1,203 @@
+from typing import TYPE_CHECKING
+
+from luark.vm.errors import LuaError
+
+if TYPE_CHECKING:
+    from luark.vm.memory import MemoryStats
+
+# Approximate sizes in bytes of the parts of a table, see memory.py.
+TABLE_SIZE = 216
+SLOT_SIZE = 8  # of the array part
+ENTRY_SIZE = 52  # of the hash part
+
+
+class _BoolKey:
+    # Python treats True and 1 as the same dictionary key,
+    # so boolean keys are replaced by these sentinels.
+    __slots__ = ("value",)
+
+    def __init__(self, value: bool):
+        self.value = value
+
+    def __repr__(self):
+        return "true" if self.value else "false"
+
+
+_TRUE_KEY = _BoolKey(True)
+_FALSE_KEY = _BoolKey(False)
+
+
+def _normalize(key):
+    cls = key.__class__
+    if cls is bool:
+        return _TRUE_KEY if key else _FALSE_KEY
+    if cls is float and key.is_integer():
+        return int(key)
+    return key
+
+
+def _denormalize(key):
+    if key.__class__ is _BoolKey:
+        return key.value
+    return key
+
+
+class LuaTable:
+    # Values of the integer keys 1..n live in the array part, everything
+    # else in the hash part. The array part never ends with nil and the
+    # hash part never holds any key from 1 to n + 1: a key that would
+    # extend the array is appended to it, along with the keys that follow
+    # it in the hash part. Nil values inside the array are holes.
+    __slots__ = (
+        "array",
+        "hash",
+        "metatable",
+        "version",
+        "memory",
+        "memory_ref",
+        "_order",
+        "_positions",
+        "_array_size",
+        "__weakref__",
+    )
+
+    def __init__(self, memory: "MemoryStats | None" = None):
+        self.memory = None  # and no 'memory_ref', see memory.py
+        if memory is not None:
+            memory.add_table(self)
+            self.memory = memory  # of the VM which made the table for a script
+        self.array: list = []
+        self.hash: dict = {}
+        self.metatable: LuaTable | None = None
+        self.version = 0  # changes with every write to the hash part and the metatable
+        self._order: list | None = None  # key order snapshot of the hash part for 'next'
+        self._positions: dict | None = None
+        self._array_size = 0  # size of the array part when the snapshot was taken
+
+    def __repr__(self):
+        return f"table: 0x{id(self):08x}"
+
+    def set_metatable(self, meta: "LuaTable | None"):
+        # Cached lookups which went through the table depend on its metatable too.
+        self.metatable = meta
+        self.version += 1
+
+    def get(self, key):
+        cls = key.__class__
+        if cls is int:
+            array = self.array
+            if 0 < key <= len(array):
+                return array[key - 1]
+            return self.hash.get(key)
+        if cls is str:
+            return self.hash.get(key)
+        if key is None:
+            return None
+        key = _normalize(key)
+        if key.__class__ is int:
+            return self.get(key)
+        return self.hash.get(key)
+
+    def set(self, key, value):
+        cls = key.__class__
+        if cls is not str and cls is not int:
+            if key is None:
+                raise LuaError("table index is nil")
+            if cls is float and key != key:
+                raise LuaError("table index is NaN")
+            key = _normalize(key)
+            cls = key.__class__
+
+        if cls is int:
+            array = self.array
+            size = len(array)
+            if 0 < key <= size:
+                array[key - 1] = value
+                if value is None and key == size:
+                    array.pop()
+                    while array and array[-1] is None:
+                        array.pop()
+                    if self.memory is not None:
+                        self.memory.shrink(self, (size - len(array)) * SLOT_SIZE)
+                return
+            if key == size + 1:
+                if value is not None:
+                    if self.memory is not None:
+                        self.memory.allocate(SLOT_SIZE)
+                        self.memory_ref.size += SLOT_SIZE
+                    array.append(value)
+                    if self.hash:
+                        self._migrate()
+                    self._order = None  # a new key invalidates the traversal order
+                return
+
+        self.version += 1
+        if value is None:
+            if self.hash.pop(key, None) is not None and self.memory is not None:
+                self.memory.shrink(self, ENTRY_SIZE)
+        else:
+            hash = self.hash
+            if self.memory is not None and key not in hash:
+                self.memory.allocate(ENTRY_SIZE)
+                self.memory_ref.size += ENTRY_SIZE
+            if self._order is not None and key not in hash:
+                self._order = None
+            hash[key] = value
+
+    def _migrate(self):
+        # Moves the keys that continue the array part out of the hash part.
+        array = self.array
+        hash = self.hash
+        key = len(array) + 1
+        while key in hash:
+            array.append(hash.pop(key))
+            key += 1
+
+    def append(self, value):
+        self.set(self.length() + 1, value)
+
+    def length(self) -> int:
+        # Any index 'n' such that t[n] is not nil and t[n + 1] is nil (or
+        # zero if t[1] is nil) is a valid length. The end of the array part
+        # is always one.
+        return len(self.array)
+
+    def next(self, key):
+        # Traverses the array part, then the hash part. Fields may be
+        # cleared during traversal, so the snapshot of the hash part keeps
+        # removed keys and skips them here.
+        if self._order is None:
+            self._order = list(self.hash)
+            self._positions = {k: i for i, k in enumerate(self._order)}
+            self._array_size = len(self.array)
+
+        array = self.array
+        position = 0
+        if key is None:
+            index = 0
+        else:
+            key = _normalize(key)
+            if key.__class__ is int and 0 < key <= max(len(array), self._array_size):
+                index = key  # the array part may have shrunk since the snapshot
+            else:
+                found = self._positions.get(key)
+                if found is None:
+                    raise LuaError("invalid key to 'next'")
+                index = len(array)
+                position = found + 1
+
+        while index < len(array):
+            value = array[index]
+            index += 1
+            if value is not None:
+                return index, value
+
+        order = self._order
+        hash = self.hash
+        while position < len(order):
+            k = order[position]
+            value = hash.get(k)
+            if value is not None:
+                return _denormalize(k), value
+            position += 1
+        return None, None
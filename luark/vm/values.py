@@ -0,0 +1,40 @@
+from luark.numbers import (
+    INT_MIN, INT_MAX, wrap_int, truthy, number_to_str, raw_equals, str_to_number, tonumber, tointeger,
+    arith_int_or_float, float_div, float_floor_div, float_mod, float_pow, to_bit_int, bitwise, shift_left,
+)
+from luark.vm.objects import LuaFunction, VMFunction, Coroutine
+from luark.vm.table import LuaTable
+
+
+def lua_type(value) -> str:
+    if value is None:
+        return "nil"
+    cls = value.__class__
+    if cls is bool:
+        return "boolean"
+    if cls is int or cls is float:
+        return "number"
+    if cls is str:
+        return "string"
+    if cls is LuaTable:
+        return "table"
+    if cls is LuaFunction or cls is VMFunction or callable(value):
+        return "function"
+    if cls is Coroutine:
+        return "thread"
+    return "userdata"
+
+
+def tostring(value) -> str:
+    cls = value.__class__
+    if cls is str:
+        return value
+    if cls is int or cls is float:
+        return number_to_str(value)
+    if value is None:
+        return "nil"
+    if cls is bool:
+        return "true" if value else "false"
+    if cls is LuaTable:
+        return f"table: 0x{id(value):08x}"
+    return f"{lua_type(value)}: 0x{id(value):08x}"
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+from luark.compiler import Compiler, EventRecorder
+from luark.compiler.program import Program
+
+# Times each phase of the compiler on every file of the test corpus and
+# compares the results against a stored baseline. Timings are the best of
+# several runs; peak memory is measured in a separate run, since tracing
+# allocations slows everything down. Only the instruction counts are checked,
+# the rest of the comparison is informational.
+#
+#   python benchmark.py                   compare against the baseline
+#   python benchmark.py --save-baseline   store the results as the new baseline
+
+TEST_DIR = os.path.join(os.path.dirname(__file__), "lua-5.4.7-tests")
+BASELINE = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+PHASES = ("parse", "transform", "emit", "optimize")
+
+
+def compile_timed(compiler: Compiler, source: str) -> tuple[Program, dict[str, float]]:
+    recorder = EventRecorder()
+    compiler.add_observer(recorder)
+    try:
+        program = compiler.compile_source(source)
+    finally:
+        compiler.remove_observer(recorder)
+    return program, {event.phase: event.duration for event in recorder.events if event.phase in PHASES}
+
+
+def peak_memory(compiler: Compiler, source: str) -> int:
+    tracemalloc.start()
+    try:
+        compiler.compile_source(source)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_file(compiler: Compiler, path: str, repeat: int) -> dict:
+    with open(path) as file:
+        source = file.read()
+
+    best = None
+    program = None
+    for _ in range(repeat):
+        program, timings = compile_timed(compiler, source)
+        if best is None:
+            best = timings
+        else:
+            best = {phase: min(best[phase], timings[phase]) for phase in PHASES}
+
+    return {
+        "lines": source.count("\n") + 1,
+        "instructions": sum(len(proto) for proto in program.prototypes),
+        "peak_memory": peak_memory(compiler, source),
+        **best,
+    }
+
+
+def summarize(results: dict[str, dict]) -> dict:
+    total = {key: sum(r[key] for r in results.values()) for key in ("lines", "instructions", *PHASES)}
+    total["peak_memory"] = max((r["peak_memory"] for r in results.values()), default=0)
+    total["time"] = sum(total[phase] for phase in PHASES)
+    return total
+
+
+def print_report(results: dict[str, dict], failed: dict[str, Exception]):
+    print(f"{'file':<20} {'lines':>6} {'instr':>7} {'parse':>8} {'transf':>8} {'emit':>8} {'opt':>8} {'peak KiB':>9}")
+    for name, r in sorted(results.items()):
+        print(
+            f"{name:<20} {r['lines']:>6} {r['instructions']:>7} "
+            f"{r['parse'] * 1000:>6.1f}ms {r['transform'] * 1000:>6.1f}ms {r['emit'] * 1000:>6.1f}ms "
+            f"{r['optimize'] * 1000:>6.1f}ms {r['peak_memory'] / 1024:>9.0f}"
+        )
+    for name, e in sorted(failed.items()):
+        print(f"{name:<20} failed: {type(e).__name__}")
+
+    total = summarize(results)
+    print()
+    print(f"Compiled {len(results)} files ({len(failed)} failed), {total['lines']} lines, "
+          f"{total['instructions']} instructions.")
+    for phase in PHASES:
+        print(f"  {phase:<10} {total[phase]:8.3f}s")
+    print(f"  {'total':<10} {total['time']:8.3f}s")
+    if total["time"] > 0:
+        print(f"Throughput: {total['lines'] / total['time']:.0f} lines/s, "
+              f"{total['instructions'] / total['time']:.0f} instructions/s.")
+    print(f"Peak memory: {total['peak_memory'] / 1024:.0f} KiB.")
+
+
+def compare(results: dict[str, dict], baseline: dict) -> bool:
+    # Only files which compiled in both runs are compared,
+    # so that fixing a failing file is not a regression.
+    names = results.keys() & baseline["files"].keys()
+    current = summarize({name: results[name] for name in names})
+    previous = summarize({name: baseline["files"][name] for name in names})
+
+    # Timings and peak memory depend on the machine and the Python version,
+    # so they are only shown. The instruction counts do not, and a file
+    # that compiles to more instructions than before is a regression.
+    print()
+    print(f"Against the baseline ({len(names)} files, timings and memory are informational):")
+    for key in (*PHASES, "time", "peak_memory", "instructions"):
+        if previous[key] == 0:
+            continue
+        print(f"  {key:<13} {current[key] / previous[key] - 1:+7.1%}")
+    ok = True
+    for name in sorted(names):
+        count = results[name]["instructions"]
+        previous_count = baseline["files"][name]["instructions"]
+        if count > previous_count:
+            ok = False
+            print(f"  {name:<20} {previous_count} -> {count} instructions  REGRESSION")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks the compiler on the test corpus.")
+    parser.add_argument("-O", dest="level", type=int, default=1, help="optimization level")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per file, the best one counts")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    args = parser.parse_args()
+
+    compiler = Compiler(optimization_level=args.level)
+    results = {}
+    failed = {}
+    for name in sorted(os.listdir(TEST_DIR)):
+        try:
+            results[name] = benchmark_file(compiler, os.path.join(TEST_DIR, name), args.repeat)
+        except Exception as e:
+            failed[name] = e
+    print_report(results, failed)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({"level": args.level, "files": results}, file, indent=2, sort_keys=True)
+        print(f"Saved the baseline to '{args.baseline}'.")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against, run with --save-baseline to create one.")
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline["level"] != args.level:
+        print(f"The baseline was made at -O{baseline['level']}, not -O{args.level}.")
+        return 1
+    return 0 if compare(results, baseline) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,26 +7,24 @@ compiler = Compiler()
 
 TEST_DIR = "lua-5.4.7-tests"
 
-with open("REPORT.txt", "w") as report:
-    failed = 0
-    tests = os.listdir(TEST_DIR)
-    for test in tests:
-        file_path = os.path.join(TEST_DIR, test)
-        # noinspection PyBroadException
-        try:
+if __name__ == "__main__":
+    with open("REPORT.txt", "w") as report:
+        failed = 0
+        tests = os.listdir(TEST_DIR)
+        results = compiler.compile_many([os.path.join(TEST_DIR, test) for test in tests])
+        for test, result in zip(tests, results):
             report.write("\n==========================\n\n")
             report.write(f">> Compiling '{test}'...\n")
-            compiler.compile_file(file_path)
-        except Exception as e:
-            report.write(f"'{test}' errored out!\n\n")
-            report.write(traceback.format_exc())
-            report.write("\n")
-            failed += 1
-        else:
-            report.write("Success!\n")
+            if isinstance(result, Exception):
+                report.write(f"'{test}' errored out!\n\n")
+                report.write("".join(traceback.format_exception(result)))
+                report.write("\n")
+                failed += 1
+            else:
+                report.write("Success!\n")
 
-    total = len(tests)
-    successful = total - failed
-    message = f"Compiled {successful} tests out of {total} ({failed} failed).\n"
-    report.write(message)
-    print(message)
+        total = len(tests)
+        successful = total - failed
+        message = f"Compiled {successful} tests out of {total} ({failed} failed).\n"
+        report.write(message)
+        print(message)
@@ -0,0 +1,414 @@
+import asyncio
+import io
+import os
+import tempfile
+
+from luark.compiler import Compiler, CompilationCache, precompiled
+from luark.compiler.errors import PrecompiledFormatError
+from luark.vm import LuaVM, LuaError, Pool, PoolError, Scheduler
+
+# Regression checks for the VM: each script is compiled at every
+# optimization level and must return the expected values. The other
+# checks run scripts through the host interfaces of the compiler and VM.
+#
+#   python vm_test.py
+
+LEVELS = (0, 1, 2)
+
+SHORT_CIRCUIT = """
+local calls = 0
+local function f(v) calls = calls + 1 return v end
+local r1 = f(false) and f(1)
+local r2 = f(1) or f(2)
+local r3 = f(nil) or f(3)
+local r4 = f(2) and f(4)
+local t = nil
+local r5 = t and t.x
+local r6 = (f(nil) and f(1)) or f(5)
+return r1, r2, r3, r4, r5, r6, calls
+"""
+
+TO_BE_CLOSED = """
+local log = {}
+local function closer(name)
+    return setmetatable({}, {__close = function(_, err) log[#log + 1] = name .. "=" .. tostring(err) end})
+end
+do
+    local a <close> = closer("a")
+    local b <close> = closer("b")
+end
+for i = 1, 3 do
+    local c <close> = closer("c" .. i)
+    if i == 2 then break end
+end
+local function f()
+    local d <close> = closer("d")
+    return "r"
+end
+local r = f()
+pcall(function()
+    local e <close> = closer("e")
+    error("boom", 0)
+end)
+for _ in function(_, i) if not i then return 1 end end, nil, nil, closer("for") do end
+return r, table.concat(log, " ")
+"""
+
+CONSTANT_OPERANDS = """
+local function f() return 1, 2 end
+local function g(...) return nil or ... end
+local c <const> = false
+return select("#", false or f()), select("#", true and f()), select("#", g(7, 8)), select("#", c or f()), false or f()
+"""
+
+GOTO = """
+local out = {}
+do goto done end
+out[#out + 1] = "skipped"
+::done::
+for i = 1, 4 do
+  if i % 2 == 0 then goto continue end
+  local x = i * 10
+  out[#out + 1] = x
+  ::continue::
+end
+local i = 0
+::top::
+i = i + 1
+if i < 3 then goto top end
+out[#out + 1] = i
+while true do
+  do
+    do goto out end
+  end
+end
+::out::
+local n = 0
+repeat
+  n = n + 1
+  if n < 3 then goto cont end
+  out[#out + 1] = "n" .. n
+  ::cont::
+until n >= 4
+return table.concat(out, " ")
+"""
+
+METATABLE_CACHES = """
+local function g() return y end
+g()
+setmetatable(_ENV, {__index = {y = 42}})
+local base = {}
+local mid = setmetatable({}, {__index = base})
+local obj = setmetatable({}, {__index = mid})
+local function get(o) return o.v end
+local before = get(obj)
+get(obj)
+setmetatable(mid, {__index = {v = 99}})
+return g(), before, get(obj)
+"""
+
+EXTRA_ARGUMENTS = """
+return math.type(next({5})), string.upper("a", "b"), math.abs(-1, 2), select("#", os.time(nil, 1))
+"""
+
+TABLES = """
+local t = {10, 20, 30, x = 1, [5] = 50}
+t[4] = 40
+local n1 = #t
+t[6] = nil
+t[5] = nil
+local n2 = #t
+local keys = 0
+for k, v in pairs(t) do keys = keys + 1 end
+t[2.0] = "two"
+t[true] = "yes"
+local sum = 0
+for i, v in ipairs({1, 2, 3, nil, 5}) do sum = sum + v end
+return n1, n2, keys, t[2], t[true], sum, select("#", table.unpack({1, nil, 3}, 1, 3))
+"""
+
+FOR_LOOPS = """
+local out = {}
+for i = 1, 3 do out[#out + 1] = i end
+for i = 3, 1, -1 do out[#out + 1] = i end
+for i = 1, 2, 0.5 do out[#out + 1] = i end
+for i = math.maxinteger - 1, math.maxinteger do out[#out + 1] = i - math.maxinteger end
+for i = 1, 0 do out[#out + 1] = "never" end
+for i = 1, 3 do local j = i i = 10 out[#out + 1] = j end
+out[#out + 1] = tostring(pcall(function() for i = 1, 10, 0 do end end))
+return table.concat(out, " ")
+"""
+
+CONSTANTS = """
+local a = "hello"
+local b = "hel" .. "lo"
+local t = {[1] = "int", [1.5] = "float", ["1"] = "str"}
+return a == b, 1 == 1.0, math.type(2^53), t[1], t[1.0], t[1.5], t["1"], 1 // 0.0, 3 % -2,
+    math.maxinteger + 1 == math.mininteger
+"""
+
+COROUTINES = """
+local function gen(n)
+    return coroutine.wrap(function()
+        local function deep(i) if i > n then return end coroutine.yield(i) return deep(i + 1) end
+        deep(1)
+    end)
+end
+local s = 0
+for v in gen(1000) do s = s + v end
+local co = coroutine.create(function(a, b)
+    local c = coroutine.yield(a + b)
+    local ok, v = pcall(function() return coroutine.yield(c * 2) end)
+    error("x" .. v, 0)
+end)
+local r = {}
+local function add(...) for i = 1, select("#", ...) do r[#r + 1] = tostring((select(i, ...))) end end
+add(coroutine.resume(co, 1, 2))
+add(coroutine.resume(co, 5))
+add(coroutine.resume(co, "y"))
+add(coroutine.status(co), coroutine.resume(co))
+local function rec(n) if n == 0 then return 0 end return 1 + rec(n - 1) end
+add(coroutine.wrap(function() return rec(20000) end)())
+return s, table.concat(r, " ")
+"""
+
+FIELD_CACHES = """
+local Point = {}
+Point.__index = Point
+function Point.new(x, y) return setmetatable({x = x, y = y}, Point) end
+function Point:len2() return self.x * self.x + self.y * self.y end
+local total = 0
+for i = 1, 100 do total = total + Point.new(i, 1):len2() end
+local p = Point.new(3, 4)
+local before = p:len2()
+function Point:len2() return 0 end
+return total, before, p:len2(), p.missing
+"""
+
+TAIL_CALLS = """
+local function count(n, acc) if n == 0 then return acc end return count(n - 1, acc + 1) end
+local function even(n) if n == 0 then return true end return odd(n - 1) end
+function odd(n) if n == 0 then return false end return even(n - 1) end
+return count(100000, 0), even(10001), select("#", (function(...) return select(2, ...) end)(1, 2, 3))
+"""
+
+AWAITS = """
+local n = ...
+local co = coroutine.wrap(function() coroutine.yield(fetch(n)) end)
+local ok, v = pcall(fetch, n + 1)
+return fetch(n) + co(), ok, v
+"""
+
+SLICED = """
+local name, n = ...
+for i = 1, n do note(name) end
+return name
+"""
+
+INCREMENTAL = """
+local function square(x) return x * x end
+local function cube(x) return x * square(x) end
+local function offset() return %d end
+return cube(3) + offset()
+"""
+
+TABLE_CHURN = """
+local n = 0
+for i = 1, 2000 do
+    local t = {}
+    for j = 1, 20 do t[j] = j end
+    t.self = t
+    n = n + #t
+end
+return n
+"""
+
+CHECKS = [
+    ("and/or short-circuit", SHORT_CIRCUIT, [False, 1, 3, 4, None, 5, 8]),
+    ("to-be-closed variables", TO_BE_CLOSED, ["r", "b=nil a=nil c1=nil c2=nil d=nil e=boom for=nil"]),
+    ("and/or with a constant left operand", CONSTANT_OPERANDS, [1, 1, 1, 1, 1]),
+    ("goto in nested blocks", GOTO, ["10 30 3 n3 n4"]),
+    ("metatable changes", METATABLE_CACHES, [42, None, 99]),
+    ("extra arguments", EXTRA_ARGUMENTS, ["integer", "A", 1, 1]),
+    ("tables", TABLES, [5, 4, 5, "two", "yes", 6, 3]),
+    ("numeric for loops", FOR_LOOPS, ["1 2 3 3 2 1 1.0 1.5 2.0 -1 0 1 2 3 false"]),
+    ("constants", CONSTANTS, [True, True, "float", "int", "int", "float", "str", float("inf"), -1, True]),
+    ("coroutines", COROUTINES, [500500, "true 3 true 10 false xy dead false cannot resume dead coroutine 20000"]),
+    ("field caches", FIELD_CACHES, [338450, 25, 0, None]),
+]
+
+
+def check_tail_calls(level: int):
+    # Tail calls reuse the frame of the caller, so they are not limited by
+    # the depth of the call stack.
+    compiler = Compiler(optimization_level=level)
+    vm = LuaVM(max_depth=1000)
+    assert vm.run(compiler.compile_source(TAIL_CALLS)) == [100000, False, 2]
+    try:
+        vm.run(compiler.compile_source("local function f(n) if n > 0 then return 1 + f(n - 1) end end f(2000)"))
+    except LuaError as e:
+        assert str(e).endswith("stack overflow"), e
+    else:
+        raise AssertionError("the call depth was not limited")
+
+
+def check_inline_caches(level: int):
+    vm = LuaVM()
+    vm.run(Compiler(optimization_level=level).compile_source(FIELD_CACHES))
+    hits = {}
+    for stats in vm.inline_cache_stats():
+        hits[stats["key"]] = hits.get(stats["key"], 0) + stats["hits"]
+    # Method lookups only get a field cache when the compiler optimizes.
+    assert hits["setmetatable"] >= 99 and (level == 0 or hits["len2"] >= 99), hits
+
+
+def check_run_async(level: int):
+    async def fetch(x):
+        await asyncio.sleep(0)
+        return x * 2
+
+    async def run_all():
+        return await asyncio.gather(*(vm.run_async(program, n) for n in range(10)))
+
+    program = Compiler(optimization_level=level).compile_source(AWAITS)
+    vm = LuaVM()
+    vm.env.set("fetch", fetch)
+    assert asyncio.run(run_all()) == [[4 * n, True, 2 * n + 2] for n in range(10)]
+    try:
+        vm.run(program, 1)
+    except LuaError as e:
+        assert str(e).endswith("attempt to await outside run_async"), e
+    else:
+        raise AssertionError("an awaitable was used outside run_async")
+
+
+def check_scheduler(level: int):
+    # A task that never ends does not keep the other ones from running,
+    # and a task of weight 2 gets twice as many turns.
+    notes = []
+    vm = LuaVM(preemptible=True)
+    vm.env.set("note", notes.append)
+    compiler = Compiler(optimization_level=level)
+    scheduler = Scheduler(vm, quantum=5)
+    forever = scheduler.spawn(compiler.compile_source("while true do end"))
+    program = compiler.compile_source(SLICED)
+    a = scheduler.spawn(program, "a", 20)
+    b = scheduler.spawn(program, "b", 20, weight=2)
+    for _ in range(50):
+        scheduler.step()
+    assert a.result() == ["a"] and b.result() == ["b"] and not forever.done
+    assert notes.index("b") < notes.index("a") + 10 and notes[-1] == "a", notes
+
+
+def check_pool(level: int):
+    compiler = Compiler(optimization_level=level)
+    with Pool(workers=1) as pool:
+        assert pool.run(compiler.compile_source(TAIL_CALLS)) == [100000, False, 2]
+        assert pool.run(compiler.compile_source(SLICED.replace("note(name)", "")), "x", 3) == ["x"]
+        try:
+            pool.run(compiler.compile_source("error('boom', 0)"))
+        except LuaError as e:
+            assert str(e).endswith("boom"), e
+        else:
+            raise AssertionError("the error was not passed on")
+        try:
+            pool.run(compiler.compile_source("return function() end"))
+        except PoolError:
+            pass
+        else:
+            raise AssertionError("a function was sent to another process")
+
+
+def check_precompiled(level: int):
+    program = Compiler(optimization_level=level).compile_source(COROUTINES)
+    expected = LuaVM().run(program)
+    assert LuaVM().run(precompiled.loads(precompiled.dumps(program))) == expected
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "coroutines" + precompiled.EXTENSION)
+        precompiled.dump(program, path)
+        assert LuaVM().run(precompiled.load(path)) == expected
+    try:
+        precompiled.loads(b"not a program")
+    except PrecompiledFormatError:
+        pass
+    else:
+        raise AssertionError("a corrupt program was loaded")
+
+
+def check_compilation_cache(level: int):
+    # The second compiler finds the program on disk.
+    with tempfile.TemporaryDirectory() as directory:
+        for expected_stats in ((1, 0, 1), (0, 1, 1)):
+            cache = CompilationCache(directory=directory)
+            compiler = Compiler(optimization_level=level, cache=cache)
+            for _ in range(2):
+                assert LuaVM().run(compiler.compile_source(TABLES)) == [5, 4, 5, "two", "yes", 6, 3]
+            assert (cache.misses, cache.disk_hits, cache.hits) == expected_stats
+
+
+def check_incremental(level: int):
+    # Only the changed function and the main function are emitted again.
+    compiler = Compiler(optimization_level=level, incremental=True)
+    assert LuaVM().run(compiler.compile_source(INCREMENTAL % 1, "script.lua")) == [28]
+    assert LuaVM().run(compiler.compile_source(INCREMENTAL % 2, "script.lua")) == [29]
+    functions = compiler.function_caches["script.lua"]
+    assert (functions.reused, functions.emitted) == (2, 2)
+
+
+def check_streaming(level: int):
+    compiler = Compiler(optimization_level=level)
+    for name, source, expected in CHECKS:
+        results = LuaVM().run(compiler.compile_stream(io.StringIO(source), chunk_size=64))
+        assert results == expected, f"streamed {name}: {results} != {expected}"
+
+
+def check_memory_limit(level: int):
+    compiler = Compiler(optimization_level=level)
+    vm = LuaVM(track_memory=True)
+    allocated = vm.memory.allocated
+    assert vm.run(compiler.compile_source("local t = {} for i = 1, 1000 do t[i] = {i} end return #t")) == [1000]
+    assert vm.memory.peak > allocated + 200_000 and vm.memory.allocated == allocated, vm.memory.to_dict()
+
+    # Garbage tables are taken off the count when they are freed, so
+    # churning through much more than the limit never needs a recount.
+    vm = LuaVM(memory_limit=200_000)
+    assert vm.run(compiler.compile_source(TABLE_CHURN)) == [40000]
+    assert vm.memory.collections <= 1, vm.memory.to_dict()
+    assert vm.memory.errors == 0
+
+    vm = LuaVM(memory_limit=200_000)
+    try:
+        vm.run(compiler.compile_source("local t = {} for i = 1, 1e6 do t[i] = {} end"))
+    except LuaError as e:
+        assert str(e).endswith("not enough memory"), e
+    else:
+        raise AssertionError("the memory limit was not enforced")
+    assert vm.memory.peak <= 200_000
+
+
+HOST_CHECKS = [
+    check_tail_calls,
+    check_inline_caches,
+    check_run_async,
+    check_scheduler,
+    check_pool,
+    check_precompiled,
+    check_compilation_cache,
+    check_incremental,
+    check_streaming,
+    check_memory_limit,
+]
+
+
+if __name__ == "__main__":
+    for level in LEVELS:
+        compiler = Compiler(optimization_level=level)
+        for name, source, expected in CHECKS:
+            results = LuaVM().run(compiler.compile_source(source))
+            assert results == expected, f"{name} at -O{level}: {results} != {expected}"
+        for check in HOST_CHECKS:
+            try:
+                check(level)
+            except AssertionError as e:
+                raise AssertionError(f"{check.__name__} at -O{level}: {e}") from e
+    print(f"Passed {len(CHECKS) + len(HOST_CHECKS)} checks at {len(LEVELS)} optimization levels.")